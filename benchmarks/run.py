@@ -0,0 +1,172 @@
+"""
+Run the stage benchmarks and compare them with a baseline.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import itertools
+import statistics
+import subprocess
+import multiprocessing
+
+from s2p import parallel
+
+
+def run_case(name, params, work_dir, repeat):
+    """
+    Prepare a benchmark case and time it. Meant to be run in a new process,
+    so that the memory measures are not polluted by the other cases.
+
+    Returns:
+        list of the measures of each run, see parallel.measure_call
+    """
+    from benchmarks import stages
+
+    # as in s2p.main
+    os.environ['GDAL_NUM_THREADS'] = '1'
+    os.environ['OMP_NUM_THREADS'] = '1'
+
+    run = stages.BENCHMARKS[name][0](*params, work_dir)
+    measures = []
+    for _ in range(repeat):
+        _, m = parallel.measure_call(run)
+        measures.append(m)
+    return measures
+
+
+def cases(names, values):
+    """
+    List the (name, parameters) of the cases of some benchmarks.
+
+    Args:
+        names: names of the benchmarks
+        values: dictionary of the values of each case parameter
+    """
+    from benchmarks import stages
+
+    for name in names:
+        params = stages.BENCHMARKS[name][1]
+        for p in itertools.product(*[values[k] for k in params]):
+            yield name, dict(zip(params, p))
+
+
+def case_id(name, params):
+    return ' '.join([name] + ['{}={}'.format(k, v) for k, v in params.items()])
+
+
+def summarize(measures):
+    times = [m['end'] - m['start'] for m in measures]
+    return {'time': statistics.median(times), 'min_time': min(times),
+            'cpu_time': statistics.median(m['cpu_time'] + m['children_cpu_time'] for m in measures),
+            'peak_rss_mb': max(max(m['peak_rss_mb'], m['children_peak_rss_mb'] or 0)
+                               for m in measures)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results, with their ratio to the baseline.
+
+    Returns:
+        list of the ids of the cases slower than the baseline by more than
+        the tolerance
+    """
+    slower = []
+    print('{:60s} {:>9s} {:>9s} {:>10s} {:>9s} {:>7s}'.format(
+        'case', 'time (s)', 'cpu (s)', 'peak (MB)', 'base (s)', 'ratio'))
+    for k, r in results.items():
+        line = '{:60s} {:9.3f} {:9.3f} {:10.0f}'.format(k, r['time'], r['cpu_time'],
+                                                         r['peak_rss_mb'])
+        if k in baseline:
+            ratio = r['time'] / baseline[k]['time']
+            line += ' {:9.3f} {:7.2f}'.format(baseline[k]['time'], ratio)
+            if ratio > 1 + tolerance:
+                line += '  slower'
+                slower.append(k)
+            elif ratio < 1 / (1 + tolerance):
+                line += '  faster'
+        print(line)
+    return slower
+
+
+def main():
+    from benchmarks import stages
+
+    parser = argparse.ArgumentParser(description='s2p stage benchmarks')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run, among {} (default: all)'.format(
+                            ', '.join(stages.BENCHMARKS)))
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--disp-ranges', type=int, nargs='+', default=[16, 64, 128])
+    parser.add_argument('--algorithms', nargs='+', default=['mgm', 'mgm_multi'],
+                        help='matching algorithms benchmarked')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each case')
+    parser.add_argument('--work-dir', default='benchmarks_work',
+                        help='directory of the synthetic scenes and outputs')
+    parser.add_argument('--output', help='json file where the results are written')
+    parser.add_argument('--baseline', help='json file of previous results')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in stages.BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+
+    values = {'tile_size': args.tile_sizes, 'disp_range': args.disp_ranges,
+              'algorithm': args.algorithms}
+    names = args.benchmarks or list(stages.BENCHMARKS)
+    work_dir = os.path.abspath(args.work_dir)
+
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    for name, params in cases(names, values):
+        k = case_id(name, params)
+        print(k, file=sys.stderr)
+        with ctx.Pool(1) as pool:
+            try:
+                measures = pool.apply(run_case, (name, list(params.values()),
+                                                 work_dir, args.repeat))
+            except Exception as e:
+                print('{} failed: {}'.format(k, e), file=sys.stderr)
+                continue
+        results[k] = summarize(measures)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    slower = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+                       'git_revision': git_revision(), 'repeat': args.repeat,
+                       'results': results}, f, indent=2)
+
+    if slower:
+        print('{} cases slower than the baseline'.format(len(slower)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Strong and weak scaling of the whole pipeline on a synthetic scene.
+
+Runs s2p on a generated scene for every combination of max_processes,
+max_processes_stereo_matching, tile_size and omp_num_threads, and reports the
+wall time, the speedup and parallel efficiency with respect to the smallest
+number of processes, and the time spent in each step (from the telemetry of
+the runs).
+
+With --weak, the scene area grows with the number of processes, so that the
+work per process stays constant.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.scaling --processes 1 2 4 8 --tile-sizes 300 500
+    python -m benchmarks.scaling --weak --processes 1 4 16 --scene-size 1024
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import subprocess
+import collections
+
+from s2p import report
+
+from benchmarks import scene
+
+
+def run_s2p(cfg, log):
+    """
+    Run s2p in a new process on a config, and return its wall time.
+    """
+    path = os.path.join(os.path.dirname(cfg['out_dir']), 'config.json')
+    with open(path, 'w') as f:
+        json.dump(cfg, f, indent=2)
+    start = time.time()
+    with open(log, 'w') as f:
+        subprocess.run([sys.executable, '-c', 'from s2p import cli; cli.main()', path],
+                       stdout=f, stderr=subprocess.STDOUT, check=True)
+    return time.time() - start
+
+
+def step_times(out_dir):
+    """
+    Return the wall time spanned by each step and its share of the total time
+    of the tasks, and the wall time spanned by all the tasks.
+    """
+    records = report.read_telemetry(out_dir)
+    by_step = collections.defaultdict(list)
+    for r in records:
+        by_step[r['step']].append(r)
+    total = sum(report.duration(r) for r in records) or 1
+    steps = {step: {'span': max(r['end'] for r in rs) - min(r['start'] for r in rs),
+                    'share': sum(report.duration(r) for r in rs) / total}
+             for step, rs in by_step.items()}
+    span = max(r['end'] for r in records) - min(r['start'] for r in records) if records else 0
+    return steps, span
+
+
+def add_speedups(runs, weak):
+    """
+    Add the speedup and efficiency of each run with respect to the run with
+    the fewest processes and the same other parameters.
+    """
+    groups = collections.defaultdict(list)
+    for r in runs:
+        groups[(r['stereo_processes'], r['tile_size'], r['omp_num_threads'])].append(r)
+    for rs in groups.values():
+        ref = min(rs, key=lambda r: r['processes'])
+        for r in rs:
+            if weak:
+                r['speedup'] = r['processes'] / ref['processes'] * ref['time'] / r['time']
+            else:
+                r['speedup'] = ref['processes'] * ref['time'] / r['time']
+            r['efficiency'] = r['speedup'] / r['processes']
+
+
+def print_runs(runs):
+    steps = []
+    for r in runs:
+        steps += [s for s in r['steps'] if s not in steps]
+    print('{:>5s} {:>6s} {:>5s} {:>4s} {:>6s} {:>9s} {:>8s} {:>6s} {:>8s}  {}'.format(
+        'proc', 'stereo', 'tile', 'omp', 'scene', 'time (s)', 'speedup', 'eff.',
+        'init (s)', 'step span in s (share of the task time)'))
+    for r in runs:
+        print('{:5d} {:>6} {:5d} {:4d} {:6d} {:9.1f} {:8.2f} {:6.2f} {:8.1f}  {}'.format(
+            r['processes'], r['stereo_processes'] or '-', r['tile_size'],
+            r['omp_num_threads'], r['scene_size'], r['time'], r['speedup'],
+            r['efficiency'], r['outside_tasks'],
+            ', '.join('{} {:.1f} ({:.0%})'.format(s, r['steps'][s]['span'],
+                                                  r['steps'][s]['share'])
+                      for s in steps if s in r['steps'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='s2p scaling benchmark')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='values of max_processes')
+    parser.add_argument('--stereo-processes', type=int, nargs='+', default=[0],
+                        help='values of max_processes_stereo_matching (0: as max_processes)')
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[500])
+    parser.add_argument('--omp-threads', type=int, nargs='+', default=[1],
+                        help='values of omp_num_threads')
+    parser.add_argument('--scene-size', type=int, default=2048,
+                        help=('width and height of the scene, or with --weak, '
+                              'of the scene of the smallest number of processes'))
+    parser.add_argument('--disp-range', type=int, default=64)
+    parser.add_argument('--weak', action='store_true',
+                        help='scale the scene area with the number of processes')
+    parser.add_argument('--config', default='{}',
+                        help='json dictionary of other s2p parameters')
+    parser.add_argument('--work-dir', default='benchmarks_work')
+    parser.add_argument('--output', help='json file where the results are written')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    runs = []
+    for p, sp, ts, omp in itertools.product(args.processes, args.stereo_processes,
+                                            args.tile_sizes, args.omp_threads):
+        size = args.scene_size
+        if args.weak:
+            size = int(round(size * (p / min(args.processes)) ** 0.5))
+        sc = scene.make_scene(os.path.join(work_dir, 'scenes', '{0}x{0}_disp_{1}'.format(
+            size, args.disp_range)), size, size, args.disp_range)
+
+        run_dir = os.path.join(work_dir, 'scaling', 'size_{}_proc_{}_stereo_{}_tile_{}_omp_{}'.format(
+            size, p, sp, ts, omp))
+        out_dir = os.path.join(run_dir, 'output')
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(run_dir, exist_ok=True)
+        cfg = scene.s2p_config(sc, out_dir, max_processes=p,
+                               max_processes_stereo_matching=sp or None,
+                               tile_size=ts, omp_num_threads=omp, telemetry=True)
+        cfg.update(json.loads(args.config))
+
+        print('{} processes, {} for stereo, tiles of {}, {} OpenMP threads, '
+              'scene of {}x{}'.format(p, sp or p, ts, omp, size, size), file=sys.stderr)
+        t = run_s2p(cfg, os.path.join(run_dir, 'log.txt'))
+        steps, span = step_times(out_dir)
+        # the time outside the tasks is mostly the initialization (tiles and
+        # masks), which is sequential
+        runs.append({'processes': p, 'stereo_processes': sp or None, 'tile_size': ts,
+                     'omp_num_threads': omp, 'scene_size': size, 'time': t,
+                     'outside_tasks': t - span, 'steps': steps})
+
+    add_speedups(runs, args.weak)
+    print_runs(runs)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'weak': args.weak, 'cpu_count': os.cpu_count(), 'runs': runs},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Synthetic stereo scenes: a known DSM seen by two affine cameras, written as
+GeoTIFF images with RPC tags.
+
+The cameras are exact affine RPC models (with their inverse), looking at a
+ground area centered on (LON0, LAT0). The parallax of the second camera is
+set so that the disparity range of the pair is the requested one. The images
+are rendered by casting a ray from each pixel through the DSM, so occlusions
+are handled, and the second image has a small pointing error.
+"""
+
+import os
+import json
+
+import numpy as np
+import rasterio
+import rpcm
+from scipy import ndimage
+
+LON0, LAT0 = 2.35, 48.85
+GSD = 0.5  # meters per pixel
+BASE_ALTITUDE = 100.0
+METERS_PER_DEGREE_LAT = 111320.0
+METERS_PER_DEGREE_LON = METERS_PER_DEGREE_LAT * float(np.cos(np.radians(LAT0)))
+
+# direction of the parallax in the images, in radians (0 means horizontal
+# epipolar lines)
+PARALLAX_DIRECTION = np.radians(10)
+
+# pointing error of the second image, in pixels
+POINTING_ERROR = (1.0, -0.8)
+
+
+def synthetic_dsm(width, height, relief, seed=0):
+    """
+    Return a DSM of smooth hills and blocky buildings, with heights in [0, relief].
+    """
+    rng = np.random.default_rng(seed)
+    hills = ndimage.gaussian_filter(rng.standard_normal((height, width)),
+                                    max(width, height) / 8, mode='wrap')
+    hills = (hills - hills.min()) / (np.ptp(hills) or 1)
+
+    buildings = np.zeros((height, width))
+    for _ in range(width * height // 4000):
+        w, h = rng.integers(8, 40, size=2)
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        buildings[y:y + h, x:x + w] = rng.uniform(0.2, 1)
+    buildings = ndimage.gaussian_filter(buildings, 1)
+
+    dsm = 0.6 * hills + 0.4 * buildings
+    return relief * (dsm - dsm.min()) / (np.ptp(dsm) or 1)
+
+
+def synthetic_texture(width, height, seed=0):
+    """
+    Return a multi-scale random texture with values in [0, 1].
+    """
+    rng = np.random.default_rng(seed + 1)
+    t = sum(w * ndimage.gaussian_filter(rng.standard_normal((height, width)), s)
+            for s, w in [(1, 1), (3, 2), (10, 4)])
+    return (t - t.min()) / (np.ptp(t) or 1)
+
+
+def affine_rpc(width, height, parallax, alt_offset, alt_scale):
+    """
+    Return the RPC tags of an affine camera.
+
+    Args:
+        width, height: image size
+        parallax: (px, py) displacement, in pixels per meter of altitude above
+            alt_offset, of the image of a ground point
+        alt_offset, alt_scale: altitude normalization of the model
+
+    Returns:
+        dictionary of RPC tags, as read by rpcm.RPCModel
+    """
+    lon_scale = width / 2 * GSD / METERS_PER_DEGREE_LON
+    lat_scale = height / 2 * GSD / METERS_PER_DEGREE_LAT
+    kx = parallax[0] * alt_scale / (width / 2)
+    ky = parallax[1] * alt_scale / (height / 2)
+
+    def coeffs(c1=0, c2=0, c3=0):
+        return ' '.join(str(c) for c in [0, c1, c2, c3] + [0] * 16)
+
+    one = ' '.join(str(c) for c in [1] + [0] * 19)
+
+    # in the RPC convention, the first three monomials are (lon, lat, alt)
+    # for the projection and (col, row, alt) for the localization
+    return {
+        'LINE_OFF': height / 2, 'SAMP_OFF': width / 2, 'LAT_OFF': LAT0,
+        'LONG_OFF': LON0, 'HEIGHT_OFF': alt_offset, 'LINE_SCALE': height / 2,
+        'SAMP_SCALE': width / 2, 'LAT_SCALE': lat_scale,
+        'LONG_SCALE': lon_scale, 'HEIGHT_SCALE': alt_scale,
+        'SAMP_NUM_COEFF': coeffs(1, 0, kx), 'SAMP_DEN_COEFF': one,
+        'LINE_NUM_COEFF': coeffs(0, -1, ky), 'LINE_DEN_COEFF': one,
+        'LON_NUM_COEFF': coeffs(1, 0, -kx), 'LON_DEN_COEFF': one,
+        'LAT_NUM_COEFF': coeffs(0, -1, ky), 'LAT_DEN_COEFF': one,
+    }
+
+
+def cast_rays(dsm, width, height, parallax, alt_offset, shift=(0, 0)):
+    """
+    Find the ground point seen by each pixel of an affine camera.
+
+    Args:
+        dsm: heights (above BASE_ALTITUDE) on a ground grid of step GSD, whose
+            center is seen at the center of the image, and which extends
+            beyond the image footprint
+        width, height, parallax, alt_offset: see affine_rpc
+        shift: displacement of the image, in pixels, with respect to its RPC
+
+    Returns:
+        east, north, altitude: arrays of shape (height, width), the east and
+            north coordinates being in meters from the center of the grid
+    """
+    cols, rows = np.meshgrid(np.arange(width) - shift[0] - width / 2,
+                             np.arange(height) - shift[1] - height / 2)
+    gh, gw = dsm.shape
+    z_max = BASE_ALTITUDE + dsm.max()
+    z_min = BASE_ALTITUDE + dsm.min()
+
+    # sample the ray from the highest altitude down, every half pixel
+    step = 0.5 / max(np.hypot(*parallax), 1e-6)
+    levels = np.arange(z_max, z_min - step, -step)
+
+    alt = np.full((height, width), z_min)
+    todo = np.ones((height, width), dtype=bool)
+    for level in levels:
+        c = cols[todo] - parallax[0] * (level - alt_offset)
+        r = rows[todo] - parallax[1] * (level - alt_offset)
+        z = BASE_ALTITUDE + ndimage.map_coordinates(dsm, [r + gh / 2, c + gw / 2],
+                                                    order=1, mode='nearest')
+        hit = z >= level
+        idx = np.flatnonzero(todo)[hit]
+        alt.flat[idx] = z[hit]
+        todo.flat[idx] = False
+        if not todo.any():
+            break
+
+    east = GSD * (cols - parallax[0] * (alt - alt_offset))
+    north = -GSD * (rows - parallax[1] * (alt - alt_offset))
+    return east, north, alt
+
+
+def make_scene(out_dir, width, height, disp_range, relief=30, seed=0):
+    """
+    Generate a synthetic stereo pair, or load it if it was already generated.
+
+    Args:
+        out_dir: directory where the files are written
+        width, height: size of the images
+        disp_range: disparity range of the pair, in pixels
+        relief: altitude range of the scene, in meters
+        seed: seed of the random DSM and texture
+
+    Returns:
+        dictionary with the paths of the images ('images'), of the ground
+        truth DSM ('dsm', in EPSG:4326) and of the ground coordinates (lon,
+        lat, alt) seen by the pixels of the first image ('ground', .npy), and
+        the altitude range of the scene ('alt_min', 'alt_max')
+    """
+    path = os.path.join(out_dir, 'scene.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # ground grid larger than the images, for the parallax
+    margin = int(disp_range) + 16
+    gw, gh = width + 2 * margin, height + 2 * margin
+    dsm = synthetic_dsm(gw, gh, relief, seed)
+    texture = synthetic_texture(gw, gh, seed)
+    alt_offset = BASE_ALTITUDE + relief / 2
+    alt_scale = relief / 2 + 10
+
+    # the disparity range is split between the two cameras
+    p = disp_range / max(relief, 1e-6) / 2
+    parallaxes = [(-p * np.cos(PARALLAX_DIRECTION), -p * np.sin(PARALLAX_DIRECTION)),
+                  (p * np.cos(PARALLAX_DIRECTION), p * np.sin(PARALLAX_DIRECTION))]
+    shifts = [(0, 0), POINTING_ERROR]
+
+    images = []
+    for k, (parallax, shift) in enumerate(zip(parallaxes, shifts)):
+        east, north, alt = cast_rays(dsm, width, height, parallax,
+                                     alt_offset, shift)
+        values = ndimage.map_coordinates(texture, [-north / GSD + gh / 2,
+                                                   east / GSD + gw / 2],
+                                         order=1, mode='nearest')
+        img = os.path.join(out_dir, 'img_{:02d}.tif'.format(k + 1))
+        with rasterio.open(img, 'w', driver='GTiff', width=width, height=height,
+                           count=1, dtype='uint16', tiled=True) as f:
+            f.write((200 + 3000 * values).astype(np.uint16), 1)
+            f.update_tags(ns='RPC', **affine_rpc(width, height, parallax,
+                                                 alt_offset, alt_scale))
+        images.append(img)
+        if k == 0:
+            ground = np.stack([LON0 + east / METERS_PER_DEGREE_LON,
+                               LAT0 + north / METERS_PER_DEGREE_LAT, alt])
+            np.save(os.path.join(out_dir, 'ground.npy'), ground)
+
+    dsm_path = os.path.join(out_dir, 'dsm.tif')
+    transform = rasterio.Affine(GSD / METERS_PER_DEGREE_LON, 0,
+                                LON0 - gw / 2 * GSD / METERS_PER_DEGREE_LON,
+                                0, -GSD / METERS_PER_DEGREE_LAT,
+                                LAT0 + gh / 2 * GSD / METERS_PER_DEGREE_LAT)
+    with rasterio.open(dsm_path, 'w', driver='GTiff', width=gw, height=gh,
+                       count=1, dtype='float32', crs='epsg:4326',
+                       transform=transform) as f:
+        f.write((BASE_ALTITUDE + dsm).astype(np.float32), 1)
+
+    scene = {'images': images, 'dsm': dsm_path,
+             'ground': os.path.join(out_dir, 'ground.npy'),
+             'width': width, 'height': height, 'disp_range': disp_range,
+             'alt_min': BASE_ALTITUDE, 'alt_max': BASE_ALTITUDE + relief}
+    with open(path, 'w') as f:
+        json.dump(scene, f, indent=2)
+    return scene
+
+
+def rpc_models(scene):
+    return [rpcm.rpc_from_geotiff(img) for img in scene['images']]
+
+
+def s2p_config(scene, out_dir, **params):
+    """
+    Return an s2p user config processing the whole scene, with the
+    disparity range given by the known altitude range.
+    """
+    cfg = {'out_dir': out_dir,
+           'images': [{'img': img} for img in scene['images']],
+           'roi': {'x': 0, 'y': 0, 'w': scene['width'], 'h': scene['height']},
+           'disp_range_method': 'fixed_altitude_range',
+           'alt_min': scene['alt_min'], 'alt_max': scene['alt_max'],
+           'dsm_resolution': GSD}
+    cfg.update(params)
+    return cfg
@@ -0,0 +1,314 @@
+"""
+Benchmarks of the s2p stages, each one run in isolation on a synthetic scene.
+
+A benchmark is a function called with the parameters of a case (tile size,
+disparity range, matching algorithm) and a work directory. It prepares the
+inputs of the stage (untimed) and returns the function to time.
+"""
+
+import os
+import sys
+import copy
+import subprocess
+
+import numpy as np
+import plyfile
+import rasterio
+
+import s2p
+from s2p import config
+from s2p import initialization
+from s2p import geographiclib
+from s2p import pointing_accuracy
+from s2p import rectification
+from s2p import block_matching
+from s2p import triangulation
+from s2p import fusion
+from s2p import ply
+from s2p import metadata
+from s2p.gpu_memory_manager import GPUMemoryManager
+from s2p.tile import Tile
+
+from benchmarks import scene
+
+# parameters of the cases of each benchmark, filled by the register decorator
+BENCHMARKS = {}
+
+# number of height maps merged by the fusion benchmark
+NB_HEIGHT_MAPS = 3
+
+# the DSM benchmarks process a grid of GRID x GRID tiles
+GRID = 3
+
+
+def register(*params):
+    """
+    Register a benchmark, depending on the given case parameters.
+    """
+    def decorator(fun):
+        BENCHMARKS[fun.__name__] = (fun, params)
+        return fun
+    return decorator
+
+
+def make_scene(work_dir, width, height, disp_range):
+    """
+    Generate a synthetic scene, shared by the benchmarks of a work directory.
+    """
+    d = os.path.join(work_dir, 'scenes', '{}x{}_disp_{}'.format(width, height, disp_range))
+    return scene.make_scene(d, width, height, disp_range)
+
+
+def make_cfg(sc, out_dir, **params):
+    """
+    Return a full s2p config for a scene, as built by s2p.main.
+    """
+    cfg = config.get_default_config()
+    initialization.build_cfg(cfg, scene.s2p_config(sc, out_dir, **params))
+    os.makedirs(out_dir, exist_ok=True)
+    return cfg
+
+
+def ground_xyz(sc, cfg, x=0, y=0, w=None, h=None):
+    """
+    Return the exact 3D points seen by a rectangle of the first image, in the
+    output CRS.
+    """
+    lon, lat, alt = np.load(sc['ground'])[:, y:y + (h or sc['height']), x:x + (w or sc['width'])]
+    e, n = geographiclib.pyproj_transform(lon, lat, 4326, geographiclib.pyproj_crs(cfg['out_crs']))
+    return np.dstack([e, n, alt])
+
+
+def rectify(sc, cfg, out_dir):
+    """
+    Rectify the scene, and return the rectified images and the homographies.
+    """
+    rpc1, rpc2 = [img['rpcm'] for img in cfg['images']]
+    out1 = os.path.join(out_dir, 'rectified_ref.tif')
+    out2 = os.path.join(out_dir, 'rectified_sec.tif')
+    H1, H2, disp_min, disp_max, _ = rectification.rectify_pair(
+        cfg, sc['images'][0], sc['images'][1], rpc1, rpc2, 0, 0, sc['width'],
+        sc['height'], out1, out2, hmargin=cfg['horizontal_margin'],
+        vmargin=cfg['vertical_margin'])
+    return out1, out2, H1, H2, disp_min, disp_max
+
+
+@register()
+def import_s2p(work_dir):
+    # in a new interpreter, as every worker and every s2p job does
+    return lambda: subprocess.run([sys.executable, '-c', 'import s2p'], check=True)
+
+
+@register('tile_size')
+def compute_correction(tile_size, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, 32)
+    cfg = make_cfg(sc, os.path.join(work_dir, 'compute_correction'))
+    rpc1, rpc2 = [img['rpcm'] for img in cfg['images']]
+
+    def run():
+        pointing_accuracy.compute_correction(cfg, sc['images'][0], sc['images'][1],
+                                             rpc1, rpc2, 0, 0, tile_size, tile_size,
+                                             'relative', cfg['sift_match_thresh'],
+                                             cfg['max_pointing_error'],
+                                             cfg['n_gcp_per_axis'])
+    return run
+
+
+@register('tile_size', 'disp_range')
+def rectify_pair(tile_size, disp_range, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, disp_range)
+    out_dir = os.path.join(work_dir, 'rectify_pair')
+    cfg = make_cfg(sc, out_dir)
+    return lambda: rectify(sc, cfg, out_dir)
+
+
+@register('tile_size', 'disp_range', 'algorithm')
+def compute_disparity_map(tile_size, disp_range, algorithm, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, disp_range)
+    out_dir = os.path.join(work_dir, 'compute_disparity_map')
+    cfg = make_cfg(sc, out_dir, matching_algorithm=algorithm)
+    rect1, rect2, _, _, disp_min, disp_max = rectify(sc, cfg, out_dir)
+
+    def run():
+        block_matching.compute_disparity_map(cfg, rect1, rect2,
+                                             os.path.join(out_dir, 'disp.tif'),
+                                             os.path.join(out_dir, 'mask.png'),
+                                             algorithm, disp_min, disp_max,
+                                             timeout=cfg['mgm_timeout'],
+                                             gpu_mem_manager=GPUMemoryManager.make_unbounded())
+    return run
+
+
+@register('tile_size', 'disp_range')
+def disp_to_xyz(tile_size, disp_range, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, disp_range)
+    out_dir = os.path.join(work_dir, 'disp_to_xyz')
+    cfg = make_cfg(sc, out_dir)
+    rect1, rect2, H1, H2, disp_min, disp_max = rectify(sc, cfg, out_dir)
+    disp, mask = os.path.join(out_dir, 'disp.tif'), os.path.join(out_dir, 'mask.png')
+    block_matching.compute_disparity_map(cfg, rect1, rect2, disp, mask,
+                                         cfg['matching_algorithm'], disp_min, disp_max,
+                                         gpu_mem_manager=GPUMemoryManager.make_unbounded())
+    with rasterio.open(disp) as f:
+        disp = f.read(1)
+    with rasterio.open(mask) as f:
+        mask = f.read(1)
+    rpc1, rpc2 = [img['rpcm'] for img in cfg['images']]
+    mask_orig = np.ones((tile_size, tile_size), dtype=np.uint8)
+    out_crs = geographiclib.pyproj_crs(cfg['out_crs'])
+
+    def run():
+        triangulation.disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask,
+                                  (0, tile_size, 0, tile_size), mask_orig,
+                                  out_crs=out_crs)
+    return run
+
+
+@register('tile_size')
+def filter_xyz(tile_size, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, 32)
+    cfg = make_cfg(sc, os.path.join(work_dir, 'filter_xyz'))
+    xyz = ground_xyz(sc, cfg)
+
+    # add outliers, and use the usual parameters of the 3D filtering
+    rng = np.random.default_rng(0)
+    outliers = rng.random(xyz.shape[:2]) < 0.02
+    xyz[outliers, 2] += rng.uniform(-50, 50, outliers.sum())
+    radius_gsd, fill_factor = 5, 1 / 3
+    r = radius_gsd * cfg['gsd']
+    n = int(fill_factor * 2 * 3.14 * radius_gsd**2)
+
+    def run():
+        triangulation.filter_xyz(xyz.copy(), r, n, cfg['gsd'])
+    return run
+
+
+def ply_inputs(tile_size, work_dir, name):
+    """
+    Return the path, points, colors, mask of the valid points and comments of
+    the point cloud of a tile, as written by heights_to_ply.
+    """
+    sc = make_scene(work_dir, tile_size, tile_size, 32)
+    out_dir = os.path.join(work_dir, name)
+    cfg = make_cfg(sc, out_dir)
+    xyz = ground_xyz(sc, cfg).reshape(-1, 3)
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (len(xyz), 3), dtype=np.uint8)
+    valid = rng.random(len(xyz)) > 0.1
+    comments = ['created by S2P', 'projection: CRS {}'.format(cfg['out_crs'])]
+    return os.path.join(out_dir, 'cloud.ply'), xyz, colors, valid, comments
+
+
+@register('tile_size')
+def write_ply(tile_size, work_dir):
+    path, xyz, colors, valid, comments = ply_inputs(tile_size, work_dir, 'write_ply')
+    return lambda: ply.write_3d_point_cloud_to_ply(path, xyz, colors=colors,
+                                                   comments=comments, mask=valid)
+
+
+@register('tile_size')
+def write_ply_plyfile(tile_size, work_dir):
+    """
+    Reference for write_ply: the same file written with plyfile.
+    """
+    path, xyz, colors, valid, comments = ply_inputs(tile_size, work_dir,
+                                                    'write_ply_plyfile')
+
+    def run():
+        arrays = list(xyz[valid].T) + list(colors[valid].T)
+        dtypes = [(k, xyz.dtype) for k in 'xyz'] + [(k, colors.dtype)
+                                                   for k in ['red', 'green', 'blue']]
+        data = np.rec.fromarrays(arrays, dtype=dtypes)
+        plyfile.PlyData([plyfile.PlyElement.describe(data, 'vertex')],
+                        comments=comments).write(path)
+    return run
+
+
+@register('tile_size')
+def ply_bounds(tile_size, work_dir):
+    """
+    Bounds of a point cloud computed from its memory-mapped columns, as
+    plys_to_dsm does for the clouds without recorded bounds.
+    """
+    path, xyz, colors, valid, comments = ply_inputs(tile_size, work_dir, 'ply_bounds')
+    ply.write_3d_point_cloud_to_ply(path, xyz, colors=colors, comments=comments, mask=valid)
+    return lambda: ply.bounds(ply.read_vertices(path)[0])
+
+
+@register('tile_size')
+def ply_bounds_plyfile(tile_size, work_dir):
+    """
+    Reference for ply_bounds: the whole cloud read with plyfile.
+    """
+    path, xyz, colors, valid, comments = ply_inputs(tile_size, work_dir,
+                                                    'ply_bounds_plyfile')
+    ply.write_3d_point_cloud_to_ply(path, xyz, colors=colors, comments=comments, mask=valid)
+
+    def run():
+        d = plyfile.PlyData.read(path)['vertex'].data
+        points = np.column_stack([d[name] for name in d.dtype.names])
+        return np.min(points, axis=0)[:2], np.max(points, axis=0)[:2]
+    return run
+
+
+@register('tile_size')
+def merge_n(tile_size, work_dir):
+    sc = make_scene(work_dir, tile_size, tile_size, 32)
+    out_dir = os.path.join(work_dir, 'merge_n')
+    cfg = make_cfg(sc, out_dir)
+    heights = np.load(sc['ground'])[2]
+
+    # noisy height maps with holes and offsets
+    rng = np.random.default_rng(0)
+    inputs = []
+    for k in range(NB_HEIGHT_MAPS):
+        h = heights + k + rng.normal(0, 0.5, heights.shape)
+        h[rng.random(h.shape) < 0.1] = np.nan
+        inputs.append(os.path.join(out_dir, 'height_map_{}.tif'.format(k)))
+        with rasterio.open(inputs[-1], 'w', driver='GTiff', width=tile_size,
+                           height=tile_size, count=1, dtype='float32') as f:
+            f.write(h.astype(np.float32), 1)
+    offsets = list(range(NB_HEIGHT_MAPS))
+
+    def run():
+        fusion.merge_n(os.path.join(out_dir, 'height_map.tif'), inputs, offsets,
+                       cfg['fusion_operator'], cfg['fusion_thresh'])
+    return run
+
+
+def dsm_tiles(tile_size, work_dir, name):
+    """
+    Write the point clouds of a grid of tiles, as s2p.main does, and return
+    the config and the tiles.
+    """
+    size = GRID * tile_size
+    sc = make_scene(work_dir, size, size, 32)
+    out_dir = os.path.join(work_dir, name)
+    cfg = make_cfg(sc, out_dir, tile_size=tile_size)
+    coords, neighborhood = initialization.compute_tiles_coordinates(0, 0, size, size,
+                                                                    tile_size, tile_size)
+    tiles = [initialization.create_tile(cfg, c, neighborhood) for c in coords]
+    for t in tiles:
+        os.makedirs(t.dir, exist_ok=True)
+        x, y, w, h = t.coordinates
+        bounds = triangulation.write_to_ply(os.path.join(t.dir, 'cloud.ply'),
+                                            ground_xyz(sc, cfg, x, y, w, h),
+                                            proj_com='CRS {}'.format(cfg['out_crs']))
+        metadata.save(cfg, os.path.join(t.dir, 'cloud_bounds.txt'), bounds)
+    return cfg, tiles
+
+
+@register('tile_size')
+def plys_to_dsm(tile_size, work_dir):
+    cfg, tiles = dsm_tiles(tile_size, work_dir, 'plys_to_dsm')
+
+    # the central tile, with all its neighbors
+    return lambda: s2p.plys_to_dsm(cfg, tiles[len(tiles) // 2])
+
+
+@register('tile_size')
+def global_dsm(tile_size, work_dir):
+    cfg, tiles = dsm_tiles(tile_size, work_dir, 'global_dsm')
+    for t in tiles:
+        s2p.plys_to_dsm(cfg, t)
+    return lambda: s2p.global_dsm(copy.deepcopy(cfg), tiles)
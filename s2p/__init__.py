@@ -20,23 +20,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import time
+import math
 import os.path
 import json
 import multiprocessing
 import tempfile
 import logging
+import collections
 from typing import List
 import subprocess
 
 import numpy as np
 import rasterio
-import rasterio.merge
-from plyflatten import plyflatten_from_plyfiles_list
 
 from s2p import common
 from s2p import parallel
+from s2p import profiling
 from s2p import geographiclib
 from s2p import initialization
+from s2p import intermediate
+from s2p import block_cache
+from s2p import catalog
+from s2p import manifest
+from s2p import metadata
 from s2p import pointing_accuracy
 from s2p import rectification
 from s2p import block_matching
@@ -79,11 +86,11 @@ def pointing_correction(cfg, tile: Tile, i) -> bool:
             cfg['n_gcp_per_axis']
         )
         if A is not None:  # A is the correction matrix
-            np.savetxt(os.path.join(out_dir, 'pointing.txt'), A, fmt='%6.3f')
+            metadata.save(cfg, os.path.join(out_dir, 'pointing.txt'), A, fmt='%6.3f')
         if m is not None:  # m is the list of sift matches
-            np.savetxt(os.path.join(out_dir, 'sift_matches.txt'), m, fmt='%9.3f')
-            np.savetxt(os.path.join(out_dir, 'center_keypts_sec.txt'),
-                       np.mean(m[:, 2:], 0), fmt='%9.3f')
+            metadata.save(cfg, os.path.join(out_dir, 'sift_matches.txt'), m, fmt='%9.3f')
+            metadata.save(cfg, os.path.join(out_dir, 'center_keypts_sec.txt'),
+                          np.mean(m[:, 2:], 0), fmt='%9.3f')
             if cfg['debug']:
                 visualisation.plot_matches(cfg, img1, img2, rpc1, rpc2, m,
                                            os.path.join(out_dir,
@@ -109,11 +116,11 @@ def global_pointing_correction(cfg, tiles: List[Tile]) -> None:
     for i in range(1, len(cfg['images'])):
         out = os.path.join(cfg['out_dir'], 'global_pointing_pair_%d.txt' % i)
         l = [os.path.join(t.dir, 'pair_%d' % i) for t in tiles]
-        np.savetxt(out, pointing_accuracy.global_from_local(l),
-                   fmt='%12.6f')
+        metadata.save(cfg, out, pointing_accuracy.global_from_local(cfg, l),
+                      fmt='%12.6f')
         if cfg['clean_intermediate']:
             for d in l:
-                common.remove(os.path.join(d, 'center_keypts_sec.txt'))
+                metadata.remove(cfg, os.path.join(d, 'center_keypts_sec.txt'))
 
 
 # evaluate the epipolar line between two images at a value of h
@@ -211,11 +218,11 @@ def rectification_pair(cfg, tile: Tile, i: int) -> bool:
 
     logger.info('rectifying tile {} {} pair {}...'.format(x, y, i))
     try:
-        A = np.loadtxt(os.path.join(out_dir, 'pointing.txt'))
+        A = metadata.load(cfg, os.path.join(out_dir, 'pointing.txt'))
     except IOError:
-        A = np.loadtxt(pointing)
+        A = metadata.load(cfg, pointing)
     try:
-        m = np.loadtxt(os.path.join(out_dir, 'sift_matches.txt'))
+        m = metadata.load(cfg, os.path.join(out_dir, 'sift_matches.txt'))
     except IOError:
         m = None
 
@@ -225,7 +232,7 @@ def rectification_pair(cfg, tile: Tile, i: int) -> bool:
         if os.path.exists(nei_dir) and not os.path.samefile(cur_dir, nei_dir):
             sift_from_neighborhood = os.path.join(nei_dir, 'sift_matches.txt')
             try:
-                m_n = np.loadtxt(sift_from_neighborhood)
+                m_n = metadata.load(cfg, sift_from_neighborhood)
                 # added sifts in the ellipse of semi axes : (3*w/4, 3*h/4)
     #            m_n = m_n[np.where(np.linalg.norm([(m_n[:, 0] - (x + w/2)) / w,
     #                                               (m_n[:, 1] - (y + h/2)) / h],
@@ -240,8 +247,8 @@ def rectification_pair(cfg, tile: Tile, i: int) -> bool:
     # remove sift matches that triangulate to points that are extreme
     m = refine_matches(rpc1, rpc2, m, A, cfg['max_altitude_span'], cfg['altitude_margin'])
 
-    rect1 = os.path.join(out_dir, 'rectified_ref.tif')
-    rect2 = os.path.join(out_dir, 'rectified_sec.tif')
+    rect1 = intermediate.path(cfg, os.path.join(out_dir, 'rectified_ref.tif'))
+    rect2 = intermediate.path(cfg, os.path.join(out_dir, 'rectified_sec.tif'))
     H1, H2, disp_min, disp_max, success = rectification.rectify_pair(cfg, img1, img2,
                                                                      rpc1, rpc2,
                                                                      x, y, w, h,
@@ -251,10 +258,10 @@ def rectification_pair(cfg, tile: Tile, i: int) -> bool:
                                                                      vmargin=cfg['vertical_margin'])
 
     if success:
-        np.savetxt(os.path.join(out_dir, 'H_ref.txt'), H1, fmt='%12.6f')
-        np.savetxt(os.path.join(out_dir, 'H_sec.txt'), H2, fmt='%12.6f')
-        np.savetxt(os.path.join(out_dir, 'disp_min_max.txt'), [disp_min, disp_max],
-                   fmt='%3.1f')
+        metadata.save(cfg, os.path.join(out_dir, 'H_ref.txt'), H1, fmt='%12.6f')
+        metadata.save(cfg, os.path.join(out_dir, 'H_sec.txt'), H2, fmt='%12.6f')
+        metadata.save(cfg, os.path.join(out_dir, 'disp_min_max.txt'), [disp_min, disp_max],
+                      fmt='%3.1f')
 
     return success
 
@@ -278,14 +285,14 @@ def disparity_range_check(cfg, tile: Tile, i: int):
     pointing = os.path.join(cfg['out_dir'],
                             'global_pointing_pair_{}.txt'.format(i))
 
-    disp_min, disp_max =  np.loadtxt(os.path.join(out_dir, 'disp_min_max.txt'))
+    disp_min, disp_max = metadata.load(cfg, os.path.join(out_dir, 'disp_min_max.txt'))
 
     try:
-        A = np.loadtxt(os.path.join(out_dir, 'pointing.txt'))
+        A = metadata.load(cfg, os.path.join(out_dir, 'pointing.txt'))
     except IOError:
-        A = np.loadtxt(pointing)
+        A = metadata.load(cfg, pointing)
     try:
-        m = np.loadtxt(os.path.join(out_dir, 'sift_matches.txt'))
+        m = metadata.load(cfg, os.path.join(out_dir, 'sift_matches.txt'))
     except IOError:
         m = None
 
@@ -309,24 +316,27 @@ def disparity_range_check(cfg, tile: Tile, i: int):
         return True
 
 
-def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager) -> None:
+def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager) -> bool:
     """
     Compute the disparity of a pair of images on a given tile.
 
     Args:
         tile: Tile containing the information needed to process a tile.
         i: index of the processed pair
+    Returns:
+        False if the block matching failed, True otherwise
     """
     out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
     x, y = tile.coordinates[:2]
 
     logger.info('estimating disparity on tile {} {} pair {}...'.format(x, y, i))
-    rect1 = os.path.join(out_dir, 'rectified_ref.tif')
-    rect2 = os.path.join(out_dir, 'rectified_sec.tif')
-    disp = os.path.join(out_dir, 'rectified_disp.tif')
-    mask = os.path.join(out_dir, 'rectified_mask.png')
-    disp_min, disp_max = np.loadtxt(os.path.join(out_dir, 'disp_min_max.txt'))
+    rect1 = intermediate.path(cfg, os.path.join(out_dir, 'rectified_ref.tif'))
+    rect2 = intermediate.path(cfg, os.path.join(out_dir, 'rectified_sec.tif'))
+    disp = intermediate.path(cfg, os.path.join(out_dir, 'rectified_disp.tif'))
+    mask = intermediate.path(cfg, os.path.join(out_dir, 'rectified_mask.png'))
+    disp_min, disp_max = metadata.load(cfg, os.path.join(out_dir, 'disp_min_max.txt'))
 
+    success = True
     try:
         # block_matching might fail (due to timeout)
         block_matching.compute_disparity_map(cfg, rect1, rect2, disp, mask,
@@ -341,12 +351,14 @@ def stereo_matching(cfg, tile: Tile, i: int, gpu_mem_manager: GPUMemoryManager)
         # in case of timeout we should take note
         # TODO: take note of the failed block matching
         logger.exception('block_matching.compute_disparity_map has failed:')
+        success = False
 
     if cfg['clean_intermediate']:
         if len(cfg['images']) > 2:
             common.remove(rect1)
         common.remove(rect2)
 #        common.remove(os.path.join(out_dir, 'disp_min_max.txt'))
+    return success
 
 
 def disparity_to_height(cfg, tile: Tile, i: int) -> None:
@@ -363,11 +375,11 @@ def disparity_to_height(cfg, tile: Tile, i: int) -> None:
     logger.info('triangulating tile {} {} pair {}...'.format(x, y, i))
     rpc1 = cfg['images'][0]['rpcm']
     rpc2 = cfg['images'][i]['rpcm']
-    H_ref = np.loadtxt(os.path.join(out_dir, 'H_ref.txt'))
-    H_sec = np.loadtxt(os.path.join(out_dir, 'H_sec.txt'))
-    disp = os.path.join(out_dir, 'rectified_disp.tif')
-    mask = os.path.join(out_dir, 'rectified_mask.png')
-    mask_orig = os.path.join(tile.dir, 'mask.tif')
+    H_ref = metadata.load(cfg, os.path.join(out_dir, 'H_ref.txt'))
+    H_sec = metadata.load(cfg, os.path.join(out_dir, 'H_sec.txt'))
+    disp = intermediate.path(cfg, os.path.join(out_dir, 'rectified_disp.tif'))
+    mask = intermediate.path(cfg, os.path.join(out_dir, 'rectified_mask.png'))
+    mask_orig = intermediate.path(cfg, os.path.join(tile.dir, 'mask.tif'))
     pointing = os.path.join(cfg['out_dir'],
                             'global_pointing_pair_{}.txt'.format(i))
 
@@ -380,19 +392,20 @@ def disparity_to_height(cfg, tile: Tile, i: int) -> None:
     height_map = triangulation.height_map(x, y, w, h, rpc1, rpc2, H_ref, H_sec,
                                           disp_img, mask_rect_img,
                                           mask_orig_img,
-                                          A=np.loadtxt(pointing))
+                                          A=metadata.load(cfg, pointing))
 
     # write height map to a file
-    common.rasterio_write(os.path.join(out_dir, 'height_map.tif'), height_map)
+    common.rasterio_write(intermediate.path(cfg, os.path.join(out_dir, 'height_map.tif')),
+                          height_map)
 
     if cfg['clean_intermediate']:
-        common.remove(H_ref)
-        common.remove(H_sec)
+        metadata.remove(cfg, os.path.join(out_dir, 'H_ref.txt'))
+        metadata.remove(cfg, os.path.join(out_dir, 'H_sec.txt'))
         common.remove(disp)
         common.remove(mask)
 
 
-def disparity_to_ply(cfg, tile: Tile) -> None:
+def disparity_to_ply(cfg, tile: Tile) -> bool:
     """
     Compute a point cloud from the disparity map of a pair of image tiles.
 
@@ -401,6 +414,8 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
 
     Args:
         tile: Tile containing the information needed to process a tile.
+    Returns:
+        False if the point cloud could not be written, True otherwise
     """
     out_dir = tile.dir
     ply_file = os.path.join(out_dir, 'cloud.ply')
@@ -412,12 +427,14 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
     H_ref = os.path.join(out_dir, 'pair_1', 'H_ref.txt')
     H_sec = os.path.join(out_dir, 'pair_1', 'H_sec.txt')
     pointing = os.path.join(cfg['out_dir'], 'global_pointing_pair_1.txt')
-    disp = os.path.join(out_dir, 'pair_1', 'rectified_disp.tif')
-    extra = os.path.join(out_dir, 'pair_1', 'rectified_disp_confidence.tif')
+    disp = intermediate.path(cfg, os.path.join(out_dir, 'pair_1', 'rectified_disp.tif'))
+    extra = intermediate.path(cfg, os.path.join(out_dir, 'pair_1',
+                                                'rectified_disp_confidence.tif'))
     if not os.path.exists(extra):    # confidence file not always generated
         extra = ''
-    mask_rect = os.path.join(out_dir, 'pair_1', 'rectified_mask.png')
-    mask_orig = os.path.join(out_dir, 'mask.tif')
+    mask_rect = intermediate.path(cfg, os.path.join(out_dir, 'pair_1', 'rectified_mask.png'))
+    mask_orig = intermediate.path(cfg, os.path.join(out_dir, 'mask.tif'))
+    rect_ref = intermediate.path(cfg, os.path.join(out_dir, 'pair_1', 'rectified_ref.tif'))
 
     # first check if disp exists for this tile
     if os.path.exists(disp) is False:
@@ -428,18 +445,18 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
     # prepare the image needed to colorize point cloud
     if cfg['images'][0]['clr']:
         # we want colors image and rectified_ref.tif to have the same size
-        with rasterio.open(os.path.join(out_dir, 'pair_1', 'rectified_ref.tif')) as f:
+        with rasterio.open(rect_ref) as f:
             ww, hh = f.width, f.height
 
         colors_path = tempfile.NamedTemporaryFile()
         common.image_apply_homography(colors_path.name, cfg['images'][0]['clr'],
-                                      np.loadtxt(H_ref), ww, hh)
+                                      metadata.load(cfg, H_ref), ww, hh)
         with rasterio.open(colors_path.name, "r") as f:
             colors = f.read()
         colors_path.close()
 
     else:
-        with rasterio.open(os.path.join(out_dir, 'pair_1', 'rectified_ref.tif')) as f:
+        with rasterio.open(rect_ref) as f:
             img = f.read()
         colors = common.linear_stretching_and_quantization_8bit(img)
 
@@ -453,11 +470,12 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
 
     out_crs = geographiclib.pyproj_crs(cfg['out_crs'])
     xyz_array, err = triangulation.disp_to_xyz(rpc1, rpc2,
-                                               np.loadtxt(H_ref), np.loadtxt(H_sec),
+                                               metadata.load(cfg, H_ref),
+                                               metadata.load(cfg, H_sec),
                                                disp_img, mask_rect_img,
                                                img_bbx=(x, x+w, y, y+h),
                                                mask_orig=mask_orig_img,
-                                               A=np.loadtxt(pointing),
+                                               A=metadata.load(cfg, pointing),
                                                out_crs=out_crs)
 
     # 3D filtering
@@ -475,19 +493,27 @@ def disparity_to_ply(cfg, tile: Tile) -> None:
         logger.warning("triangulation.filter_xyz with params {} has conserved only {} out of {}".format((r, n, cfg['gsd']), valid_out, valid_in))
 
     proj_com = "CRS {}".format(cfg['out_crs'])
+    bounds_file = os.path.join(out_dir, 'cloud_bounds.txt')
+    metadata.remove(cfg, bounds_file)
+    success = True
     try:
-        triangulation.write_to_ply(ply_file, xyz_array, colors, proj_com, confidence=extra)
+        bounds = triangulation.write_to_ply(ply_file, xyz_array, colors, proj_com,
+                                            confidence=extra)
+        metadata.save(cfg, bounds_file, bounds)
     except Exception:
         logger.error('triangulation.write_to_ply has failed: tile: {} {}'.format(*tile.coordinates[0:2]))
+        success = False
 
 
     if cfg['clean_intermediate']:
-        common.remove(H_ref)
-        common.remove(H_sec)
+        metadata.remove(cfg, H_ref)
+        metadata.remove(cfg, H_sec)
         common.remove(disp)
         common.remove(mask_rect)
         common.remove(mask_orig)
-        common.remove(os.path.join(out_dir, 'pair_1', 'rectified_ref.tif'))
+        common.remove(rect_ref)
+    intermediate.persist(cfg, tile.dir)
+    return success
 
 
 def mean_heights(cfg, tile: Tile) -> None:
@@ -496,8 +522,8 @@ def mean_heights(cfg, tile: Tile) -> None:
     maps = np.empty((h, w, n))
     for i in range(n):
         try:
-            with rasterio.open(os.path.join(tile.dir, 'pair_{}'.format(i + 1),
-                                            'height_map.tif'), 'r') as f:
+            with rasterio.open(intermediate.path(cfg, os.path.join(
+                    tile.dir, 'pair_{}'.format(i + 1), 'height_map.tif')), 'r') as f:
                 maps[:, :, i] = f.read(1)
         except RuntimeError:  # the file is not there
             maps[:, :, i] *= np.nan
@@ -506,18 +532,18 @@ def mean_heights(cfg, tile: Tile) -> None:
     validity_mask += 1 - validity_mask  # 1 on valid pixels, and nan on invalid
 
     # save the n mean height values to a txt file in the tile directory
-    np.savetxt(os.path.join(tile.dir, 'local_mean_heights.txt'),
-               [np.nanmean(validity_mask * maps[:, :, i]) for i in range(n)])
+    metadata.save(cfg, os.path.join(tile.dir, 'local_mean_heights.txt'),
+                  [np.nanmean(validity_mask * maps[:, :, i]) for i in range(n)])
 
 
 def global_mean_heights(cfg, tiles: List[Tile]) -> None:
-    local_mean_heights = [np.loadtxt(os.path.join(t.dir, 'local_mean_heights.txt'))
+    local_mean_heights = [metadata.load(cfg, os.path.join(t.dir, 'local_mean_heights.txt'))
                           for t in tiles]
     global_mean_heights = np.nanmean(local_mean_heights, axis=0)
     for i in range(len(cfg['images']) - 1):
-        np.savetxt(os.path.join(cfg['out_dir'],
-                                'global_mean_height_pair_{}.txt'.format(i+1)),
-                   [global_mean_heights[i]])
+        metadata.save(cfg, os.path.join(cfg['out_dir'],
+                                        'global_mean_height_pair_{}.txt'.format(i+1)),
+                      [global_mean_heights[i]])
 
 
 def heights_fusion(cfg, tile: Tile) -> None:
@@ -528,7 +554,8 @@ def heights_fusion(cfg, tile: Tile) -> None:
         tile: Tile that provides all you need to process a tile
     """
     tile_dir = tile.dir
-    height_maps = [os.path.join(tile_dir, 'pair_%d' % (i + 1), 'height_map.tif')
+    height_maps = [intermediate.path(cfg, os.path.join(tile_dir, 'pair_%d' % (i + 1),
+                                                       'height_map.tif'))
                    for i in range(len(cfg['images']) - 1)]
 
     # remove spurious matches
@@ -539,12 +566,12 @@ def heights_fusion(cfg, tile: Tile) -> None:
     # load global mean heights
     global_mean_heights = []
     for i in range(len(cfg['images']) - 1):
-        x = np.loadtxt(os.path.join(cfg['out_dir'],
-                                    'global_mean_height_pair_{}.txt'.format(i+1)))
+        x = metadata.load(cfg, os.path.join(cfg['out_dir'],
+                                            'global_mean_height_pair_{}.txt'.format(i+1)))
         global_mean_heights.append(x)
 
     # merge the height maps (applying mean offset to register)
-    fusion.merge_n(os.path.join(tile_dir, 'height_map.tif'), height_maps,
+    fusion.merge_n(intermediate.path(cfg, os.path.join(tile_dir, 'height_map.tif')), height_maps,
                    global_mean_heights, averaging=cfg['fusion_operator'],
                    threshold=cfg['fusion_thresh'], debug=cfg['debug'])
 
@@ -567,15 +594,12 @@ def heights_to_ply(cfg, tile: Tile) -> None:
     out_dir = tile.dir
     x, y, w, h = tile.coordinates
     plyfile = os.path.join(out_dir, 'cloud.ply')
-    height_map = os.path.join(out_dir, 'height_map.tif')
+    height_map = intermediate.path(cfg, os.path.join(out_dir, 'height_map.tif'))
 
     if cfg['images'][0]['clr']:
-        with rasterio.open(cfg['images'][0]['clr'], "r") as f:
-            colors = f.read(window=((y, y + h), (x, x + w)))
+        colors = block_cache.read_window(cfg['images'][0]['clr'], ((y, y + h), (x, x + w)))
     else:
-        with rasterio.open(cfg['images'][0]['img'], "r") as f:
-            colors = f.read(window=((y, y + h), (x, x + w)))
-
+        colors = block_cache.read_window(cfg['images'][0]['img'], ((y, y + h), (x, x + w)))
         colors = common.linear_stretching_and_quantization_8bit(colors)
 
     out_crs = geographiclib.pyproj_crs(cfg['out_crs'])
@@ -593,11 +617,15 @@ def heights_to_ply(cfg, tile: Tile) -> None:
 
 
     proj_com = "CRS {}".format(cfg['out_crs'])
-    triangulation.write_to_ply(plyfile, xyz_array, colors, proj_com)
+    bounds_file = os.path.join(out_dir, 'cloud_bounds.txt')
+    metadata.remove(cfg, bounds_file)
+    bounds = triangulation.write_to_ply(plyfile, xyz_array, colors, proj_com)
+    metadata.save(cfg, bounds_file, bounds)
 
     if cfg['clean_intermediate']:
         common.remove(height_map)
-        common.remove(os.path.join(out_dir, 'mask.tif'))
+        common.remove(intermediate.path(cfg, os.path.join(out_dir, 'mask.tif')))
+    intermediate.persist(cfg, tile.dir)
 
 
 def plys_to_dsm(cfg, tile: Tile) -> None:
@@ -622,16 +650,18 @@ def plys_to_dsm(cfg, tile: Tile) -> None:
         logger.error(f'missing input file: {in_ply}')
         return
 
-    # compute the point cloud x, y bounds
-    points, _ = ply.read_3d_point_cloud_from_ply(in_ply)
-    if len(points) == 0:
+    # point cloud x, y bounds, recorded by the triangulation (or computed from
+    # the memory-mapped x, y columns for the clouds of older runs)
+    try:
+        n, xmin, ymin, xmax, ymax = metadata.load(cfg, os.path.join(tile.dir,
+                                                                    'cloud_bounds.txt'))
+    except OSError:
+        n, xmin, ymin, xmax, ymax = ply.bounds(ply.read_vertices(in_ply)[0])
+    if n == 0:
         # TODO: take note of the missing part of the DSM
         logger.error(f'plys_to_dsm no points in file: {in_ply}')
         return
 
-    xmin, ymin, *_ = np.min(points, axis=0)
-    xmax, ymax, *_ = np.max(points, axis=0)
-
     # compute xoff, yoff, xsize, ysize on a grid of unit r
     xoff = np.floor(xmin / r) * r
     xsize = int(1 + np.floor((xmax - xoff) / r))
@@ -651,6 +681,7 @@ def plys_to_dsm(cfg, tile: Tile) -> None:
     # this option controls the type of aggregation
     # TODO: this interface is VERY VERY ugly AND FRAGILE and will be reworked within a new plyflatten
     use_max_aggregation = cfg['dsm_aggregation_with_max']
+    from plyflatten import plyflatten_from_plyfiles_list  # slow to import (numba)
     raster, profile = plyflatten_from_plyfiles_list(clouds,
                                                     resolution=r,
                                                     roi=roi,
@@ -716,6 +747,7 @@ def merge_tiles_rasterio(paths, bounds, res, dst_path, creation_options, method)
     Returns:
         None. The merged raster is written to `dst_path`.
     """
+    import rasterio.merge
 
     rasterio.merge.merge(paths,
                          bounds=bounds,
@@ -910,18 +942,220 @@ def global_dsm(cfg, tiles: List[Tile]) -> None:
     os.rmdir(save_folder)
 
 
-def main(user_cfg, start_from=0):
+def _pointing_fallback(cfg, tile: Tile, i: int, global_pointing: parallel.Task):
     """
-    Launch the s2p pipeline with the parameters given in a json file.
+    Return a function telling if rectification_pair has to wait for the global
+    pointing correction, ie if the local one is not available.
+    """
+    def late_after():
+        if metadata.exists(cfg, os.path.join(tile.dir, 'pair_{}'.format(i), 'pointing.txt')):
+            return []
+        return [global_pointing]
+    return late_after
+
+
+def _rectified_pair_info(cfg, tile: Tile, i: int):
+    """
+    Return the size of the rectified images and the disparity range of a pair,
+    or None if rectification_pair did not write them.
+    """
+    out_dir = os.path.join(tile.dir, 'pair_{}'.format(i))
+    try:
+        with rasterio.open(intermediate.path(cfg, os.path.join(out_dir, 'rectified_ref.tif'))) as f:
+            w, h = f.width, f.height
+        disp_min, disp_max = metadata.load(cfg, os.path.join(out_dir, 'disp_min_max.txt'))
+    except (OSError, ValueError):
+        return None
+    return w, h, disp_min, disp_max
+
+
+def _stereo_matching_cost(cfg, tile: Tile, i: int):
+    """
+    Return a function estimating the cost of stereo_matching on a tile, from
+    the size of the rectified images and the disparity range.
+    """
+    def cost():
+        info = _rectified_pair_info(cfg, tile, i)
+        if info is None:
+            return tile.coordinates[2] * tile.coordinates[3]
+        w, h, disp_min, disp_max = info
+        return w * h * (disp_max - disp_min + 1)
+    return cost
+
+
+def _stereo_matching_memory(cfg, tile: Tile, i: int):
+    """
+    Return a function estimating the host memory used by stereo_matching on a
+    tile, from the size of the rectified images and the disparity range.
+    """
+    def resources():
+        info = _rectified_pair_info(cfg, tile, i)
+        if info is None:
+            return {}
+        return {'memory': block_matching.estimate_memory(cfg['matching_algorithm'], *info)}
+    return resources
+
+
+def _global_mean_heights_on_processed_tiles(cfg, tiles: List[Tile], tasks: dict) -> None:
+    """
+    Run global_mean_heights on the tiles whose local mean heights were computed.
+    """
+    global_mean_heights(cfg, [t for t in tiles if tasks[t.dir].status == 'done'])
+
+
+def tasks_graph(cfg, tiles: List[Tile], gpu_mem_manager: GPUMemoryManager,
+                start_from: int = 0, global_dsm_in_worker: bool = False) -> List[parallel.Task]:
+    """
+    Build the graph of tasks of the s2p pipeline.
+
+    The tasks of the steps before start_from are assumed to be done already,
+    and so are the ones recorded in the manifests with the same key if
+    cfg['skip_unchanged_steps'] is set and their outputs still exist. The keys
+    of the other tasks are recorded in the manifests once they are done.
 
     Args:
-        user_cfg: user config dictionary
-        start_from: the step to start from (default: 0)
+        tiles: list of tiles
+        gpu_mem_manager: passed to stereo_matching
+        start_from: the step to start from
+        global_dsm_in_worker: run global_dsm in a worker, without timeout,
+            instead of the main process. For graphs shared by several jobs,
+            whose tasks must keep being dispatched meanwhile
+
+    Returns:
+        list of parallel.Task, in the order of the steps
     """
-    common.reset_elapsed_time()
+    n = len(cfg['images'])
+    tasks: List[parallel.Task] = []
+    keys = {}
+    manifests = {}
+    skip_unchanged = cfg['skip_unchanged_steps'] and not cfg['clean_intermediate']
+
+    def add(fun, args, number, step=None, also_reads=(), **kwargs) -> parallel.Task:
+        """
+        Add a task of the step number `number`. The key of the task depends on
+        the tasks it reads the outputs of: its deps, after and also_reads.
+        """
+        # several jobs may share a graph (s2p.batch): each task runs with its cfg
+        task = parallel.Task(fun, args, step=step or fun.__name__, cfg=cfg, **kwargs)
+        if len(args) > 1 and isinstance(args[1], Tile):
+            directory = args[1].dir
+            w, h = args[1].coordinates[2:]
+            if 'cost' not in kwargs:
+                # the cost of most steps grows with the tile area
+                task.cost = w * h
+            if 'resources' not in kwargs:
+                # a few float64 rasters of the size of the tile
+                task.resources = {'memory': 8 * 8 * w * h / 1024 / 1024}
+            name = task.step
+            if len(args) > 2 and isinstance(args[2], int):
+                name = 'pair_{}/{}'.format(args[2], task.step)
+        else:
+            directory = cfg['out_dir']
+            name = task.step
+        inputs = [keys[t] for t in task.deps + task.after + list(also_reads)]
+        key = keys[task] = manifest.step_key(cfg, task.step, name, inputs)
+        task.on_done = lambda: manifest.record_step(directory, name, key)
+
+        if directory not in manifests:
+            manifests[directory] = manifest.read_manifest(directory) if skip_unchanged else {}
+        if number < start_from or (manifests[directory].get(name) == key and
+                                   manifest.outputs_exist(cfg, directory, task.step, name)):
+            task.status = 'done'
+        tasks.append(task)
+        return task
+
+    # neighbors of each tile (plys_to_dsm and rectification_pair read their outputs)
+    by_dir = {os.path.normpath(t.dir): t for t in tiles}
+    neighbors = {}
+    for t in tiles:
+        dirs = [os.path.normpath(os.path.join(t.dir, d)) for d in t.neighborhood_dirs]
+        neighbors[t.dir] = [by_dir[d] for d in dirs if d in by_dir and by_dir[d] is not t]
+
+    # local-pointing step
+    pointing = {}
+    for i in range(1, n):
+        for t in tiles:
+            pointing[t.dir, i] = add(pointing_correction, (cfg, t, i), 1)
+
+    # global-pointing step
+    global_pointing = add(global_pointing_correction, (cfg, tiles), 2,
+                          deps=list(pointing.values()), require='none',
+                          barrier=True)
+
+    # rectification step
+    rectification = {}
+    for i in range(1, n):
+        for t in tiles:
+            rectification[t.dir, i] = add(
+                rectification_pair, (cfg, t, i), 3,
+                deps=[pointing[t.dir, i]],
+                after=[pointing[m.dir, i] for m in neighbors[t.dir]],
+                late_after=_pointing_fallback(cfg, t, i, global_pointing),
+                also_reads=[global_pointing],
+            )
+
+    # disparity range reasoning and matching steps
+    matching = {}
+    for i in range(1, n):
+        for t in tiles:
+            check = add(disparity_range_check, (cfg, t, i), 4,
+                        deps=[rectification[t.dir, i]])
+            matching[t.dir, i] = add(stereo_matching, (cfg, t, i, gpu_mem_manager), 4,
+                                     deps=[check], cost=_stereo_matching_cost(cfg, t, i),
+                                     resources=_stereo_matching_memory(cfg, t, i))
+
+    # triangulation step
+    triangulation = {}
+    if n > 2:
+        heights = {}
+        for i in range(1, n):
+            for t in tiles:
+                heights[t.dir, i] = add(disparity_to_height, (cfg, t, i), 5,
+                                        deps=[matching[t.dir, i]],
+                                        after=[global_pointing])
+        local_mean_heights = {}
+        for t in tiles:
+            local_mean_heights[t.dir] = add(mean_heights, (cfg, t), 5,
+                                            deps=[heights[t.dir, i] for i in range(1, n)],
+                                            require='any')
+        global_heights = add(_global_mean_heights_on_processed_tiles,
+                             (cfg, tiles, local_mean_heights), 5,
+                             step='global_mean_heights',
+                             deps=list(local_mean_heights.values()),
+                             require='none', barrier=True)
+        for t in tiles:
+            triangulation[t.dir] = add(heights_to_ply, (cfg, t), 5,
+                                       deps=[local_mean_heights[t.dir]],
+                                       after=[global_heights])
+    else:
+        for t in tiles:
+            triangulation[t.dir] = add(disparity_to_ply, (cfg, t), 5,
+                                       deps=[matching[t.dir, 1]],
+                                       after=[global_pointing])
 
-    # setup logger to stderr
-    # (loggers per tiles are set in parallel.py)
+    # local-dsm-rasterization step
+    dsms = []
+    for t in tiles:
+        dsms.append(add(plys_to_dsm, (cfg, t), 6,
+                        deps=[triangulation[t.dir]],
+                        after=[triangulation[m.dir] for m in neighbors[t.dir]]))
+
+    # global-dsm-rasterization step
+    if global_dsm_in_worker:
+        add(global_dsm, (cfg, tiles), 7, deps=dsms, require='none', tilewise=False,
+            timeout=math.inf)
+    else:
+        add(global_dsm, (cfg, tiles), 7, deps=dsms, require='none', barrier=True)
+
+    return tasks
+
+
+def setup_main_process() -> None:
+    """
+    Log to stderr (the loggers of the tiles are set in parallel.py), and
+    disable the multithreading of GDAL and OpenMP, as s2p already uses
+    process-based parallelism.
+    """
     root = logging.getLogger()
     root.setLevel(logging.INFO)
     f = logging.Formatter('%(message)s')
@@ -929,17 +1163,37 @@ def main(user_cfg, start_from=0):
     h.setFormatter(f)
     root.addHandler(h)
 
-    # s2p is already using (processed-based) parallelism when needed
     os.environ['GDAL_NUM_THREADS'] = "1"
     os.environ['OMP_NUM_THREADS'] = "1"
 
-    cfg = config.get_default_config()
-    initialization.build_cfg(cfg, user_cfg)
-    initialization.make_dirs(cfg)
 
-    # multiprocessing setup
-    nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()  # nb of available cores
+def make_gpu_mem_manager(cfg, nb_workers_stereo) -> GPUMemoryManager:
+    """
+    Return the GPU memory manager of a run, bounded by cfg['gpu_total_memory'].
+    """
+    if cfg["gpu_total_memory"] is not None:
+        gpu_total_memory = cfg["gpu_total_memory"]
+        if not isinstance(gpu_total_memory, list):
+            gpu_total_memory = [gpu_total_memory]
+        # keep some space for the CUDA contexts
+        gpu_total_memory = [m - nb_workers_stereo * 120 for m in gpu_total_memory]
+        return GPUMemoryManager.make_bounded(
+            max_memory_in_megabytes=gpu_total_memory,
+            mp_context=parallel.get_mp_context(),
+        )
+    return GPUMemoryManager.make_unbounded()
 
+
+def list_tiles(cfg, start_from=0) -> List[Tile]:
+    """
+    List the tiles of a job and compute their masks, or read them from the
+    catalog of the tiles (see s2p/catalog.py) when restarting from a later
+    step.
+
+    Returns:
+        list of tiles, empty if the ROI is not seen in two images or is
+        totally masked
+    """
     tw, th = initialization.adjust_tile_size(cfg)
     tiles_txt = os.path.join(cfg['out_dir'], 'tiles.txt')
     if start_from <= 1:
@@ -947,124 +1201,117 @@ def main(user_cfg, start_from=0):
     else: # skip mask creation if already done
         tiles = initialization.tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False)
     if not tiles:
-        logger.error('the ROI is not seen in two images or is totally masked.')
-        sys.exit(1)
+        return tiles
 
     if start_from > 0:
-        assert os.path.exists(tiles_txt), "start_from set to {} but tiles.txt is not found in '{}'. Make sure this is" \
-                                          " the output directory of a previous run.".format(start_from, cfg['out_dir'])
+        catalog_path = os.path.join(cfg['out_dir'], catalog.CATALOG_NAME)
+        assert os.path.exists(catalog_path) or os.path.exists(tiles_txt), \
+            "start_from set to {} but neither {} nor tiles.txt is found in '{}'. Make sure this is" \
+            " the output directory of a previous run.".format(start_from, catalog.CATALOG_NAME,
+                                                               cfg['out_dir'])
     else:
-        # initialisation: write the list of tilewise json files to outdir/tiles.txt
-        with open(tiles_txt, 'w') as f:
-            for t in tiles:
-                f.write(t.json)
-                f.write('\n')
+        # initialisation: write the list of tiles to outdir/tiles.txt, read by
+        # the scripts of the utils directory
+        initialization.write_tiles_txt(cfg, tiles, tiles_txt)
+    return tiles
 
-    n = len(cfg['images'])
-    tiles_pairs = [(cfg, t, i) for i in range(1, n) for t in tiles]
-    tiles_with_cfg = [(cfg, t) for t in tiles]
-    timeout = cfg['timeout']
 
-    # local-pointing step:
-    if start_from <= 1:
-        logger.info('1) correcting pointing locally...')
-        successes = parallel.launch_calls(cfg, pointing_correction, tiles_pairs, nb_workers,
-                              timeout=timeout)
-
-        # update the tiles removing the discarded tiles
-        tiles_pairs = [x for x, b in zip(tiles_pairs, successes) if b]
-
-    # global-pointing step:
-    if start_from <= 2:
-        logger.info('2) correcting pointing globally...')
-        global_pointing_correction(cfg, tiles)
-        common.print_elapsed_time()
-
-    # rectification step:
-    if start_from <= 3:
-        logger.info('3) rectifying tiles...')
-        successes = parallel.launch_calls(cfg, rectification_pair, tiles_pairs, nb_workers,
-                              timeout=timeout)
-
-        # update the tiles removing the discarded tiles
-        tiles_pairs = [x for x, b in zip(tiles_pairs, successes) if b]
-
-    # disparity range reasoning step: (WIP)
-    if start_from <= 4:
-        logger.info('4) reason about the disparity ranges... (WIP)')
-        # extra step checking the disparity range
-        # verity if the disparity range of a tile is not too different from its neighbors
-        tiles_usefulnesses = parallel.launch_calls(cfg, disparity_range_check, tiles_pairs, nb_workers,
-                              timeout=timeout)
-        # some feedback
-        for x, b in zip(tiles_pairs, tiles_usefulnesses):
-            if not b: logger.info('  removed tile: %s', x[1].dir)
-
-        # update the tiles removing the discarded tiles
-        tiles_pairs = [x for x, b in zip(tiles_pairs, tiles_usefulnesses) if b]
-
-
-    # matching step:
-    if start_from <= 4:
-        logger.info('4) running stereo matching...')
-        if cfg['max_processes_stereo_matching'] is not None:
-            nb_workers_stereo = cfg['max_processes_stereo_matching']
-        else:
-            nb_workers_stereo = nb_workers
-
-        if cfg["gpu_total_memory"] is not None:
-            gpu_total_memory = cfg["gpu_total_memory"]
-            # keep some space for the CUDA contexts
-            gpu_total_memory -= nb_workers_stereo * 120
-            gpu_mem_manager = GPUMemoryManager.make_bounded(
-                max_memory_in_megabytes=gpu_total_memory,
-                mp_context=parallel.get_mp_context(),
-            )
-        else:
-            gpu_mem_manager = GPUMemoryManager.make_unbounded()
-
-        parallel.launch_calls(cfg, stereo_matching, tiles_pairs,
-                              nb_workers_stereo,
-                              gpu_mem_manager,
-                              timeout=timeout)
-
-    ### UPDATE TILES_WITH_CFG FROM CURRENT TILES_PAIRS
-    tilesdict = dict( [(t.json,t) for _,t,_ in tiles_pairs] )
-    tiles_with_cfg = [(cfg,t) for t in tilesdict.values()]
-
-    if start_from <= 5:
-        if n > 2:
-            # disparity-to-height step:
-            logger.info('5a) computing height maps...')
-            parallel.launch_calls(cfg, disparity_to_height, tiles_pairs, nb_workers,
-                                  timeout=timeout)
-
-            logger.info('5b) computing local pairwise height offsets...')
-            parallel.launch_calls(cfg, mean_heights, tiles_with_cfg, nb_workers, timeout=timeout)
-
-            # global-mean-heights step:
-            logger.info('5c) computing global pairwise height offsets...')
-            global_mean_heights(cfg, tiles)
-
-            # heights-to-ply step:
-            logger.info('5d) merging height maps and computing point clouds...')
-            parallel.launch_calls(cfg, heights_to_ply, tiles_with_cfg, nb_workers,
-                                  timeout=timeout)
-        else:
-            # triangulation step:
-            logger.info('5) triangulating tiles...')
-            parallel.launch_calls(cfg, disparity_to_ply, tiles_with_cfg, nb_workers,
-                                  timeout=timeout)
-
-    # local-dsm-rasterization step:
-    if start_from <= 6:
-        logger.info('6) computing DSM by tile...')
-        parallel.launch_calls(cfg, plys_to_dsm, tiles_with_cfg, nb_workers, timeout=timeout)
-
-    # global-dsm-rasterization step:
-    if start_from <= 7:
-        logger.info('7) computing global DSM...')
-        global_dsm(cfg, tiles)
+def store_job_files(cfg, start_time: float) -> None:
+    """
+    Move the remaining intermediate files of a job to out_dir and merge its
+    profiles, once its graph of tasks has run.
+    """
+    intermediate.persist(cfg, cfg['out_dir'])
+
+    if cfg['profile']:
+        for path in profiling.merge_profiles(os.path.join(cfg['out_dir'], 'tiles'),
+                                             os.path.join(cfg['out_dir'], 'profile'),
+                                             since=start_time):
+            logger.info('profile written to {}'.format(path))
+
+
+def log_failed_tasks(cfg, tasks: List[parallel.Task]) -> None:
+    """
+    Log the number of tasks of a job that raised an error or timed out.
+    """
+    # tasks that failed after their retries were logged as they happened
+    statuses = collections.Counter(t.status for t in tasks)
+    if statuses['error'] or statuses['timeout']:
+        logger.error('{}: {} tasks raised an error and {} timed out'.format(
+            cfg['out_dir'], statuses['error'], statuses['timeout']))
+
+
+def finish_job(cfg, tasks: List[parallel.Task], start_time: float) -> None:
+    """
+    Merge the profiles of a job, move its remaining intermediate files to
+    out_dir and log its failed tasks, once its graph of tasks has run.
+    """
+    store_job_files(cfg, start_time)
+    log_failed_tasks(cfg, tasks)
+
+
+def log_gpu_stats(gpu_mem_manager: GPUMemoryManager) -> None:
+    gpu_stats = gpu_mem_manager.stats()
+    if gpu_stats.get("requests"):
+        logger.info('GPU memory: {:.0f} requests, waited {:.1f}s in total, '
+                    '{:.1f}s at most'.format(gpu_stats["requests"],
+                                            gpu_stats["total_wait"],
+                                            gpu_stats["max_wait"]))
+
+
+def main(user_cfg, start_from=0):
+    """
+    Launch the s2p pipeline with the parameters given in a json file.
+
+    Args:
+        user_cfg: user config dictionary
+        start_from: the step to start from (default: 0)
+    """
+    common.reset_elapsed_time()
+    start_time = time.time()
+    setup_main_process()
+
+    cfg = config.get_default_config()
+    initialization.build_cfg(cfg, user_cfg)
+    initialization.make_dirs(cfg)
+    block_cache.configure(cfg)
+
+    # multiprocessing setup
+    nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()  # nb of available cores
+
+    # matching step resources
+    if cfg['max_processes_stereo_matching'] is not None:
+        nb_workers_stereo = cfg['max_processes_stereo_matching']
+    else:
+        nb_workers_stereo = nb_workers
+
+    gpu_mem_manager = make_gpu_mem_manager(cfg, nb_workers_stereo)
+
+    # the same workers are used by all the steps. The config (with the RPC
+    # models) and the GPU memory manager are sent to each of them only once
+    queue_dir = cfg['queue_dir'] or os.path.join(cfg['out_dir'], 'queue')
+    with parallel.worker_pool(nb_workers, cfg, gpu_mem_manager,
+                              executor=cfg['executor'], queue_dir=queue_dir):
+        tiles = list_tiles(cfg, start_from)
+        if not tiles:
+            logger.error('the ROI is not seen in two images or is totally masked.')
+            sys.exit(1)
+
+        # each (tile, pair) flows through the tilewise steps as soon as its inputs
+        # are ready. Only the global steps wait for all the tiles
+        tasks = tasks_graph(cfg, tiles, gpu_mem_manager, start_from)
+        logger.info('running steps {} to 7 on {} tiles...'.format(max(start_from, 1),
+                                                                  len(tiles)))
+        parallel.launch_graph(cfg, tasks, nb_workers,
+                              max_tasks_per_step={'stereo_matching': nb_workers_stereo},
+                              timeout=cfg['timeout'], max_retries=cfg['max_retries'],
+                              retry_backoff=cfg['retry_backoff'], raise_errors=False,
+                              resources={'memory': cfg['max_memory']} if cfg['max_memory'] else None,
+                              telemetry=os.path.join(cfg['out_dir'], 'telemetry.jsonl') if cfg['telemetry'] else None)
+
+    finish_job(cfg, tasks, start_time)
+    log_gpu_stats(gpu_mem_manager)
+
     common.print_elapsed_time()
     common.print_elapsed_time(since_first_call=True)
 
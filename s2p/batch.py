@@ -0,0 +1,144 @@
+"""
+Batch processing: many s2p jobs run through a single pool of workers.
+
+The jobs are independent, each one with its own out_dir, but the tiles of all
+of them are scheduled in a single graph of tasks, and they share:
+
+- the RPC models of their images, read once per image and sent only once to
+  each worker,
+- the input images and the DEM, kept open by each worker for all the tiles
+  reading them (common.open_dataset), and the geoid model of the DEM lookups,
+- the SIFT keypoints of the tiles of their images, cached on disk
+  (cfg['keypoints_cache_dir']).
+
+The execution parameters (max_processes, timeout, retries, max_memory,
+executor) are those of the first job.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from typing import List
+
+import rpcm
+
+import s2p
+from s2p import common
+from s2p import block_cache
+from s2p import config
+from s2p import parallel
+from s2p import initialization
+
+logger = logging.getLogger(__name__)
+
+
+def read_rpcs(user_cfgs):
+    """
+    Read the RPC models of the images of several jobs, once per RPC file or
+    image, and store them in the user configs ('rpcm' key of the images).
+
+    Returns:
+        dictionary of the RPC models, indexed by the path they were read from
+    """
+    models = {}
+    for user_cfg in user_cfgs:
+        for img in user_cfg['images']:
+            if 'rpcm' in img or isinstance(img.get('rpc'), dict):
+                continue  # already read, or read by build_cfg
+            path = os.path.abspath(img.get('rpc', img['img']))
+            if path not in models:
+                if 'rpc' in img:
+                    models[path] = rpcm.rpc_from_rpc_file(path)
+                else:
+                    models[path] = rpcm.rpc_from_geotiff(path)
+            img['rpcm'] = models[path]
+    return models
+
+
+def main(user_cfgs: List[dict], start_from=0, nb_workers=None, nb_workers_stereo=None,
+         keypoints_cache_dir=None, telemetry=None) -> None:
+    """
+    Run several s2p jobs through a single pool of workers.
+
+    Args:
+        user_cfgs: list of user config dictionaries, with different out_dir
+        start_from: the step to start all the jobs from
+        nb_workers: number of worker processes. By default, max_processes of
+            the first job or the number of cores
+        nb_workers_stereo: maximal number of simultaneous stereo matching
+            tasks. By default, max_processes_stereo_matching of the first job
+        keypoints_cache_dir: directory where the keypoints are cached, for the
+            jobs without keypoints_cache_dir. By default, a temporary
+            directory removed at the end
+        telemetry: path to a JSONL file where the telemetry of the tasks of
+            all the jobs is written (see s2p.report)
+    """
+    common.reset_elapsed_time()
+    start_time = time.time()
+    s2p.setup_main_process()
+
+    out_dirs = [os.path.abspath(c['out_dir']) for c in user_cfgs]
+    if len(set(out_dirs)) < len(out_dirs):
+        raise ValueError('the jobs of a batch must have different out_dir')
+
+    tmp_cache = None
+    if keypoints_cache_dir is None:
+        keypoints_cache_dir = tmp_cache = tempfile.mkdtemp(prefix='s2p_keypoints_')
+
+    read_rpcs(user_cfgs)
+    cfgs = []
+    for user_cfg in user_cfgs:
+        cfg = config.get_default_config()
+        initialization.build_cfg(cfg, user_cfg)
+        if cfg['keypoints_cache_dir'] is None:
+            cfg['keypoints_cache_dir'] = keypoints_cache_dir
+        initialization.make_dirs(cfg)
+        cfgs.append(cfg)
+
+    first = cfgs[0]
+    block_cache.configure(first)
+    nb_workers = nb_workers or first['max_processes'] or multiprocessing.cpu_count()
+    nb_workers_stereo = (nb_workers_stereo or first['max_processes_stereo_matching']
+                         or nb_workers)
+    gpu_mem_manager = s2p.make_gpu_mem_manager(first, nb_workers_stereo)
+
+    # the configs (with the shared RPC models) and the GPU memory manager are
+    # sent to each worker only once
+    queue_dir = first['queue_dir'] or os.path.join(first['out_dir'], 'queue')
+    jobs = []
+    try:
+        with parallel.worker_pool(nb_workers, gpu_mem_manager, *cfgs,
+                                  executor=first['executor'], queue_dir=queue_dir):
+            for cfg in cfgs:
+                tiles = s2p.list_tiles(cfg, start_from)
+                if not tiles:
+                    logger.error('{}: the ROI is not seen in two images or is totally '
+                                 'masked.'.format(cfg['out_dir']))
+                    continue
+                # the global DSM of a job is computed by a worker, while the
+                # tasks of the other jobs keep being dispatched
+                jobs.append((cfg, s2p.tasks_graph(cfg, tiles, gpu_mem_manager, start_from,
+                                                  global_dsm_in_worker=True)))
+
+            tasks = [t for _, job_tasks in jobs for t in job_tasks]
+            logger.info('running steps {} to 7 on {} jobs...'.format(max(start_from, 1),
+                                                                      len(jobs)))
+            parallel.launch_graph(first, tasks, nb_workers,
+                                  max_tasks_per_step={'stereo_matching': nb_workers_stereo},
+                                  timeout=first['timeout'], max_retries=first['max_retries'],
+                                  retry_backoff=first['retry_backoff'], raise_errors=False,
+                                  resources={'memory': first['max_memory']} if first['max_memory'] else None,
+                                  telemetry=telemetry)
+    finally:
+        if tmp_cache is not None:
+            shutil.rmtree(tmp_cache, ignore_errors=True)
+
+    for cfg, job_tasks in jobs:
+        s2p.finish_job(cfg, job_tasks, start_time)
+    s2p.log_gpu_stats(gpu_mem_manager)
+
+    common.print_elapsed_time()
+    common.print_elapsed_time(since_first_call=True)
@@ -0,0 +1,231 @@
+"""
+Cache of the decoded blocks of the input rasters (images, DEM).
+
+read_window reads a window of a raster as the union of the blocks of a grid
+aligned with the internal tiles of the file, kept in a per-process LRU cache
+of cfg['block_cache_size'] MB. The neighboring tiles, and the successive
+steps on a tile (masks, sift keypoints, DEM lookups, colors of the point
+clouds) thus decode each block of a JPEG2000 or deflate-compressed image only
+once per worker. With cfg['block_cache_dir'] (e.g. a directory of /dev/shm),
+the decoded blocks are also shared by the workers, as .npy files, up to
+cfg['block_cache_dir_max_size'] MB.
+
+The cache is configured by environment variables, set from the config by
+configure in the main process and inherited by the workers it starts. Without
+them (e.g. in an s2p-worker process started by hand) the windows are read
+directly.
+"""
+
+import os
+import glob
+import hashlib
+import collections
+
+import numpy as np
+import rasterio
+
+from s2p import common
+
+SIZE_VAR = 'S2P_BLOCK_CACHE_SIZE'
+DIR_VAR = 'S2P_BLOCK_CACHE_DIR'
+DIR_MAX_SIZE_VAR = 'S2P_BLOCK_CACHE_DIR_MAX_SIZE'
+
+# bounds of the size of the blocks of the cache grid, in pixels. The native
+# blocks of the files are merged up to MIN_BLOCK_SIDE, and the grid of files
+# with larger blocks (e.g. strips of the whole image width) is made of
+# MAX_BLOCK_SIDE x MAX_BLOCK_SIDE blocks
+MIN_BLOCK_SIDE = 256
+MAX_BLOCK_SIDE = 1024
+
+
+class BlockCache:
+    """
+    LRU cache of arrays, bounded by their total size in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.blocks = collections.OrderedDict()
+
+    def get(self, key):
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+        return block
+
+    def put(self, key, block):
+        if key in self.blocks:
+            self.nbytes -= self.blocks.pop(key).nbytes
+        self.blocks[key] = block
+        self.nbytes += block.nbytes
+        while self.nbytes > self.max_bytes and self.blocks:
+            self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+
+
+# cache of the current process, created at its first read_window
+cache = None
+# bytes written to the shared directory since its last eviction
+written = 0
+
+
+def configure(cfg) -> None:
+    """
+    Set the cache parameters of the current process and of the workers it
+    starts from cfg['block_cache_size'], cfg['block_cache_dir'] and
+    cfg['block_cache_dir_max_size'].
+    """
+    global cache
+    os.environ[SIZE_VAR] = str(cfg['block_cache_size'] or 0)
+    os.environ[DIR_MAX_SIZE_VAR] = str(cfg['block_cache_dir_max_size'])
+    if cfg['block_cache_dir']:
+        os.environ[DIR_VAR] = os.path.abspath(os.path.expandvars(cfg['block_cache_dir']))
+    else:
+        os.environ.pop(DIR_VAR, None)
+    cache = None
+
+
+def get_cache():
+    """
+    Return the cache of the current process, or None if it is disabled.
+    """
+    global cache
+    max_bytes = float(os.environ.get(SIZE_VAR, 0)) * 1e6
+    if not max_bytes:
+        return None
+    if cache is None or cache.max_bytes != max_bytes:
+        cache = BlockCache(max_bytes)
+    return cache
+
+
+def grid_shape(dataset):
+    """
+    Return the (height, width) of the blocks of the cache grid of a raster.
+    """
+    bh, bw = dataset.block_shapes[0]
+    bh = min(bh, dataset.height)
+    bw = min(bw, dataset.width)
+    if max(bh, bw) > MAX_BLOCK_SIDE:
+        return MAX_BLOCK_SIDE, MAX_BLOCK_SIDE
+    return bh * -(-MIN_BLOCK_SIDE // bh), bw * -(-MIN_BLOCK_SIDE // bw)
+
+
+def shared_block_path(path, signature, bh, bw, i, j):
+    """
+    Return the path of a block of a raster in the shared directory, or None if
+    there is none. The name of the file depends on the signature (size and
+    modification time) of the raster, so that the blocks of a modified raster
+    are not reused.
+    """
+    directory = os.environ.get(DIR_VAR)
+    if not directory:
+        return None
+    key = '{}:{}'.format(os.path.abspath(path), signature)
+    name = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(directory, name, '{}x{}_{}_{}.npy'.format(bh, bw, i, j))
+
+
+def evict_shared_blocks(directory, max_bytes) -> None:
+    """
+    Remove the oldest blocks of the shared directory until it is below 80% of
+    its maximal size.
+    """
+    files = []
+    for f in glob.glob(os.path.join(directory, '*', '*.npy')):
+        try:
+            s = os.stat(f)
+        except OSError:  # removed meanwhile by another worker
+            continue
+        files.append((s.st_mtime, s.st_size, f))
+    total = sum(size for _, size, _ in files)
+    for _, size, f in sorted(files):
+        if total <= 0.8 * max_bytes:
+            break
+        common.remove(f)
+        total -= size
+
+
+def read_block(dataset, path, signature, bh, bw, i, j):
+    """
+    Return the block (i, j) of the cache grid of a raster, with all its bands.
+    The signature of the file (see common.file_signature) is part of the
+    keys, so that the blocks of a replaced raster are read again.
+    """
+    global written
+    blocks = get_cache()
+    key = (path, signature, bh, bw, i, j)
+    block = blocks.get(key)
+    if block is not None:
+        return block
+
+    shared = shared_block_path(path, signature, bh, bw, i, j)
+    if shared is not None and os.path.exists(shared):
+        try:
+            block = np.load(shared)
+        except (OSError, ValueError):  # removed or being replaced meanwhile
+            block = None
+
+    if block is None:
+        window = rasterio.windows.Window(j * bw, i * bh,
+                                         min(bw, dataset.width - j * bw),
+                                         min(bh, dataset.height - i * bh))
+        block = dataset.read(window=window)
+        if shared is not None:
+            os.makedirs(os.path.dirname(shared), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(shared, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, block)
+            os.replace(tmp, shared)
+            written += block.nbytes
+            max_bytes = float(os.environ.get(DIR_MAX_SIZE_VAR, 0)) * 1e6
+            if written > max_bytes / 8:
+                written = 0
+                evict_shared_blocks(os.environ[DIR_VAR], max_bytes)
+
+    blocks.put(key, block)
+    return block
+
+
+def read_window(path, window, indexes=None):
+    """
+    Read a window of a raster, through the cache of the decoded blocks.
+
+    Args:
+        path: path to the raster file
+        window: rasterio Window, or ((row_start, row_stop), (col_start,
+            col_stop)). It is clipped to the raster boundaries
+        indexes: band index or list of band indexes, as in
+            rasterio.DatasetReader.read. By default all the bands are read
+
+    Returns:
+        array of shape (bands, h, w), or (h, w) if indexes is an int
+    """
+    signature = common.file_signature(path)
+    dataset = common.open_dataset(path)
+    if not isinstance(window, rasterio.windows.Window):
+        window = rasterio.windows.Window.from_slices(*window, boundless=True)
+
+    # clip the window to the raster boundaries
+    c0 = max(int(window.col_off), 0)
+    r0 = max(int(window.row_off), 0)
+    c1 = max(min(int(window.col_off + window.width), dataset.width), c0)
+    r1 = max(min(int(window.row_off + window.height), dataset.height), r0)
+
+    if get_cache() is None or r1 == r0 or c1 == c0:
+        return dataset.read(indexes, window=rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0))
+
+    bh, bw = grid_shape(dataset)
+    out = np.empty((dataset.count, r1 - r0, c1 - c0), dtype=dataset.dtypes[0])
+    for i in range(r0 // bh, (r1 - 1) // bh + 1):
+        for j in range(c0 // bw, (c1 - 1) // bw + 1):
+            block = read_block(dataset, path, signature, bh, bw, i, j)
+            y0, x0 = i * bh, j * bw
+            ys, ye = max(r0, y0), min(r1, y0 + bh)
+            xs, xe = max(c0, x0), min(c1, x0 + bw)
+            out[:, ys - r0:ye - r0, xs - c0:xe - c0] = block[:, ys - y0:ye - y0,
+                                                             xs - x0:xe - x0]
+    if indexes is None:
+        return out
+    if isinstance(indexes, int):
+        return out[indexes - 1]
+    return out[[k - 1 for k in indexes]]
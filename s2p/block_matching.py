@@ -4,6 +4,7 @@
 # Copyright (C) 2015, Julien Michel <julien.michel@cnes.fr>
 
 import os
+import logging
 import tempfile
 import numpy as np
 import rasterio
@@ -11,7 +12,8 @@ from scipy import ndimage
 
 from s2p import common
 from s2p.gpu_memory_manager import GPUMemoryManager
-from s2p.specklefilter import specklefilter
+
+logger = logging.getLogger(__name__)
 
 
 class MaxDisparityRangeError(Exception):
@@ -81,6 +83,65 @@ def leftright(offL, offR, maxdiff=1):
 
 
 
+def estimate_memory(algo, width, height, disp_min, disp_max):
+    """
+    Rough estimation of the host memory used by compute_disparity_map.
+
+    Args:
+        algo: block-matching algorithm, see compute_disparity_map
+        width, height: size of the rectified images
+        disp_min, disp_max: disparity range
+
+    Returns:
+        memory in MB
+    """
+    pixels = width * height
+    disp_range = min(disp_max - disp_min, width) + 1
+    if algo in ['mgm', 'mgm_multi', 'sgbm', 'hirschmuller02', 'hirschmuller08',
+                'hirschmuller08_laplacian', 'hirschmuller08_cauchy']:
+        # float cost volume, and its aggregation
+        nbytes = 2 * 4 * pixels * disp_range
+    else:
+        # the cost volume is on the GPU, or not computed: a few float images
+        nbytes = 16 * 4 * pixels
+    return nbytes / 1024 / 1024
+
+
+# rough single-thread computation time of each algorithm, in nanoseconds per
+# pixel and disparity. These are orders of magnitude, used for estimating
+# the cost of a job before running it
+NANOSECONDS_PER_VOXEL = {
+    'mgm': 80,
+    'mgm_multi': 120,
+    'sgbm': 10,
+    'hirschmuller02': 60,
+    'hirschmuller08': 60,
+    'hirschmuller08_laplacian': 60,
+    'hirschmuller08_cauchy': 60,
+    'msmw': 200,
+    'tvl1': 30,
+    'stereosgm_gpu': 1,
+}
+
+
+def estimate_time(algo, width, height, disp_min, disp_max, nb_threads=1):
+    """
+    Rough estimation of the computation time of compute_disparity_map.
+
+    Args:
+        algo: block-matching algorithm, see compute_disparity_map
+        width, height: size of the rectified images
+        disp_min, disp_max: disparity range
+        nb_threads: number of OpenMP threads (cfg['omp_num_threads'])
+
+    Returns:
+        time in seconds
+    """
+    disp_range = min(disp_max - disp_min, width) + 1
+    ns = NANOSECONDS_PER_VOXEL.get(algo, max(NANOSECONDS_PER_VOXEL.values()))
+    return ns * 1e-9 * width * height * disp_range / max(nb_threads, 1)
+
+
 def compute_disparity_map(cfg, im1, im2, disp, mask, algo, disp_min=None,
                           disp_max=None, timeout=600, max_disp_range=None,
                           extra_params='',
@@ -213,6 +274,7 @@ def compute_disparity_map(cfg, im1, im2, disp, mask, algo, disp_min=None,
         regularity_multiplier = cfg['stereo_regularity_multiplier']
 
         from s2p import stereosgm_gpu
+        from s2p.specklefilter import specklefilter  # numba is slow to import
         i1 = common.rio_read_as_array_with_nans(im1)
         i2 = common.rio_read_as_array_with_nans(im2)
 
@@ -233,7 +295,14 @@ def compute_disparity_map(cfg, im1, im2, disp, mask, algo, disp_min=None,
         i2o = ndimage.zoom(np.nan_to_num(i2), .5, mode='reflect')
         dispmino = (disp_min + disp_max)//2 - 256
 
-        with gpu_mem_manager.request(vram_required):
+        with gpu_mem_manager.request(vram_required) as device:
+            # with a single device, keep the default one of the CUDA runtime
+            if device is not None and gpu_mem_manager.nb_devices() > 1:
+                try:
+                    stereosgm_gpu.set_device(device)
+                except (OSError, RuntimeError) as e:
+                    logger.warning('could not select the CUDA device %d, using the '
+                                   'default one: %s', device, e)
             resulto = stereosgm_gpu.run(i1o, i2o, nb_dir=nb_dir, disp_min=dispmino, P1=P1, P2=P2)
             # debug
             # common.rasterio_write(disp+'o.tif', resulto)
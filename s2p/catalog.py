@@ -0,0 +1,112 @@
+"""
+Catalog of the tiles of a job.
+
+A single file, out_dir/tiles.npz, holds the coordinates of all the tiles of
+the ROI (masked ones included), the indices of their neighbors and their
+status flags, as arrays. The neighbors are stored in compressed sparse row
+form: the neighbors of the tile k are neighbors[offsets[k]:offsets[k + 1]].
+
+The catalog is written at the initialization and read when restarting from a
+later step, instead of the json config of every tile. The per-tile json
+configs, and their list out_dir/tiles.txt, are still written for the scripts
+of the utils directory, unless cfg['tile_configs'] is False.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from s2p.tile import Tile, get_tile_dir
+
+CATALOG_NAME = 'tiles.npz'
+
+# status flags
+USEFUL = 1  # the tile is not masked, it is processed
+
+
+@dataclass
+class Catalog:
+    coordinates: np.ndarray  # (n, 4) array of the x, y, w, h of the tiles
+    offsets: np.ndarray  # (n + 1,) array
+    neighbors: np.ndarray  # indices of the neighbors of the tiles
+    flags: np.ndarray  # (n,) array of status flags
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def neighbors_of(self, k) -> np.ndarray:
+        """
+        Return the indices of the neighbors of the tile k.
+        """
+        return self.neighbors[self.offsets[k]:self.offsets[k + 1]]
+
+    def useful(self) -> np.ndarray:
+        """
+        Return the indices of the useful tiles.
+        """
+        return np.flatnonzero(self.flags & USEFUL)
+
+    def tiles(self, cfg) -> List[Tile]:
+        """
+        Return the useful tiles, their neighborhoods being restricted to the
+        useful tiles.
+        """
+        # python lists are faster than numpy for this per-tile bookkeeping
+        coords = [tuple(c) for c in self.coordinates.tolist()]
+        dirs = [get_tile_dir(*c) for c in coords]
+        neighborhood_dirs = [os.path.join('../../..', d) for d in dirs]
+        useful = (self.flags & USEFUL).astype(bool).tolist()
+        offsets = self.offsets.tolist()
+        neighbors = self.neighbors.tolist()
+        tiles = []
+        for k in self.useful().tolist():
+            n = neighbors[offsets[k]:offsets[k + 1]]
+            tiles.append(Tile(coordinates=coords[k],
+                              dir=os.path.join(cfg['out_dir'], dirs[k]),
+                              neighborhood_dirs=[neighborhood_dirs[j] for j in n if useful[j]],
+                              json=os.path.join(dirs[k], 'config.json')))
+        return tiles
+
+
+def from_tiles(tiles_coords, neighborhood_coords_dict, useful) -> Catalog:
+    """
+    Build the catalog of a list of tiles.
+
+    Args:
+        tiles_coords: list of the coordinates of all the tiles
+        neighborhood_coords_dict: neighborhoods of the tiles, see
+            initialization.compute_tiles_coordinates
+        useful: list of booleans telling which tiles are useful
+    """
+    index = {tuple(c): k for k, c in enumerate(tiles_coords)}
+    offsets = [0]
+    neighbors = []
+    for c in tiles_coords:
+        neighbors += [index[tuple(n)] for n in neighborhood_coords_dict.get(str(tuple(c)), [])]
+        offsets.append(len(neighbors))
+    return Catalog(coordinates=np.array(tiles_coords, dtype=np.int64).reshape(-1, 4),
+                   offsets=np.array(offsets, dtype=np.int64),
+                   neighbors=np.array(neighbors, dtype=np.int64),
+                   flags=np.where(useful, USEFUL, 0).astype(np.uint8))
+
+
+def write(path, catalog: Catalog) -> None:
+    """
+    Write a catalog, atomically.
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, coordinates=catalog.coordinates, offsets=catalog.offsets,
+                 neighbors=catalog.neighbors, flags=catalog.flags)
+    os.replace(tmp, path)
+
+
+def read(path) -> Catalog:
+    """
+    Read a catalog written by write.
+    """
+    with np.load(path) as f:
+        return Catalog(coordinates=f['coordinates'], offsets=f['offsets'],
+                       neighbors=f['neighbors'], flags=f['flags'])
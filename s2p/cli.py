@@ -1,8 +1,18 @@
 import os
+import json
 import shutil
 import argparse
+import multiprocessing
 
 import s2p
+from s2p import batch as s2p_batch
+from s2p import config
+from s2p import service as s2p_service
+from s2p import parallel
+from s2p import dry_run
+from s2p import ingest as s2p_ingest
+from s2p import report as s2p_report
+from s2p.gpu_memory_manager import GPUMemoryManager
 
 
 def main():
@@ -18,12 +28,178 @@ def main():
     parser.add_argument('--start_from', dest='start_from', type=int,
                         default=0, help="Restart the process from a given step in "
                                         "case of an interruption or to try different parameters.")
+    parser.add_argument('--estimate', action='store_true',
+                        help=('do not run the job, but estimate its computation '
+                              'time, memory and disk usage from the initialization '
+                              'and a sample of the tiles'))
+    parser.add_argument('--estimate_samples', type=int, default=8,
+                        help='number of tiles sampled by --estimate')
     args = parser.parse_args()
 
     user_cfg = s2p.read_config_file(args.config)
 
+    if args.estimate:
+        print(dry_run.format_estimate(dry_run.estimate(user_cfg, args.estimate_samples)))
+        return
+
     s2p.main(user_cfg, start_from=args.start_from)
 
     # Backup input file for sanity check
     if not args.config.startswith(os.path.abspath(user_cfg['out_dir'] + os.sep)):
         shutil.copy2(args.config,os.path.join(user_cfg['out_dir'], 'config.json.orig'))
+
+
+def batch():
+    """
+    Command line interface running several s2p jobs through a single pool of
+    workers.
+    """
+    parser = argparse.ArgumentParser(description=('S2P batch: run many s2p jobs '
+                                                  'through a single pool of workers, '
+                                                  'sharing the RPC models, open images '
+                                                  'and keypoints of their common images'),
+                                     fromfile_prefix_chars='@')
+    parser.add_argument('configs', metavar='config.json', nargs='+',
+                        help=('json files of the jobs, each one with its own '
+                              'out_dir. @file reads them from a file, one per line'))
+    parser.add_argument('--start_from', type=int, default=0,
+                        help='restart all the jobs from a given step')
+    parser.add_argument('--processes', type=int, default=None,
+                        help=('number of worker processes (default: max_processes '
+                              'of the first job, or the number of cores)'))
+    parser.add_argument('--stereo_processes', type=int, default=None,
+                        help=('maximal number of simultaneous stereo matching tasks '
+                              '(default: max_processes_stereo_matching of the first job)'))
+    parser.add_argument('--keypoints_cache_dir', default=None,
+                        help=('directory where the sift keypoints are cached, kept '
+                              'for the next batches (default: a temporary directory)'))
+    parser.add_argument('--telemetry', default=None,
+                        help='JSONL file where the telemetry of all the tasks is written')
+    args = parser.parse_args()
+
+    user_cfgs = [s2p.read_config_file(c) for c in args.configs]
+    s2p_batch.main(user_cfgs, start_from=args.start_from, nb_workers=args.processes,
+                   nb_workers_stereo=args.stereo_processes,
+                   keypoints_cache_dir=args.keypoints_cache_dir, telemetry=args.telemetry)
+
+    # Backup input files for sanity check
+    for path, user_cfg in zip(args.configs, user_cfgs):
+        if not path.startswith(os.path.abspath(user_cfg['out_dir'] + os.sep)):
+            shutil.copy2(path, os.path.join(user_cfg['out_dir'], 'config.json.orig'))
+
+
+def service():
+    """
+    Command line interface of the long-running s2p service.
+    """
+    parser = argparse.ArgumentParser(description=('S2P service: run the s2p jobs '
+                                                  'submitted over HTTP with a pool of '
+                                                  'workers kept alive between jobs'))
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address the HTTP API listens on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port of the HTTP API (default: %(default)s)')
+    parser.add_argument('--socket', default=None,
+                        help='path of a Unix socket the HTTP API listens on, instead of a port')
+    parser.add_argument('--config', default=None,
+                        help=('json file of execution parameters (max_processes, '
+                              'timeout, max_retries, max_memory, gpu_total_memory...) '
+                              'applied to all the jobs'))
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--stereo_processes', type=int, default=None,
+                        help='maximal number of simultaneous stereo matching tasks')
+    parser.add_argument('--telemetry', default=None,
+                        help='JSONL file where the telemetry of all the tasks is written')
+    args = parser.parse_args()
+
+    cfg = config.get_default_config()
+    if args.config is not None:
+        with open(args.config) as f:
+            cfg.update(json.load(f))
+    if args.processes is not None:
+        cfg['max_processes'] = args.processes
+    if args.stereo_processes is not None:
+        cfg['max_processes_stereo_matching'] = args.stereo_processes
+
+    address = args.socket if args.socket is not None else (args.host, args.port)
+    s2p_service.main(address, cfg, telemetry=args.telemetry)
+
+
+def ingest():
+    """
+    Command line interface converting the input images of s2p jobs to tiled
+    GeoTIFFs with overviews.
+    """
+    parser = argparse.ArgumentParser(description=('S2P ingest: convert the input '
+                                                  'images of s2p jobs to tiled GeoTIFFs '
+                                                  'with overviews, reused by the jobs '
+                                                  'with the same ingest_dir'),
+                                     fromfile_prefix_chars='@')
+    parser.add_argument('configs', metavar='config.json', nargs='+',
+                        help='json files of the jobs. @file reads them from a file, one per line')
+    parser.add_argument('--ingest_dir', default=None,
+                        help=('directory of the converted images (default: the '
+                              'ingest_dir of the jobs)'))
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of images converted in parallel (default: number of cores)')
+    args = parser.parse_args()
+
+    user_cfgs = [s2p.read_config_file(c) for c in args.configs]
+    ingest_dirs = set(args.ingest_dir or c.get('ingest_dir') for c in user_cfgs)
+    if None in ingest_dirs:
+        parser.error('--ingest_dir is required for the jobs without ingest_dir')
+    for ingest_dir in sorted(ingest_dirs):
+        images = [img for c in user_cfgs if (args.ingest_dir or c['ingest_dir']) == ingest_dir
+                  for img in c['images']]
+        for src, dst in s2p_ingest.ingest({'images': images}, ingest_dir,
+                                          args.processes).items():
+            print('{} -> {}'.format(src, dst))
+
+
+def worker():
+    """
+    Command line interface of the s2p workers of the 'file_queue' executor.
+    """
+    parser = argparse.ArgumentParser(description=('S2P worker: run the tasks '
+                                                  'of s2p instances using the '
+                                                  'file_queue executor'))
+    parser.add_argument('queue_dir',
+                        help=('queue directory, on a filesystem shared with the '
+                              'main s2p process (cfg["queue_dir"], by default '
+                              'out_dir/queue)'))
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of tasks run in parallel (default: number of cores)')
+    parser.add_argument('--gpu_total_memory', type=int, nargs='+', default=None,
+                        help=('GPU memory usable by the tasks of this worker, in '
+                              'MB, one value per GPU'))
+    parser.add_argument('--max_idle_time', type=float, default=None,
+                        help='stop after this time (in seconds) without any task to run')
+    args = parser.parse_args()
+
+    nb_workers = args.processes or multiprocessing.cpu_count()
+    if args.gpu_total_memory is not None:
+        gpu_mem_manager = GPUMemoryManager.make_bounded(
+            max_memory_in_megabytes=[m - nb_workers * 120 for m in args.gpu_total_memory],
+            mp_context=parallel.get_mp_context(),
+        )
+    else:
+        gpu_mem_manager = None
+    parallel.serve_file_queue(args.queue_dir, nb_workers, gpu_mem_manager,
+                              max_idle_time=args.max_idle_time)
+
+
+def report():
+    """
+    Command line interface summarizing the telemetry of an s2p run.
+    """
+    parser = argparse.ArgumentParser(description=('S2P report: summary of the '
+                                                  'telemetry of a run'))
+    parser.add_argument('telemetry',
+                        help=('telemetry.jsonl file, or output directory of a '
+                              'run with the "telemetry" option'))
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest tiles and tasks listed')
+    args = parser.parse_args()
+
+    print(s2p_report.summary(s2p_report.read_telemetry(args.telemetry), args.top))
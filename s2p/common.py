@@ -9,6 +9,7 @@ import sys
 import logging
 import datetime
 import warnings
+import functools
 import subprocess
 import numpy as np
 import rasterio
@@ -89,6 +90,43 @@ def rio_read_as_array_with_nans(im):
     return array.squeeze()
 
 
+def file_signature(path):
+    """
+    Return the size and modification time (in ns) of a file, or None if it
+    can't be stat'ed (e.g. a GDAL virtual file system path).
+    """
+    try:
+        s = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return s.st_size, s.st_mtime_ns
+
+
+def open_dataset(path):
+    """
+    Open an input raster (image, DEM) for reading, and keep it open for the
+    next calls made by the same process.
+
+    The header of the file is thus parsed only once per worker, whatever the
+    number of tiles (and, with s2p-batch, of jobs) reading it. The datasets
+    are cached with the size and modification time of their file, so that a
+    replaced file is opened again. The dataset must not be closed by the
+    caller.
+
+    Args:
+        path: path to the raster file
+
+    Returns:
+        rasterio dataset
+    """
+    return _open_dataset(path, file_signature(path))
+
+
+@functools.lru_cache(maxsize=32)
+def _open_dataset(path, signature):
+    return rasterio.open(path, 'r')
+
+
 def rasterio_write(path, array, profile={}, tags={}):
     """
     Write a numpy array in a tiff or png file with rasterio.
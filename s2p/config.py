@@ -25,6 +25,39 @@ def get_default_config() -> dict:
     # remove all generated files except from ply point clouds and tif raster dsm
     cfg['clean_intermediate'] = False
 
+    # directory of a RAM-backed filesystem (e.g. /dev/shm) where the
+    # intermediate rasters of the tiles (rectified images, disparity maps,
+    # height maps and masks) are written instead of out_dir, up to
+    # intermediate_dir_max_size MB. They are moved to out_dir once the point
+    # cloud of their tile is computed. See s2p/intermediate.py
+    cfg['intermediate_dir'] = None
+    cfg['intermediate_dir_max_size'] = 4000
+
+    # store the small arrays of the tiles (pointing corrections, sift matches,
+    # homographies, disparity ranges...) in the SQLite database
+    # out_dir/metadata.sqlite instead of one text file each. See s2p/metadata.py
+    cfg['metadata_db'] = False
+
+    # size in MB of the cache of the decoded blocks of the input images and
+    # DEM, per worker (0 to disable it), and directory of a RAM-backed
+    # filesystem (e.g. /dev/shm) where the decoded blocks are shared by the
+    # workers, up to block_cache_dir_max_size MB. See s2p/block_cache.py
+    cfg['block_cache_size'] = 128
+    cfg['block_cache_dir'] = None
+    cfg['block_cache_dir_max_size'] = 4000
+
+    # directory where the input images (img and clr) are converted to tiled
+    # GeoTIFFs with overviews, and reused by the next jobs on the same images.
+    # The paths of the images are replaced by those of their converted
+    # versions. See s2p/ingest.py
+    cfg['ingest_dir'] = None
+
+    # write the json configuration of each tile in its directory, and their
+    # list in out_dir/tiles.txt, read by the scripts of the utils directory.
+    # s2p itself only reads the catalog of the tiles, out_dir/tiles.npz. See
+    # s2p/catalog.py
+    cfg['tile_configs'] = True
+
     # switch to True if you want to process the whole image
     cfg['full_img'] = False
 
@@ -32,6 +65,12 @@ def get_default_config() -> dict:
     # reference image. The width and height of the tiles are given by this param, in pixels.
     cfg['tile_size'] = 800
 
+    # adapt the size of the tiles to the relief given by the exogenous dem (or
+    # SRTM): the tiles are split in high relief areas and merged in flat areas
+    # (from tile_size / 4 to 4 * tile_size), so that their stereo matching
+    # costs are balanced
+    cfg['adaptive_tiling'] = False
+
     # margins used to increase the footprint of the rectified tiles, to
     # account for poor disparity estimation close to the borders
     cfg['horizontal_margin'] = 50  # for regularity and occlusions
@@ -40,6 +79,15 @@ def get_default_config() -> dict:
     # max number of processes launched in parallel. None means the number of available cores
     cfg['max_processes'] = None
 
+    # how the tilewise functions are run: 'local' (pool of processes on this
+    # machine), 'serial' (in the main process) or 'file_queue' (by s2p-worker
+    # processes, possibly on other machines, watching the directory
+    # 'queue_dir' of a shared filesystem. max_processes should then be the
+    # total number of processes of these workers)
+    cfg['executor'] = 'local'
+    # directory of the file queue. None means out_dir/queue
+    cfg['queue_dir'] = None
+
     # max number of processes launched in parallel for stereo_matching
     # Uses the value of cfg['max_processes'] if None
     #   If the GPU has little VRAM, reduce this value so that CUDA contexts (per cpu)
@@ -51,15 +99,49 @@ def get_default_config() -> dict:
     # There is no mechanism to restrict s2p to this quantity, but the code will use this value
     # to schedule a reasonnable number of jobs on the GPU in parallel.
     # It should be set if 'max_processes_stereo_matching' is not set.
+    # With several GPUs, a list of the memories of each of them: the jobs are
+    # sent to the least loaded GPU having enough free memory.
     cfg['gpu_total_memory'] = None
 
+    # total host memory (RAM) allowed for the tasks of this instance of s2p, in
+    # MB. The tasks are started only when their estimated memory fits (the
+    # memory of the worker processes themselves is not counted). None means
+    # no limit, and only max_processes limits the number of tasks
+    cfg['max_memory'] = None
+
+    # write a record for each task (tile, pair, step, start and end times, CPU
+    # time, peak memory, bytes written...) to out_dir/telemetry.jsonl. Use the
+    # s2p-report command to summarize it
+    cfg['telemetry'] = False
+
+    # sample the stacks of the tilewise tasks, and write them to
+    # out_dir/profile/<step>.collapsed, in the format of flamegraph.pl. If
+    # profile_steps is a list of steps (e.g. ["heights_to_ply"]), only these
+    # steps are profiled
+    cfg['profile'] = False
+    cfg['profile_steps'] = None
+
     # max number of OMP threads used by programs compiled with openMP
     cfg['omp_num_threads'] = 1
 
-    # timeout in seconds, after which a function that runs on a single tile is not
-    # waited for
+    # timeout in seconds, after which a function that runs on a single tile is
+    # killed (with the processes it launched). The time is counted from the
+    # start of the function
     cfg['timeout'] = 600
 
+    # number of times a function that runs on a single tile is retried after a
+    # timeout or an error, and delay in seconds before the first retry (doubled
+    # at each retry). Either a number, or a dictionary with per-step values,
+    # e.g. {"stereo_matching": 2, "default": 0}
+    cfg['max_retries'] = 0
+    cfg['retry_backoff'] = 10
+
+    # skip the steps whose inputs and parameters did not change since the
+    # previous run in the same output directory (see s2p/manifest.py). The
+    # steps are recorded in the manifest.json files of the tiles directories.
+    # Needs clean_intermediate to be False
+    cfg['skip_unchanged_steps'] = False
+
     # debug mode (more verbose logs and intermediate results saved)
     cfg['debug'] = False
 
@@ -93,6 +175,18 @@ def get_default_config() -> dict:
     # else (absolute) a reasonable value is between 200 and 300 (128-vectors SIFT descriptors)
     cfg['sift_match_thresh'] = 0.6
 
+    # directory where the sift keypoints of the image tiles are cached, to be
+    # reused by the other pairs, restarts and jobs (see s2p-batch) matching
+    # the same tiles. None disables the cache
+    cfg['keypoints_cache_dir'] = None
+
+    # resolution reduction factor (e.g. 4) of the images on which the sift
+    # matches of the pointing correction and of the disparity range are
+    # searched, read from the overviews of the images if they have some (see
+    # ingest_dir). The sift disparity range is widened by this number of
+    # pixels. 1 for the full resolution
+    cfg['sift_overview_factor'] = 1
+
     # disp range expansion facto
     cfg['disp_range_extra_margin'] = 0.2
 
@@ -0,0 +1,198 @@
+"""
+Estimation of the cost of an s2p job before running it.
+
+The initialization (list of the tiles and masks) is run on the whole ROI, and
+the pointing correction and rectification on a sample of the tiles, in a
+temporary directory. The stereo matching time is extrapolated from the size
+of the rectified tiles and their disparity range with the cost models of
+block_matching, and the other steps from the tile areas. The input images are
+not ingested (see s2p.ingest): they are read as they are, which may
+overestimate the time of the steps reading them.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import s2p
+from s2p import config
+from s2p import parallel
+from s2p import initialization
+from s2p import intermediate
+from s2p import metadata
+from s2p import block_matching
+
+logger = logging.getLogger(__name__)
+
+# rough single-thread computation time of the tilewise steps that follow the
+# stereo matching, in seconds per megapixel of tile and per pair
+SECONDS_PER_MEGAPIXEL = {
+    'triangulation': 1.5,
+    'heights_to_ply': 1.0,
+    'plys_to_dsm': 1.0,
+}
+
+# size, in bytes per pixel, of the intermediate files: rectified images,
+# disparity and mask (per rectified pixel), height map (per tile pixel and
+# pair), point cloud (float64 coordinates and 8-bit colors, per tile pixel)
+RECTIFIED_BYTES_PER_PIXEL = 2 * 4 + 4 + 1
+HEIGHT_MAP_BYTES_PER_PIXEL = 4
+PLY_BYTES_PER_PIXEL = 3 * 8 + 3
+
+
+def sample(items, n):
+    """
+    Return n items evenly spread in a list.
+    """
+    if len(items) <= n:
+        return list(items)
+    return [items[int(k)] for k in np.linspace(0, len(items) - 1, n)]
+
+
+def estimate(user_cfg, nb_samples=8):
+    """
+    Estimate the computation time, memory and disk usage of an s2p job.
+
+    Args:
+        user_cfg: user config dictionary
+        nb_samples: number of tiles on which the pointing correction and the
+            rectification are run
+
+    Returns:
+        dictionary of estimates
+    """
+    # a dry run doesn't convert the input images
+    cfg = config.get_default_config()
+    initialization.build_cfg(cfg, dict(user_cfg, ingest_dir=None))
+
+    # nothing is written in the output directory
+    tmp_dir = tempfile.mkdtemp(prefix='s2p_estimate_')
+    cfg['out_dir'] = tmp_dir
+    try:
+        initialization.make_dirs(cfg)
+        nb_workers = cfg['max_processes'] or multiprocessing.cpu_count()
+        nb_workers_stereo = cfg['max_processes_stereo_matching'] or nb_workers
+        nb_pairs = len(cfg['images']) - 1
+
+        start = time.time()
+        tw, th = initialization.adjust_tile_size(cfg)
+        tiles = initialization.tiles_full_info(cfg, tw, th, os.path.join(tmp_dir, 'tiles.txt'),
+                                               create_masks=True)
+        init_time = time.time() - start
+
+        # pointing correction and rectification on the sampled tiles, with the
+        # local corrections only
+        for i in range(1, nb_pairs + 1):
+            metadata.save(cfg, os.path.join(tmp_dir, 'global_pointing_pair_{}.txt'.format(i)),
+                          np.eye(3))
+        sampled = sample(tiles, nb_samples)
+        samples = []
+        for t in sampled:
+            for i in range(1, nb_pairs + 1):
+                _, pointing = parallel.measure_call(s2p.pointing_correction, cfg, t, i)
+                _, rectification = parallel.measure_call(s2p.rectification_pair, cfg, t, i)
+                info = s2p._rectified_pair_info(cfg, t, i)
+                if info is None:
+                    logger.warning('rectification failed on tile %s pair %d', t.dir, i)
+                    continue
+                samples.append({'tile': t, 'info': info,
+                                'pointing': pointing, 'rectification': rectification})
+    finally:
+        intermediate.persist(cfg, tmp_dir)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if not samples:
+        raise RuntimeError('the rectification failed on all the sampled tiles')
+
+    # extrapolation from the samples to all the tiles and pairs
+    nb_pairs_total = len(tiles) * nb_pairs
+    scale = nb_pairs_total / len(samples)
+    algo = cfg['matching_algorithm']
+
+    def duration(m):
+        return m['end'] - m['start']
+
+    pointing_time = scale * sum(duration(s['pointing']) for s in samples)
+    rectification_time = scale * sum(duration(s['rectification']) for s in samples)
+    matching_times = [block_matching.estimate_time(algo, *s['info'], cfg['omp_num_threads'])
+                      for s in samples]
+    matching_time = scale * sum(matching_times)
+    tiles_megapixels = sum(t.coordinates[2] * t.coordinates[3] for t in tiles) / 1e6
+    other_time = tiles_megapixels * (nb_pairs * SECONDS_PER_MEGAPIXEL['triangulation']
+                                     + SECONDS_PER_MEGAPIXEL['heights_to_ply']
+                                     + SECONDS_PER_MEGAPIXEL['plys_to_dsm'])
+
+    # the steps run in parallel, the stereo matching on fewer workers
+    wall_time = (init_time
+                 + max((pointing_time + rectification_time + other_time) / nb_workers,
+                       max(duration(s['pointing']) + duration(s['rectification'])
+                           for s in samples))
+                 + max(matching_time / min(nb_workers, nb_workers_stereo),
+                       max(matching_times)))
+
+    # memory of a worker: the largest of the sampled steps and of the matching
+    memory = max(max(s['pointing']['peak_rss_mb'], s['rectification']['peak_rss_mb'])
+                 for s in samples)
+    matching_memory = max(block_matching.estimate_memory(algo, *s['info']) for s in samples)
+
+    rectified_pixels = scale * sum(s['info'][0] * s['info'][1] for s in samples)
+    disk = {
+        'rectified images, disparities and masks': rectified_pixels * RECTIFIED_BYTES_PER_PIXEL,
+        'height maps': (tiles_megapixels * 1e6 * nb_pairs * HEIGHT_MAP_BYTES_PER_PIXEL
+                        if nb_pairs > 1 else 0),
+        'point clouds': tiles_megapixels * 1e6 * PLY_BYTES_PER_PIXEL,
+    }
+
+    return {
+        'nb_tiles': len(tiles),
+        'nb_pairs': nb_pairs,
+        'nb_sampled_pairs': len(samples),
+        'nb_workers': nb_workers,
+        'nb_workers_stereo': min(nb_workers, nb_workers_stereo),
+        'initialization_time': init_time,
+        'pointing_time': pointing_time,
+        'rectification_time': rectification_time,
+        'matching_time': matching_time,
+        'other_steps_time': other_time,
+        'wall_time': wall_time,
+        'mean_disparity_range': float(np.mean([s['info'][3] - s['info'][2] for s in samples])),
+        'max_disparity_range': float(max(s['info'][3] - s['info'][2] for s in samples)),
+        'worker_memory_mb': max(memory, matching_memory),
+        'matching_memory_mb': matching_memory,
+        'disk_bytes': disk,
+    }
+
+
+def format_estimate(e):
+    """
+    Return a text report of the estimates returned by estimate.
+    """
+    lines = [
+        '{} tiles, {} pairs, estimates from {} sampled (tile, pair)'.format(
+            e['nb_tiles'], e['nb_pairs'], e['nb_sampled_pairs']),
+        'disparity range: {:.0f} on average, {:.0f} at most'.format(
+            e['mean_disparity_range'], e['max_disparity_range']),
+        '',
+        'computation time, in seconds of one core:',
+        '  initialization     {:10.0f} (measured, wall time)'.format(e['initialization_time']),
+        '  pointing           {:10.0f}'.format(e['pointing_time']),
+        '  rectification      {:10.0f}'.format(e['rectification_time']),
+        '  stereo matching    {:10.0f} (cost model)'.format(e['matching_time']),
+        '  other steps        {:10.0f} (cost model)'.format(e['other_steps_time']),
+        'wall time with {} workers ({} for the stereo matching): {:.0f}s'.format(
+            e['nb_workers'], e['nb_workers_stereo'], e['wall_time']),
+        '',
+        'peak memory per worker: {:.0f} MB (stereo matching: {:.0f} MB)'.format(
+            e['worker_memory_mb'], e['matching_memory_mb']),
+        '',
+        'intermediate files:',
+    ]
+    for k, v in e['disk_bytes'].items():
+        lines.append('  {:40s} {:8.1f} GB'.format(k, v / 1e9))
+    lines.append('  {:40s} {:8.1f} GB'.format('total', sum(e['disk_bytes'].values()) / 1e9))
+    return '\n'.join(lines)
@@ -3,8 +3,9 @@
 # Copyright (C) 2015, Enric Meinhardt <enric.meinhardt@cmla.ens-cachan.fr>
 # Copyright (C) 2015, Julien Michel <julien.michel@cnes.fr>
 
+import functools
+
 import geojson
-from distutils.version import LooseVersion
 
 import pyproj
 import numpy as np
@@ -13,6 +14,18 @@ from rasterio.crs import CRS as RioCRS
 from pyproj.enums import WktVersion
 
 
+@functools.lru_cache(maxsize=1)
+def geoid_to_ellipsoid_transformer():
+    """
+    Return the (slow to build) transformer used by geoid_to_ellipsoid.
+    """
+    # WGS84 with ellipsoid height as vertical axis
+    ellipsoid = pyproj.CRS.from_epsg(4979)
+    # WGS84 with Gravity-related height (EGM96)
+    geoid = pyproj.CRS("EPSG:4326+5773")
+    return pyproj.Transformer.from_crs(geoid, ellipsoid)
+
+
 def geoid_to_ellipsoid(lat, lon, z):
     """
     Converts a height, in meters, from the EGM96 geoid datum
@@ -28,12 +41,7 @@ def geoid_to_ellipsoid(lat, lon, z):
 
     The conversion is made by PROJ through its python wrapper pyproj
     """
-    # WGS84 with ellipsoid height as vertical axis
-    ellipsoid = pyproj.CRS.from_epsg(4979)
-    # WGS84 with Gravity-related height (EGM96)
-    geoid = pyproj.CRS("EPSG:4326+5773")
-    transformer = pyproj.Transformer.from_crs(geoid, ellipsoid)
-    height = transformer.transform(lat, lon, z)[-1]
+    height = geoid_to_ellipsoid_transformer().transform(lat, lon, z)[-1]
     return height
 
 
@@ -92,6 +100,8 @@ def rasterio_crs(projparams):
     Returns:
         rasterio.crs.CRS: object that can be used with rasterio
     """
+    from distutils.version import LooseVersion  # slow to import
+
     proj_crs = pyproj_crs(projparams)
     if LooseVersion(rasterio.__gdal_version__) < LooseVersion("3.0.0"):
         rio_crs = RioCRS.from_wkt(proj_crs.to_wkt(WktVersion.WKT1_GDAL))
@@ -1,21 +1,34 @@
 from __future__ import annotations
 
 import abc
+import fcntl
 import logging
 import math
 import multiprocessing
 import multiprocessing.context
 import multiprocessing.sharedctypes
 import multiprocessing.synchronize
+import os
+import tempfile
+import threading
 import time
+import weakref
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Generator
+from typing import Any, Dict, Generator, List, Optional, Sequence, Union
 
 logger = logging.getLogger(__name__)
 
 MEM_SLICE_PER_TOKEN = 100
 
+# number of simultaneous waiters, and of simultaneous holders of tokens, of a
+# bounded manager. The other requests wait for a free slot
+NUM_SLOTS = 64
+
+# maximal time a waiter sleeps without checking the state, in case the process
+# that should have woken it up was killed
+WAKE_UP_TIMEOUT = 1.0
+
 
 class UnavailableMemoryException(Exception):
     """The device does not have enough total memory to handle a request."""
@@ -26,63 +39,243 @@ class UnavailableMemoryException(Exception):
 class GPUMemoryManager(abc.ABC):
     @abc.abstractmethod
     @contextmanager
-    def request(self, megabytes: float) -> Generator[None, None, None]:
+    def request(self, megabytes: float) -> Generator[Optional[int], None, None]:
+        """
+        Reserve GPU memory, waiting until it is available.
+
+        Yields:
+            index of the device on which the memory is reserved (None if the
+            manager doesn't know about devices)
+        """
         ...
 
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the number of requests, and the total and maximal time (in
+        seconds) spent waiting for them.
+        """
+        return {}
+
+    def nb_devices(self) -> int:
+        """
+        Return the number of devices the requests are spread on.
+        """
+        return 1
+
     @staticmethod
     def make_bounded(
-        max_memory_in_megabytes: float,
+        max_memory_in_megabytes: Union[float, Sequence[float]],
         mp_context: multiprocessing.context.BaseContext,
     ) -> GPUMemoryManager:
-        num_tokens = math.floor(max_memory_in_megabytes // MEM_SLICE_PER_TOKEN)
-        counter = mp_context.Value("i", num_tokens)
-        return _BoundedGPUMemoryManager(
-            num_tokens=num_tokens,
-            counter=counter,
+        """
+        Args:
+            max_memory_in_megabytes: usable memory of the GPU, or list of the
+                usable memories of several GPUs
+            mp_context: multiprocessing context of the processes sharing the
+                manager
+        """
+        if isinstance(max_memory_in_megabytes, (int, float)):
+            max_memory_in_megabytes = [max_memory_in_megabytes]
+        capacities = [math.floor(m // MEM_SLICE_PER_TOKEN) for m in max_memory_in_megabytes]
+        fd, lock_path = tempfile.mkstemp(prefix="s2p_gpu_", suffix=".lock")
+        os.close(fd)
+        manager = _BoundedGPUMemoryManager(
+            capacities=capacities,
+            lock=_FileLock(lock_path),
+            bells=[mp_context.Semaphore(0) for _ in range(NUM_SLOTS)],
+            free=mp_context.RawArray("i", capacities),
+            tickets=mp_context.RawArray("q", 2),
+            holders=mp_context.RawArray("q", 3 * NUM_SLOTS),
+            waiters=mp_context.RawArray("q", 2 * NUM_SLOTS),
+            wait_stats=mp_context.RawArray("d", 3),
         )
+        weakref.finalize(manager, os.remove, lock_path)
+        return manager
 
     @staticmethod
     def make_unbounded() -> _UnboundedGPUMemoryManager:
         return _UnboundedGPUMemoryManager()
 
 
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _FileLock:
+    """
+    Lock shared by the threads and processes using the file at path.
+
+    Unlike a multiprocessing.Lock, it is released by the system when its
+    holder dies (e.g. killed after a timeout).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+
+    def _open(self) -> None:
+        # flock doesn't exclude the threads sharing a file descriptor
+        self._thread_lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._pid: Optional[int] = None
+
+    def __getstate__(self) -> str:
+        return self.path
+
+    def __setstate__(self, path: str) -> None:
+        self.path = path
+        self._open()
+
+    def __enter__(self) -> None:
+        self._thread_lock.acquire()
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self._pid = os.getpid()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
 @dataclass
 class _BoundedGPUMemoryManager(GPUMemoryManager):
-    num_tokens: int
-    """ 1 token = 100MB """
-    counter: Any
+    """
+    Tokens (1 token = 100MB) of one or several devices, shared by processes.
+
+    The requests are served in FIFO order, with tickets: only the oldest
+    request can take tokens, so that large requests are not starved by small
+    ones. It is then assigned the least loaded device with enough free tokens.
+    Releasing tokens, or taking them, wakes the next waiter up. The tokens of
+    the processes that died (e.g. killed after a timeout) are given back, and
+    their tickets skipped.
+    """
+    capacities: List[int]
+    """ number of tokens of each device """
+    lock: Any
+    """ _FileLock protecting the shared arrays """
+    bells: List[Any]
+    """ semaphores waking the waiters up, one per waiter slot """
+    free: Any
+    """ number of free tokens of each device """
+    tickets: Any
+    """ next ticket, and ticket being served """
+    holders: Any
+    """ (pid, device, tokens) of the processes holding tokens """
+    waiters: Any
+    """ (ticket, pid) of the processes waiting """
+    wait_stats: Any
+    """ number of requests, total and maximal wait time """
+
+    def _least_loaded_device(self, tokens: int) -> Optional[int]:
+        candidates = [d for d, c in enumerate(self.capacities) if self.free[d] >= tokens]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda d: ((self.capacities[d] - self.free[d]) / self.capacities[d],
+                                              -self.free[d], d))
+
+    def _waiter(self, ticket: int) -> Optional[int]:
+        """ slot of the waiter with this ticket. Call with the lock """
+        return next((k for k in range(NUM_SLOTS)
+                     if self.waiters[2 * k + 1] and self.waiters[2 * k] == ticket), None)
+
+    def _ring(self) -> None:
+        """ wake the waiter of the ticket being served up. Call with the lock """
+        k = self._waiter(self.tickets[1])
+        if k is not None:
+            self.bells[k].release()
+
+    def _cleanup(self) -> None:
+        """ forget the dead processes. Call with the lock """
+        for k in range(NUM_SLOTS):
+            pid, device, tokens = self.holders[3 * k: 3 * k + 3]
+            if pid and not _is_alive(pid):
+                logger.warning("giving back %d GPU tokens of dead process %d", tokens, pid)
+                self.free[device] += tokens
+                self.holders[3 * k: 3 * k + 3] = [0, 0, 0]
+        while self.tickets[1] < self.tickets[0]:
+            k = self._waiter(self.tickets[1])
+            if k is not None:
+                if _is_alive(self.waiters[2 * k + 1]):
+                    break
+                self.waiters[2 * k: 2 * k + 2] = [0, 0]
+            self.tickets[1] += 1
 
     @contextmanager
-    def request(self, megabytes: float) -> Generator[None, None, None]:
+    def request(self, megabytes: float) -> Generator[Optional[int], None, None]:
         # add some overhead just in case
         megabytes += megabytes * 0.05
 
         tokens = math.ceil(megabytes / MEM_SLICE_PER_TOKEN)
 
-        if tokens > self.num_tokens:
+        if tokens > max(self.capacities):
             raise UnavailableMemoryException(
-                f"{tokens} tokens requested, only {self.num_tokens} total available"
+                f"{tokens} tokens requested, only {max(self.capacities)} total available"
                 f" (1 token = {MEM_SLICE_PER_TOKEN}MB)"
             )
 
-        # this is a poor's man semaphore, because python's semaphore does not support acquiring many tokens at once
-        # and doing something smarter with Condition harder to get right.
+        start = time.monotonic()
         while True:
-            with self.counter.get_lock():
-                if self.counter.value >= tokens:
-                    self.counter.value -= tokens
+            with self.lock:
+                self._cleanup()
+                waiter = next((k for k in range(NUM_SLOTS) if not self.waiters[2 * k + 1]), None)
+                if waiter is not None:
+                    ticket = self.tickets[0]
+                    self.tickets[0] += 1
+                    self.waiters[2 * waiter: 2 * waiter + 2] = [ticket, os.getpid()]
                     break
-            time.sleep(0.1)
+            time.sleep(WAKE_UP_TIMEOUT)
+
+        while True:
+            with self.lock:
+                self._cleanup()
+                if self.tickets[1] == ticket:
+                    device = self._least_loaded_device(tokens)
+                    # the tokens are only given with a slot to track them,
+                    # so that they can be given back if the process dies
+                    slot = next((k for k in range(NUM_SLOTS) if not self.holders[3 * k]), None)
+                    if device is not None and slot is not None:
+                        self.holders[3 * slot: 3 * slot + 3] = [os.getpid(), device, tokens]
+                        self.free[device] -= tokens
+                        self.waiters[2 * waiter: 2 * waiter + 2] = [0, 0]
+                        self.tickets[1] += 1
+                        waited = time.monotonic() - start
+                        self.wait_stats[0] += 1
+                        self.wait_stats[1] += waited
+                        self.wait_stats[2] = max(self.wait_stats[2], waited)
+                        # the next request may fit too
+                        self._ring()
+                        break
+            self.bells[waiter].acquire(timeout=WAKE_UP_TIMEOUT)
 
         try:
-            yield
+            yield device
         finally:
-            with self.counter.get_lock():
-                self.counter.value += tokens
+            with self.lock:
+                self.holders[3 * slot: 3 * slot + 3] = [0, 0, 0]
+                self.free[device] += tokens
+                self._ring()
+
+    def nb_devices(self) -> int:
+        return len(self.capacities)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "requests": self.wait_stats[0],
+                "total_wait": self.wait_stats[1],
+                "max_wait": self.wait_stats[2],
+            }
 
 
 @dataclass
 class _UnboundedGPUMemoryManager(GPUMemoryManager):
     @contextmanager
-    def request(self, megabytes: float) -> Generator[None, None, None]:
-        yield
+    def request(self, megabytes: float) -> Generator[Optional[int], None, None]:
+        yield None
@@ -1,18 +1,29 @@
 import os
 from typing import Any
 
-import cffi
 import numpy as np
 
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 LIB_FOLDER = os.path.join(ROOT, "..", "lib")
 
-ffi = cffi.FFI()
-ffi.cdef(open(os.path.join(LIB_FOLDER, "libhomography.h")).read())
+# libhomography, loaded on first use so that importing s2p stays fast
+ffi: Any = None
+homography: Any = None
 
-homography: Any = ffi.dlopen(os.path.join(LIB_FOLDER, "libhomography.so"))
-homography.init()
+
+def load_lib() -> Any:
+    """
+    Load libhomography, if it is not loaded yet, and return it.
+    """
+    global ffi, homography
+    if homography is None:
+        import cffi
+        ffi = cffi.FFI()
+        ffi.cdef(open(os.path.join(LIB_FOLDER, "libhomography.h")).read())
+        homography = ffi.dlopen(os.path.join(LIB_FOLDER, "libhomography.so"))
+        homography.init()
+    return homography
 
 
 def wrap(array):
@@ -52,7 +63,7 @@ def image_apply_homography(
     The output image is defined on the domain [0, w] x [0, h]. Its pixels
     intensities are defined by out(x) = im(H^{-1}(x)).
     """
-    success = homography.run(
+    success = load_lib().run(
         im.encode("utf-8"),
         wrap(H.flatten()),
         out.encode("utf-8"),
@@ -0,0 +1,147 @@
+"""
+Conversion of the input images to internally tiled GeoTIFFs with overviews.
+
+The windowed reads of strip-organized TIFFs or JPEG2000 files decode much
+more than the window, at a cost that depends on the file layout. The images
+(and their color versions) are thus rewritten into GeoTIFFs with square
+blocks of BLOCK_SIZE pixels and internal overviews, keeping their RPC tags.
+
+The converted files are named after the checksum of their source, in
+cfg['ingest_dir'], so that the jobs on the same acquisition reuse them. With
+cfg['ingest_dir'] set, the images of a job are converted (if needed) by
+initialization.build_cfg, which replaces their paths in the config. The
+s2p-ingest command converts them beforehand.
+"""
+
+import os
+import hashlib
+import logging
+import multiprocessing
+import concurrent.futures
+
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+from s2p import parallel
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512
+# smallest side of the coarsest overview
+MIN_OVERVIEW_SIZE = 256
+
+
+def checksum(path, ingest_dir):
+    """
+    Return the sha256 checksum of a file.
+
+    The checksum is memoized in ingest_dir, for the same path, size and
+    modification time.
+    """
+    s = os.stat(path)
+    key = '{}:{}:{}'.format(os.path.abspath(path), s.st_size, s.st_mtime_ns)
+    memo = os.path.join(ingest_dir, 'checksums', hashlib.sha1(key.encode()).hexdigest())
+    try:
+        with open(memo) as f:
+            return f.read().strip()
+    except OSError:
+        pass
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            h.update(chunk)
+    os.makedirs(os.path.dirname(memo), exist_ok=True)
+    with open(memo, 'w') as f:
+        f.write(h.hexdigest())
+    return h.hexdigest()
+
+
+def is_ingested(path):
+    """
+    Tell if a raster is already a tiled GeoTIFF with overviews.
+    """
+    with rasterio.open(path) as f:
+        bh, bw = f.block_shapes[0]
+        return (f.driver == 'GTiff' and bw < f.width and bh < f.height
+                and bool(f.overviews(1)))
+
+
+def overview_factors(width, height):
+    """
+    Return the decimation factors of the overviews of a raster.
+    """
+    factors = []
+    f = 2
+    while min(width, height) // f >= MIN_OVERVIEW_SIZE:
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def convert(src, dst):
+    """
+    Write a raster as an internally tiled GeoTIFF with overviews, keeping its
+    georeferencing, metadata and RPC tags.
+    """
+    with rasterio.open(src) as f:
+        rpc = f.tags(ns='RPC')
+        integer = f.dtypes[0].startswith(('int', 'uint'))
+
+    tmp = '{}.{}.tmp.tif'.format(os.path.splitext(dst)[0], os.getpid())
+    rasterio.shutil.copy(src, tmp, driver='GTiff', tiled=True,
+                         blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                         compress='deflate', predictor=2 if integer else 1,
+                         bigtiff='IF_SAFER')
+    with rasterio.open(tmp, 'r+') as f:
+        if rpc and not f.tags(ns='RPC'):
+            f.update_tags(ns='RPC', **rpc)
+        f.build_overviews(overview_factors(f.width, f.height), Resampling.average)
+        f.update_tags(ns='rio_overview', resampling='average')
+    os.replace(tmp, dst)
+
+
+def ingest_image(path, ingest_dir):
+    """
+    Return the path of the converted version of an image, converting it if it
+    is not in ingest_dir yet. The images that are already tiled GeoTIFFs with
+    overviews are left as they are.
+    """
+    if is_ingested(path):
+        return path
+    dst = os.path.join(ingest_dir, '{}.tif'.format(checksum(path, ingest_dir)[:32]))
+    if not os.path.exists(dst):
+        logger.info('converting %s to %s...', path, dst)
+        convert(path, dst)
+    return dst
+
+
+def ingest(user_cfg, ingest_dir, nb_workers=None):
+    """
+    Convert the images (img and clr) of a config, in parallel, and replace
+    their paths in the config.
+
+    Returns:
+        dictionary of the paths of the converted images, indexed by the paths
+        of their sources
+    """
+    ingest_dir = os.path.abspath(os.path.expandvars(ingest_dir))
+    os.makedirs(ingest_dir, exist_ok=True)
+    paths = sorted(set(img[k] for img in user_cfg['images'] for k in ['img', 'clr']
+                       if img.get(k)))
+
+    nb_workers = min(nb_workers or multiprocessing.cpu_count(), len(paths))
+    if nb_workers <= 1:
+        converted = [ingest_image(p, ingest_dir) for p in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                nb_workers, mp_context=parallel.get_mp_context()) as pool:
+            converted = list(pool.map(ingest_image, paths, [ingest_dir] * len(paths)))
+
+    mapping = dict(zip(paths, converted))
+    for img in user_cfg['images']:
+        for k in ['img', 'clr']:
+            if img.get(k):
+                img[k] = mapping[img[k]]
+    return mapping
@@ -8,21 +8,34 @@ import sys
 import json
 import copy
 import logging
+import collections
 import rasterio
 import numpy as np
 import rpcm
 from typing import List, Tuple
 
 from s2p import common
+from s2p import intermediate
+from s2p import block_cache
+from s2p import ingest
 from s2p import geographiclib
 from s2p import rpc_utils
 from s2p import masking
 from s2p import parallel
-from s2p.tile import Tile
+from s2p import catalog
+from s2p.tile import Tile, get_tile_dir
 
 
 logger = logging.getLogger(__name__)
 
+# with adaptive tiling, the tiles are up to 2**ADAPTIVE_TILING_LEVELS times
+# larger or smaller than the nominal tile size
+ADAPTIVE_TILING_LEVELS = 2
+
+# disparity range of a tile without relief, in pixels, used in the cost of the
+# tiles (the rectification always adds some margin to the estimated range)
+ADAPTIVE_TILING_MIN_DISP_RANGE = 16
+
 # This function is here as a workaround to python bug #24313 When
 # using python3, json does not know how to serialize numpy.int64 on
 # some platform numpy also decides to go for int64 when numpy.arange
@@ -57,9 +70,11 @@ def check_parameters(cfg, d: dict) -> None:
             logger.critical('missing img paths for image', img)
             sys.exit(1)
 
-    # read RPCs
+    # read RPCs, unless they were already read (e.g. by s2p.batch)
     for img in d['images']:
-        if 'rpc' in img:
+        if 'rpcm' in img:
+            pass
+        elif 'rpc' in img:
             if isinstance(img['rpc'], str):  # path to an RPC file
                 img['rpcm'] = rpcm.rpc_from_rpc_file(img['rpc'])
             elif isinstance(img['rpc'], dict):  # RPC dict in 'rpcm' format
@@ -139,6 +154,11 @@ def build_cfg(cfg, user_cfg: dict) -> None:
     Args:
         user_cfg: user config dictionary
     """
+    # convert the input images to tiled GeoTIFFs, before their RPC models
+    # are read
+    if user_cfg.get('ingest_dir'):
+        ingest.ingest(user_cfg, user_cfg['ingest_dir'], user_cfg.get('max_processes'))
+
     # check that all the mandatory arguments are defined
     check_parameters(cfg, user_cfg)
 
@@ -244,12 +264,140 @@ def compute_tiles_coordinates(rx, ry, rw, rh, tw, th):
     return out, neighborhood_dict
 
 
-def get_tile_dir(x, y, w, h):
+def tiles_neighborhoods(tiles_coords, cell_size):
+    """
+    Find the neighbors of tiles of any size that partition a region.
+
+    Args:
+        tiles_coords: list of (x, y, w, h) tuples
+        cell_size: size of the cells of the grid used to look up the tiles,
+            typically the size of the smallest tiles
+
+    Returns:
+        dictionary of the list of the tiles that touch each tile (including
+        itself), indexed by str((x, y, w, h))
+    """
+    cells = collections.defaultdict(list)
+    for t in tiles_coords:
+        x, y, w, h = t
+        for j in range(y // cell_size, (y + h - 1) // cell_size + 1):
+            for i in range(x // cell_size, (x + w - 1) // cell_size + 1):
+                cells[i, j].append(t)
+
+    neighborhood_dict = dict()
+    for t in tiles_coords:
+        x, y, w, h = t
+        candidates = set()
+        for j in range((y - 1) // cell_size, (y + h) // cell_size + 1):
+            for i in range((x - 1) // cell_size, (x + w) // cell_size + 1):
+                candidates.update(cells.get((i, j), []))
+        neighborhood_dict[str(t)] = sorted(
+            (x2, y2, w2, h2) for x2, y2, w2, h2 in candidates
+            if x2 <= x + w and x2 + w2 >= x and y2 <= y + h and y2 + h2 >= y)
+    return neighborhood_dict
+
+
+def compute_adaptive_tiles_coordinates(rx, ry, rw, rh, tw, th, relief,
+                                       hmargin=0, vmargin=0):
+    """
+    Cut a region in tiles whose stereo matching costs are balanced.
+
+    The region is covered by a grid of tiles 2**ADAPTIVE_TILING_LEVELS times
+    larger than the nominal (tw, th) size, which are split in four, as in a
+    quadtree, while their cost is larger than the cost of a nominal tile of
+    median relief. Flat areas thus get large tiles and high relief areas get
+    small ones, down to 2**ADAPTIVE_TILING_LEVELS times smaller than the
+    nominal size. The total size of the cost volumes decreases, and the tiles
+    are processed in similar times.
+
+    Args:
+        rx, ry, rw, rh: region of interest, in the reference image
+        tw, th: nominal tile size
+        relief: function that returns the disparity range (in pixels) of a
+            (x, y, w, h) rectangle of the reference image
+        hmargin, vmargin: margins added to the tiles by the rectification
+
+    Returns:
+        same as compute_tiles_coordinates
+    """
+    factor = 2 ** ADAPTIVE_TILING_LEVELS
+
+    def cost(x, y, w, h, d=None):
+        # size of the cost volume
+        if d is None:
+            d = relief(x, y, w, h)
+        return (w + 2 * hmargin) * (h + 2 * vmargin) * (d + ADAPTIVE_TILING_MIN_DISP_RANGE)
+
+    # the target cost is the one of a nominal tile of median relief
+    nominal = compute_tiles_coordinates(rx, ry, rw, rh, tw, th)[0]
+    d = np.median([relief(*t) for t in nominal])
+    target = cost(0, 0, tw, th, d)
+
+    def split(x, y, tw, th, level):
+        w = min(tw, rx + rw - x)
+        h = min(th, ry + rh - y)
+        if level == 2 * ADAPTIVE_TILING_LEVELS or cost(x, y, w, h) <= target:
+            return [(x, y, w, h)]
+        out = []
+        for y2, th2 in [(y, th // 2), (y + th // 2, th - th // 2)]:
+            for x2, tw2 in [(x, tw // 2), (x + tw // 2, tw - tw // 2)]:
+                if x2 < rx + rw and y2 < ry + rh:
+                    out += split(x2, y2, tw2, th2, level + 1)
+        return out
+
+    out = []
+    for y in range(ry, ry + rh, th * factor):
+        for x in range(rx, rx + rw, tw * factor):
+            out += split(x, y, tw * factor, th * factor, 0)
+
+    return out, tiles_neighborhoods(out, max(min(tw, th) // factor, 1))
+
+
+def relief_disparity_range(cfg):
+    """
+    Return a function that estimates the disparity range due to the relief
+    of a rectangle of the reference image, using the exogenous DEM or SRTM.
+    """
+    rpc = cfg['images'][0]['rpcm']
+    roi = cfg['roi']
+    x = roi['x'] + roi['w'] / 2
+    y = roi['y'] + roi['h'] / 2
+    alt = rpc.alt_offset
+    lon, lat = rpc.localization(x, y, alt)
+
+    # displacement, in pixels per meter of altitude, of the matches of the
+    # center of the ROI in the secondary image with the largest parallax
+    parallax = max(np.hypot(*np.subtract(img['rpcm'].projection(lon, lat, alt + 100),
+                                         img['rpcm'].projection(lon, lat, alt))) / 100
+                   for img in cfg['images'][1:])
+
+    def relief(x, y, w, h):
+        m, M = rpc_utils.altitude_range(cfg, rpc, x, y, w, h)
+        return parallax * (M - m)
+
+    return relief
+
+
+def tiles_coordinates(cfg, rx, ry, rw, rh, tw, th):
     """
-    Get the name of a tile directory
+    Cut the region of interest in tiles, with a regular grid or with
+    adaptive tiling if cfg['adaptive_tiling'] is set.
+
+    Returns:
+        same as compute_tiles_coordinates
     """
-    return os.path.join('tiles','row_{:07d}_height_{}'.format(y, h),
-                        'col_{:07d}_width_{}'.format(x, w))
+    if cfg['adaptive_tiling']:
+        if cfg['exogenous_dem'] is None and not cfg['use_srtm']:
+            logger.warning('adaptive tiling needs an exogenous DEM or SRTM, '
+                           'using a regular grid')
+        else:
+            out, neighborhood_dict = compute_adaptive_tiles_coordinates(
+                rx, ry, rw, rh, tw, th, relief_disparity_range(cfg),
+                cfg['horizontal_margin'], cfg['vertical_margin'])
+            logger.info('adaptive tiling: {} tiles, of widths from {} to {}'.format(
+                len(out), min(w for _, _, w, _ in out), max(w for _, _, w, _ in out)))
+            return out, neighborhood_dict
+    return compute_tiles_coordinates(rx, ry, rw, rh, tw, th)
 
 
 def create_tile(cfg, coords, neighborhood_coords_dict) -> Tile:
@@ -325,15 +473,14 @@ def is_tile_all_nodata(path:str, window:rasterio.windows.Window):
         Return True if all pixels in the window are nodata.
         Return False if at least one pixel is non-nodata.
     """
-    with rasterio.open(path, "r") as ds:
-        arr = ds.read(window=window)
+    arr = block_cache.read_window(path, window)
 
-        # NOTE: Many satellite imagery providers use ds.nodata as the value of
-        # nodata pixels. Pleiades and PNeo imagery use None as nodata in their
-        # profile while putting 0 to nodata pixel in reality. Thus, we have to
-        # If a window is full of nodata (or 0), then this window is discarded.
-        nodata = ds.nodata or 0
-        return (arr == nodata).all()
+    # NOTE: Many satellite imagery providers use ds.nodata as the value of
+    # nodata pixels. Pleiades and PNeo imagery use None as nodata in their
+    # profile while putting 0 to nodata pixel in reality. Thus, we have to
+    # If a window is full of nodata (or 0), then this window is discarded.
+    nodata = common.open_dataset(path).nodata or 0
+    return (arr == nodata).all()
 
 
 def is_this_tile_useful(cfg, x, y, w, h, images_sizes):
@@ -374,6 +521,76 @@ def is_this_tile_useful(cfg, x, y, w, h, images_sizes):
     return True, mask
 
 
+def create_tiles(cfg, tiles_coords, neighborhood_coords_dict,
+                 tiles_usefulnesses) -> List[Tile]:
+    """
+    Create the useful tiles, with their output directories and masks, and
+    write the catalog of the tiles (and with cfg['tile_configs'] their json
+    configuration dumps).
+
+    Args:
+        tiles_coords: list of the coordinates of all the tiles
+        neighborhood_coords_dict: neighborhoods of the tiles, see
+            compute_tiles_coordinates
+        tiles_usefulnesses: outputs of is_this_tile_useful on all the tiles
+
+    Returns:
+        list of the useful tiles
+    """
+    cat = catalog.from_tiles(tiles_coords, neighborhood_coords_dict,
+                             [b for b, _ in tiles_usefulnesses])
+    catalog.write(os.path.join(cfg['out_dir'], catalog.CATALOG_NAME), cat)
+    tiles = cat.tiles(cfg)
+
+    masks = (m for b, m in tiles_usefulnesses if b)
+    for tile, mask in zip(tiles, masks):
+        # make tiles directories
+        os.makedirs(tile.dir, exist_ok=True)
+        for i in range(1, len(cfg['images'])):
+            os.makedirs(os.path.join(tile.dir, 'pair_{}'.format(i)), exist_ok=True)
+
+        if cfg['tile_configs']:
+            write_tile_config(cfg, tile)
+
+        # save the mask
+        common.rasterio_write(intermediate.path(cfg, os.path.join(tile.dir, 'mask.tif')),
+                              mask.astype(np.uint8), {"NBITS": 1, "compress": "LZW"})
+    return tiles
+
+
+def write_tile_config(cfg, tile: Tile) -> None:
+    """
+    Save a json dump of the configuration of a tile, that can be run on its
+    own by the s2p command.
+    """
+    tile_cfg = copy.deepcopy(cfg)
+    x, y, w, h = tile.coordinates
+    for img in tile_cfg['images']:
+        img.pop('rpcm', None)
+    tile_cfg['roi'] = {'x': x, 'y': y, 'w': w, 'h': h}
+    tile_cfg['full_img'] = False
+    tile_cfg['max_processes'] = 1
+    tile_cfg['neighborhood_dirs'] = tile.neighborhood_dirs
+    tile_cfg['out_dir'] = '../../..'
+
+    with open(os.path.join(cfg['out_dir'], tile.json), 'w') as f:
+        json.dump(tile_cfg, f, indent=2, default=workaround_json_int64)
+
+
+def write_tiles_txt(cfg, tiles: List[Tile], tiles_txt) -> None:
+    """
+    Write the list of the json configurations of the tiles, read by the
+    scripts of the utils directory. Nothing is written without
+    cfg['tile_configs'], as there are no configurations to list.
+    """
+    if not cfg['tile_configs']:
+        return
+    with open(tiles_txt, 'w') as f:
+        for t in tiles:
+            f.write(t.json)
+            f.write('\n')
+
+
 def tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False) -> List[Tile]:
     """
     List the tiles to process and prepare their output directories structures.
@@ -385,6 +602,17 @@ def tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False) -> List[Tile]:
         a list of dictionaries. Each dictionary contains the image coordinates
         and the output directory path of a tile.
     """
+    # restart from the catalog of the tiles
+    catalog_path = os.path.join(cfg['out_dir'], catalog.CATALOG_NAME)
+    if not create_masks and os.path.exists(catalog_path):
+        tiles = catalog.read(catalog_path).tiles(cfg)
+        for tile in tiles:
+            # check if the mask.tif is present; othewise create_masks should have been True
+            if not os.path.exists(intermediate.path(cfg, os.path.join(tile.dir, 'mask.tif'))):
+                logger.critical('the tile masks (%s) must be initialized: use  --start_from 1' % os.path.join (tile.dir, 'mask.tif'))
+                sys.exit(1)
+        return tiles
+
     rx = cfg['roi']['x']
     ry = cfg['roi']['y']
     rw = cfg['roi']['w']
@@ -394,14 +622,13 @@ def tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False) -> List[Tile]:
     tiles = []
 
     # list tiles coordinates
-    tiles_coords, neighborhood_coords_dict = compute_tiles_coordinates(rx, ry, rw, rh, tw, th)
+    tiles_coords, neighborhood_coords_dict = tiles_coordinates(cfg, rx, ry, rw, rh, tw, th)
 
     if create_masks or not os.path.exists(tiles_txt):
         logger.info('discarding masked tiles...')
         images_sizes = []
         for img in cfg['images']:
-            with rasterio.open(img['img'], 'r') as f:
-                images_sizes.append(f.shape)
+            images_sizes.append(common.open_dataset(img['img']).shape)
 
         # compute all masks in parallel as numpy arrays
         tiles_usefulnesses = parallel.launch_calls(cfg, is_this_tile_useful,
@@ -409,44 +636,13 @@ def tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False) -> List[Tile]:
                                                    cfg['max_processes'],
                                                    images_sizes,
                                                    tilewise=False,
-                                                   timeout=cfg['timeout'])
-
-        # discard useless tiles from neighborhood_coords_dict
-        discarded_tiles = set(x for x, (b, _) in zip(tiles_coords, tiles_usefulnesses) if not b)
-        for k, v in neighborhood_coords_dict.items():
-            neighborhood_coords_dict[k] = list(set(v) - discarded_tiles)
-
-        for coords, usefulness in zip(tiles_coords, tiles_usefulnesses):
-            useful, mask = usefulness
-            if not useful:
-                continue
-
-            tile = create_tile(cfg, coords, neighborhood_coords_dict)
-            tiles.append(tile)
-
-            # make tiles directories and store json configuration dumps
-            os.makedirs(tile.dir, exist_ok=True)
-            for i in range(1, len(cfg['images'])):
-                os.makedirs(os.path.join(tile.dir, 'pair_{}'.format(i)), exist_ok=True)
-
-            # save a json dump of the tile configuration
-            tile_cfg = copy.deepcopy(cfg)
-            x, y, w, h = tile.coordinates
-            for img in tile_cfg['images']:
-                img.pop('rpcm', None)
-            tile_cfg['roi'] = {'x': x, 'y': y, 'w': w, 'h': h}
-            tile_cfg['full_img'] = False
-            tile_cfg['max_processes'] = 1
-            tile_cfg['neighborhood_dirs'] = tile.neighborhood_dirs
-            tile_cfg['out_dir'] = '../../..'
-
-            with open(os.path.join(cfg['out_dir'], tile.json), 'w') as f:
-                json.dump(tile_cfg, f, indent=2, default=workaround_json_int64)
-
-            # save the mask
-            common.rasterio_write(os.path.join(tile.dir, 'mask.tif'),
-                                  mask.astype(np.uint8), {"NBITS": 1, "compress": "LZW"})
-    else:
+                                                   timeout=cfg['timeout'],
+                                                   telemetry=os.path.join(cfg['out_dir'], 'telemetry.jsonl')
+                                                   if cfg['telemetry'] else None)
+
+        tiles = create_tiles(cfg, tiles_coords, neighborhood_coords_dict,
+                             tiles_usefulnesses)
+    else:  # output directory of a run prior to the catalog of the tiles
         if len(tiles_coords) == 1:
             tiles.append(create_tile(cfg, tiles_coords[0], neighborhood_coords_dict))
         else:
@@ -464,7 +660,7 @@ def tiles_full_info(cfg, tw, th, tiles_txt, create_masks=False) -> List[Tile]:
                         tiles.append(tile)
 
                     # check if the mask.tif is present; othewise create_masks should have been True
-                    if not os.path.exists(os.path.join(tile.dir, 'mask.tif')):
+                    if not os.path.exists(intermediate.path(cfg, os.path.join(tile.dir, 'mask.tif'))):
                         logger.critical('the tile masks (%s) must be initialized: use  --start_from 1' % os.path.join (tile.dir, 'mask.tif'))
                         sys.exit(1)
     return tiles
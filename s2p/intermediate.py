@@ -0,0 +1,127 @@
+"""
+Store of the intermediate rasters of the tiles (tile masks, rectified images,
+disparity maps and masks, height maps) on a RAM-backed filesystem.
+
+Each of these files is written by a step and read by the next ones. On a
+parallel filesystem (Lustre, NFS), these small-file round trips are a
+significant part of the time of the rectification, matching and
+triangulation steps. With cfg['intermediate_dir'] set to a directory of a
+tmpfs (e.g. /dev/shm), they are written there instead, up to
+cfg['intermediate_dir_max_size'] MB per job, and spill to out_dir above it.
+The size of the store is checked once per tile, when its first file is
+placed: the next files of an admitted tile go to the store as well.
+
+The files of a tile are moved to out_dir once its point cloud is computed
+(or deleted, with cfg['clean_intermediate']), so that they stay available for
+debugging and for restarting from a later step. The external programs (e.g.
+the stereo matching binaries) read and write them as any other file.
+"""
+
+import os
+import shutil
+import hashlib
+
+
+def root(cfg):
+    """
+    Return the directory of the intermediate files of a job in the store, or
+    None if the store is not used.
+    """
+    if not cfg['intermediate_dir']:
+        return None
+    key = hashlib.sha1(os.path.abspath(cfg['out_dir']).encode()).hexdigest()[:16]
+    return os.path.join(os.path.expandvars(cfg['intermediate_dir']), 's2p_{}'.format(key))
+
+
+def size(directory):
+    """
+    Return the total size, in bytes, of the files of a directory tree.
+    """
+    total = 0
+    for d, _, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.stat(os.path.join(d, f)).st_size
+            except OSError:  # removed meanwhile
+                pass
+    return total
+
+
+def tile_dir(rel):
+    """
+    Return the tile directory (tiles/row_*/col_*) of a path relative to
+    out_dir, or None if the path is not in a tile directory.
+    """
+    parts = rel.split(os.sep)
+    if len(parts) > 3 and parts[0] == 'tiles':
+        return os.path.join(*parts[:3])
+    return None
+
+
+def path(cfg, p):
+    """
+    Return the path where an intermediate file of out_dir is read and written.
+
+    The file is in the store if it is already there, or if it is not in
+    out_dir and either its tile is already in the store or the store is not
+    full. Otherwise, it is in out_dir.
+
+    Args:
+        p: path of the file in out_dir
+    """
+    r = root(cfg)
+    if r is None:
+        return p
+    rel = os.path.relpath(os.path.abspath(p), os.path.abspath(cfg['out_dir']))
+    if rel.startswith(os.pardir):
+        return p
+    stored = os.path.join(r, rel)
+    if os.path.exists(stored):
+        return stored
+    if os.path.exists(p):
+        return p
+    # walking the store is only needed to admit a new tile in it
+    tile = tile_dir(rel)
+    if tile is None or not os.path.isdir(os.path.join(r, tile)):
+        if size(r) >= cfg['intermediate_dir_max_size'] * 1e6:
+            return p
+    os.makedirs(os.path.dirname(stored), exist_ok=True)
+    return stored
+
+
+def exists(cfg, p):
+    """
+    Tell if an intermediate file of out_dir exists, in the store or in out_dir.
+
+    Args:
+        p: path of the file in out_dir
+    """
+    if os.path.exists(p):
+        return True
+    r = root(cfg)
+    if r is None:
+        return False
+    rel = os.path.relpath(os.path.abspath(p), os.path.abspath(cfg['out_dir']))
+    return not rel.startswith(os.pardir) and os.path.exists(os.path.join(r, rel))
+
+
+def persist(cfg, directory):
+    """
+    Move the intermediate files of a directory of out_dir (a tile, or the
+    whole out_dir) from the store to out_dir, or delete them if
+    cfg['clean_intermediate'] is set.
+    """
+    r = root(cfg)
+    if r is None:
+        return
+    rel = os.path.relpath(os.path.abspath(directory), os.path.abspath(cfg['out_dir']))
+    stored = os.path.normpath(os.path.join(r, rel))
+    if not os.path.isdir(stored):
+        return
+    if not cfg['clean_intermediate']:
+        for d, _, files in os.walk(stored):
+            dst = os.path.join(directory, os.path.relpath(d, stored))
+            os.makedirs(dst, exist_ok=True)
+            for f in files:
+                shutil.move(os.path.join(d, f), os.path.join(dst, f))
+    shutil.rmtree(stored, ignore_errors=True)
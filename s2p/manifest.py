@@ -0,0 +1,182 @@
+"""
+Manifest of the steps already computed, used to skip them on reruns.
+
+Each tilewise step records, in a manifest.json file in the tile directory, a
+key hashing the config parameters it depends on and the keys of the steps
+whose outputs it reads. A step whose key did not change since the last run
+does not need to be recomputed, unless the outputs read by the next steps
+were removed meanwhile. Global steps record their keys in the output
+directory.
+"""
+
+import os
+import json
+import hashlib
+
+from s2p import metadata
+from s2p import intermediate
+
+# config parameters used by each step, in addition to the ones used by the
+# steps it depends on. The steps not listed here (pointing_correction and
+# global_pointing_correction) depend on all the parameters that are neither
+# listed here nor in IGNORED_CFG_KEYS: an unknown parameter invalidates all
+# the steps
+STEPS_CFG_KEYS = {
+    'rectification_pair': ['rectification_method', 'register_with_shear',
+                           'horizontal_margin', 'vertical_margin',
+                           'max_altitude_span', 'altitude_margin',
+                           'epipolar_thresh', 'disp_range_method',
+                           'disp_range_exogenous_low_margin',
+                           'disp_range_exogenous_high_margin',
+                           'disp_range_extra_margin', 'disp_min', 'disp_max',
+                           'alt_min', 'alt_max', 'rpc_alt_range_scale_factor'],
+    'disparity_range_check': ['max_disp_range'],
+    'stereo_matching': ['matching_algorithm', 'census_ncc_win',
+                        'stereo_speckle_filter', 'stereo_regularity_multiplier',
+                        'mgm_nb_directions', 'mgm_leftright_threshold',
+                        'mgm_leftright_control', 'mgm_mindiff_control',
+                        'postprocess_stereosgm_gpu', 'msk_erosion'],
+    'disparity_to_ply': ['3d_filtering_radius_gsd', '3d_filtering_fill_factor'],
+    'heights_to_ply': ['3d_filtering_radius_gsd', '3d_filtering_fill_factor',
+                       'fusion_operator', 'fusion_thresh', 'cargarse_basura'],
+    'plys_to_dsm': ['dsm_resolution', 'dsm_radius', 'dsm_sigma',
+                    'dsm_aggregation_with_max', 'fill_dsm_holes_smaller_than'],
+    'global_dsm': ['dsm_resolution', 'dsm_merging_method'],
+}
+
+# outputs of each step that are read by the next steps, relative to the
+# directory of the step output (e.g. tiles/row_*/col_*/pair_1 for
+# 'pair_1/stereo_matching'): ('array', name) for the arrays saved with
+# s2p.metadata, and ('file', name) for the other files. {i} is replaced by the
+# index of each pair. The outputs of the steps not listed here are optional
+STEPS_OUTPUTS = {
+    'global_pointing_correction': [('array', 'global_pointing_pair_{i}.txt')],
+    'rectification_pair': [('file', 'rectified_ref.tif'), ('file', 'rectified_sec.tif'),
+                           ('array', 'H_ref.txt'), ('array', 'H_sec.txt'),
+                           ('array', 'disp_min_max.txt')],
+    'stereo_matching': [('file', 'rectified_disp.tif'), ('file', 'rectified_mask.png')],
+    'disparity_to_height': [('file', 'height_map.tif')],
+    'mean_heights': [('array', 'local_mean_heights.txt')],
+    'global_mean_heights': [('array', 'global_mean_height_pair_{i}.txt')],
+    'disparity_to_ply': [('file', 'cloud.ply'), ('array', 'cloud_bounds.txt')],
+    'heights_to_ply': [('file', 'cloud.ply'), ('array', 'cloud_bounds.txt')],
+}
+
+# config parameters that do not change the outputs
+IGNORED_CFG_KEYS = ['out_dir', 'temporary_dir', 'clean_tmp', 'clean_intermediate',
+                    'max_processes', 'max_processes_stereo_matching',
+                    'gpu_total_memory', 'omp_num_threads', 'timeout',
+                    'max_retries', 'retry_backoff', 'debug', 'mgm_timeout',
+                    'skip_unchanged_steps', 'executor', 'queue_dir',
+                    'max_memory', 'telemetry', 'profile', 'profile_steps',
+                    'keypoints_cache_dir', 'intermediate_dir',
+                    'intermediate_dir_max_size', 'tile_configs',
+                    'block_cache_size', 'block_cache_dir',
+                    'block_cache_dir_max_size', 'ingest_dir']
+
+
+def step_cfg_keys(cfg, step):
+    """
+    Return the list of config parameters used by a step (but not by the steps
+    it depends on).
+    """
+    if step in STEPS_CFG_KEYS:
+        return STEPS_CFG_KEYS[step]
+    listed = set(IGNORED_CFG_KEYS).union(*STEPS_CFG_KEYS.values())
+    return sorted(k for k in cfg if k not in listed)
+
+
+def input_file_signature(path):
+    """
+    Return the size and modification time of a file, or None if the file
+    doesn't exist.
+    """
+    try:
+        s = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return s.st_size, s.st_mtime_ns
+
+
+def cfg_value(cfg, k):
+    """
+    Return the value of a config parameter, as it is hashed in the keys.
+    """
+    if k != 'images':
+        return cfg[k]
+
+    # the RPC models are derived from the 'rpc' and 'img' entries. The input
+    # files are identified by their path, size and modification time
+    images = []
+    for img in cfg['images']:
+        img = {d: v for d, v in img.items() if d != 'rpcm'}
+        for d, v in list(img.items()):
+            if isinstance(v, str):
+                img[d] = [v, input_file_signature(v)]
+        images.append(img)
+    return images
+
+
+def step_key(cfg, step, name, input_keys):
+    """
+    Compute the key of a step.
+
+    Args:
+        cfg: config dictionary
+        step: name of the step function
+        name: name of the step output, e.g. 'pair_1/stereo_matching', that
+            identifies it in its manifest
+        input_keys: keys of the steps whose outputs are read by the step
+
+    Return:
+        hexadecimal string
+    """
+    params = {k: cfg_value(cfg, k) for k in step_cfg_keys(cfg, step) if k in cfg}
+    s = json.dumps([step, name, params, sorted(input_keys)], sort_keys=True,
+                   default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def outputs_exist(cfg, directory, step, name):
+    """
+    Tell if the outputs of a step, that the next steps read, still exist.
+
+    Args:
+        cfg: config dictionary
+        directory: directory of the manifest of the step
+        step: name of the step function
+        name: name of the step output in its manifest
+    """
+    out_dir = os.path.join(directory, os.path.dirname(name))
+    for kind, f in STEPS_OUTPUTS.get(step, []):
+        pairs = range(1, len(cfg['images'])) if '{i}' in f else [None]
+        for i in pairs:
+            path = os.path.join(out_dir, f.format(i=i))
+            if kind == 'array' and not metadata.exists(cfg, path):
+                return False
+            if kind == 'file' and not intermediate.exists(cfg, path):
+                return False
+    return True
+
+
+def read_manifest(directory):
+    """
+    Return the dictionary of the keys recorded in a directory.
+    """
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_step(directory, name, key):
+    """
+    Record the key of a step that was computed, in the manifest of a directory.
+    """
+    manifest = read_manifest(directory)
+    manifest[name] = key
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
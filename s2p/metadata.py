@@ -0,0 +1,113 @@
+"""
+Store of the small arrays of the tiles and pairs (pointing corrections, sift
+matches, homographies, disparity ranges, mean heights...).
+
+By default, each array is a text file of the tile or pair directory, written
+with np.savetxt. With cfg['metadata_db'], the arrays are records of a single
+SQLite database, out_dir/metadata.sqlite, indexed by the directory (relative
+to out_dir) and the name of their text file. The records are stored in binary
+form, so the floats round-trip exactly, and SQLite serializes the writes of
+concurrent processes. The filesystem of out_dir must support POSIX locks.
+
+At 10k tiles, this replaces hundreds of thousands of tiny files and the
+metadata operations of the filesystem that go with them.
+"""
+
+import os
+import json
+import sqlite3
+import functools
+
+import numpy as np
+
+DB_NAME = 'metadata.sqlite'
+
+
+@functools.lru_cache(maxsize=None)
+def connect(path):
+    """
+    Return a connection to a metadata database, kept open for the next calls
+    made by the same process.
+    """
+    db = sqlite3.connect(path, timeout=600, isolation_level=None,
+                         check_same_thread=False)
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('CREATE TABLE IF NOT EXISTS arrays (dir TEXT, name TEXT, dtype TEXT, '
+               'shape TEXT, data BLOB, PRIMARY KEY (dir, name))')
+    return db
+
+
+def record_key(cfg, path):
+    """
+    Return the database and the (dir, name) key of the record replacing a
+    text file of out_dir, or None if the text files are used.
+    """
+    if not cfg['metadata_db']:
+        return None
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(cfg['out_dir']))
+    d, name = os.path.split(rel)
+    db = os.path.join(os.path.abspath(cfg['out_dir']), DB_NAME)
+    if not os.path.exists(db):  # new, or removed since it was opened
+        connect.cache_clear()
+    return connect(db), (d or '.', name)
+
+
+def save(cfg, path, array, fmt='%.18e'):
+    """
+    Save an array, as np.savetxt(path, array, fmt) does.
+    """
+    record = record_key(cfg, path)
+    if record is None:
+        np.savetxt(path, array, fmt=fmt)
+        return
+    db, key = record
+    a = np.ascontiguousarray(array, dtype=float)
+    db.execute('INSERT OR REPLACE INTO arrays VALUES (?, ?, ?, ?, ?)',
+               key + (a.dtype.str, json.dumps(a.shape), a.tobytes()))
+
+
+def load(cfg, path):
+    """
+    Load an array, as np.loadtxt(path) does (its unit dimensions are
+    squeezed).
+
+    Raises:
+        OSError: if the array was not saved
+    """
+    record = record_key(cfg, path)
+    if record is None:
+        return np.loadtxt(path)
+    db, key = record
+    row = db.execute('SELECT dtype, shape, data FROM arrays WHERE dir = ? AND name = ?',
+                     key).fetchone()
+    if row is None:
+        raise FileNotFoundError('{} not found in the metadata database'.format(path))
+    dtype, shape, data = row
+    return np.frombuffer(data, dtype=dtype).reshape(json.loads(shape)).squeeze().copy()
+
+
+def exists(cfg, path):
+    """
+    Tell if an array was saved.
+    """
+    record = record_key(cfg, path)
+    if record is None:
+        return os.path.isfile(path)
+    db, key = record
+    return db.execute('SELECT 1 FROM arrays WHERE dir = ? AND name = ?',
+                      key).fetchone() is not None
+
+
+def remove(cfg, path):
+    """
+    Remove an array, if it was saved.
+    """
+    record = record_key(cfg, path)
+    if record is None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+    db, key = record
+    db.execute('DELETE FROM arrays WHERE dir = ? AND name = ?', key)
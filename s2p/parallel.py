@@ -1,13 +1,32 @@
 #!/usr/bin/env python
 # Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@polytechnique.org>
 
+from __future__ import annotations
+
 import os
 import sys
+import time
+import abc
+import uuid
+import math
+import heapq
+import pickle
+import itertools
+import signal
+import socket
+import resource
+import json
 import logging
+import contextlib
+import collections
 import multiprocessing
 import multiprocessing.context
+import multiprocessing.connection
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from s2p import common
+from s2p import profiling
 from s2p.gpu_memory_manager import GPUMemoryManager
 
 logger = logging.getLogger(__name__)
@@ -35,41 +54,139 @@ def show_progress(a):
 
 
 # this is biggest hack ever, because python's multiprocessing.Value cannot be passed to Pool.apply_async
-# so we use the initializer/initargs mechanism, and patch the arguments in tilewise_wrapper
+# so we use the initializer/initargs mechanism, and patch the arguments in tilewise_wrapper.
+# The same mechanism sends the objects shared by all the calls of a run (cfg
+# and its RPC models) only once to each worker, see worker_pool
 substituted_args = []
 INIT_ARG_SENTINEL = 'INIT_ARG_SENTINEL'
 
+# pool shared by the successive calls to launch_calls and launch_graph, and the
+# objects sent to its workers at initialization. See worker_pool
+shared_pool = None
+shared_init_args: Optional[List[Any]] = None
+
 
 def expand_initargs(*initargs):
     global substituted_args
     substituted_args = initargs
 
 
-def remap_extra_args(extra_args):
+def remap_extra_args(extra_args, init_args=None):
+    """
+    Replace the arguments that are sent to the workers at initialization by
+    references to them.
+
+    Args:
+        extra_args: arguments of a call
+        init_args: list of objects sent to the workers at initialization. The
+            GPU memory managers found in extra_args are added to it, unless it
+            is the list of a running worker_pool
+
+    Return:
+        remapped arguments, init_args
+    """
     out_args = []
-    init_args = []
+    init_args = [] if init_args is None else init_args
     for a in extra_args:
-        if isinstance(a, GPUMemoryManager):
-            out_args.append(INIT_ARG_SENTINEL)
+        # the same object may be shared by several calls: pass it only once
+        k = next((k for k, b in enumerate(init_args) if b is a), None)
+        if k is None and isinstance(a, GPUMemoryManager):
+            assert init_args is not shared_init_args, \
+                "the GPU memory manager must be given to worker_pool"
+            k = len(init_args)
             init_args.append(a)
-        else:
-            out_args.append(a)
+        out_args.append(a if k is None else (INIT_ARG_SENTINEL, k))
     return tuple(out_args), init_args
 
 
 def undo_remap_extra_args(extra_args):
     out_args = []
-    subargs = iter(substituted_args)
     for a in extra_args:
-        if a == INIT_ARG_SENTINEL:
-            out_args.append(next(subargs))
+        if isinstance(a, tuple) and len(a) == 2 and a[0] == INIT_ARG_SENTINEL:
+            out_args.append(substituted_args[a[1]])
         else:
             out_args.append(a)
     return out_args
 
 
+def call_wrapper(fun, *args):
+    return fun(*undo_remap_extra_args(args))
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the current process, in MB, since the
+    last call to reset_peak_rss.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kB on linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process (linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def measure_call(fun, *args, **kwds):
+    """
+    Call fun(*args, **kwds) and measure the resources used by the call and by
+    the subprocesses (e.g. mgm) it waited for.
+
+    Return:
+        output of fun, dictionary of measures. If fun raises an exception,
+        the measures are stored in its `s2p_measures` attribute.
+    """
+    reset_peak_rss()
+    self_0 = resource.getrusage(resource.RUSAGE_SELF)
+    children_0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    measures = {'start': time.time(),
+                'worker': '{}:{}'.format(socket.gethostname(), os.getpid())}
+
+    def measure():
+        self_1 = resource.getrusage(resource.RUSAGE_SELF)
+        children_1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        measures.update({
+            'end': time.time(),
+            'cpu_time': (self_1.ru_utime + self_1.ru_stime
+                         - self_0.ru_utime - self_0.ru_stime),
+            'children_cpu_time': (children_1.ru_utime + children_1.ru_stime
+                                  - children_0.ru_utime - children_0.ru_stime),
+            'peak_rss_mb': peak_rss(),
+            # the largest subprocess since the worker started: only meaningful
+            # if it grew during the call
+            'children_peak_rss_mb': (children_1.ru_maxrss / scale
+                                     if children_1.ru_maxrss > children_0.ru_maxrss else None),
+            # ru_oublock counts 512-byte blocks
+            'bytes_written': 512 * (self_1.ru_oublock - self_0.ru_oublock
+                                    + children_1.ru_oublock - children_0.ru_oublock),
+        })
+        return measures
+
+    try:
+        out = fun(*args, **kwds)
+    except Exception as e:
+        e.s2p_measures = measure()
+        raise
+    return out, measure()
+
+
 def tilewise_wrapper(cfg, fun, *args, stdout: str, tile_label: str, **kwargs):
-    args = undo_remap_extra_args(args)
+    cfg, *args = undo_remap_extra_args((cfg,) + args)
 
     root = logging.getLogger()
     prevhandlers = list(root.handlers)
@@ -102,7 +219,15 @@ def tilewise_wrapper(cfg, fun, *args, stdout: str, tile_label: str, **kwargs):
         root.addHandler(h)
 
     try:
-        out = fun(*args)
+        if cfg['profile'] and (not cfg['profile_steps'] or
+                               fun.__name__ in cfg['profile_steps']):
+            # the profile is written next to the log file of the tile (or pair)
+            path = os.path.join(os.path.dirname(stdout),
+                                'profile_{}.collapsed'.format(fun.__name__))
+            with profiling.sample_stacks(path, root=fun):
+                out = fun(*args)
+        else:
+            out = fun(*args)
     except Exception:
         logging.exception("Exception in %s" % fun.__name__)
         raise
@@ -127,8 +252,493 @@ def get_mp_context() -> multiprocessing.context.BaseContext:
     return multiprocessing.get_context("spawn")
 
 
+def worker_loop(conn, initializer, initargs):
+    """
+    Main function of the WorkerPool processes: run the calls received on conn,
+    one at a time, and send back (success, output or exception).
+    """
+    if hasattr(os, 'setpgid'):
+        # own process group, so that the worker can be killed with its
+        # subprocesses (e.g. a stuck mgm)
+        os.setpgid(0, 0)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            return
+        if call is None:
+            return
+        fun, args, kwds = call
+        try:
+            out = (True, fun(*args, **kwds))
+        except Exception as e:
+            out = (False, e)
+        try:
+            conn.send(out)
+        except Exception as e:  # output or exception that can not be pickled
+            conn.send((False, RuntimeError('{!r} in {}: {}'.format(out[1], fun.__name__, e))))
+
+
+class Executor(abc.ABC):
+    """
+    Runs the calls submitted by launch_graph.
+
+    The objects given at construction (init_args) are the ones replaced by
+    references in the arguments of the calls, see remap_extra_args.
+    """
+
+    @abc.abstractmethod
+    def nb_idle(self) -> int:
+        """
+        Return the number of calls that can be submitted without waiting.
+        """
+
+    @abc.abstractmethod
+    def submit(self, key, fun, args=(), kwds=None):
+        """
+        Run fun(*args, **kwds). The call is identified by key in the outputs of
+        `wait`.
+        """
+
+    @abc.abstractmethod
+    def wait(self, timeout=None) -> List[Tuple[Any, bool, Any]]:
+        """
+        Wait for at least one call to finish, or for timeout seconds.
+
+        Return:
+            list of (key, success, output or exception) of the finished calls
+        """
+
+    @abc.abstractmethod
+    def kill(self, key):
+        """
+        Interrupt a call.
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Release the resources once the current calls are finished.
+        """
+
+    @abc.abstractmethod
+    def terminate(self):
+        """
+        Interrupt the current calls and release the resources.
+        """
+
+
+class SerialExecutor(Executor):
+    """
+    Run the calls in the current process, as soon as they are submitted.
+    Timeouts can't be enforced.
+    """
+
+    def __init__(self, init_args=()):
+        expand_initargs(*init_args)
+        self.results = []
+
+    def nb_idle(self):
+        return 0 if self.results else 1
+
+    def submit(self, key, fun, args=(), kwds=None):
+        try:
+            self.results.append((key, True, fun(*args, **(kwds or {}))))
+        except Exception as e:
+            self.results.append((key, False, e))
+
+    def wait(self, timeout=None):
+        results, self.results = self.results, []
+        return results
+
+    def kill(self, key):
+        pass
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+class WorkerPool(Executor):
+    """
+    Pool of worker processes, each running one call at a time.
+
+    Unlike multiprocessing.Pool, the pool knows which worker runs which call,
+    so that a call can be interrupted by killing its worker, which is then
+    replaced by a new one. A worker dying during a call is detected too.
+    """
+
+    def __init__(self, nb_workers, init_args=(), initializer=expand_initargs):
+        self.initializer = initializer
+        self.initargs = tuple(init_args)
+        self.idle = [self._start_worker() for _ in range(nb_workers)]
+        self.busy = {}
+
+    def nb_idle(self):
+        return len(self.idle)
+
+    def _start_worker(self):
+        ctx = get_mp_context()
+        conn, child_conn = ctx.Pipe()
+        # not daemonic, so that the calls can start their own pools (e.g.
+        # merge_tiles_mp in global_dsm). The workers exit when their pipe is
+        # closed and are killed with their process group on timeout.
+        p = ctx.Process(target=worker_loop, daemon=False,
+                        args=(child_conn, self.initializer, self.initargs))
+        p.start()
+        child_conn.close()
+        return p, conn
+
+    @staticmethod
+    def _kill_worker(worker):
+        p, conn = worker
+        conn.close()
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(p.pid, signal.SIGKILL)
+            else:
+                p.kill()
+        except (ProcessLookupError, PermissionError):
+            # the worker is dead, or did not create its process group yet
+            p.kill()
+        p.join()
+
+    def submit(self, key, fun, args=(), kwds=None):
+        worker = self.idle.pop()
+        try:
+            worker[1].send((fun, args, kwds or {}))
+        except BaseException:
+            self.idle.append(worker)
+            raise
+        self.busy[key] = worker
+
+    def wait(self, timeout=None):
+        keys = {}
+        for key, (p, conn) in self.busy.items():
+            keys[conn] = key
+            keys[p.sentinel] = key
+        results = []
+        for key in set(keys[o] for o in multiprocessing.connection.wait(list(keys), timeout)):
+            p, conn = self.busy.pop(key)
+            try:
+                results.append((key,) + conn.recv())
+                self.idle.append((p, conn))
+            except (EOFError, OSError):
+                p.join()
+                results.append((key, False, RuntimeError(
+                    'worker process died with exit code {}'.format(p.exitcode))))
+                self._kill_worker((p, conn))
+                self.idle.append(self._start_worker())
+        return results
+
+    def kill(self, key):
+        """
+        Interrupt a call by killing its worker, and replace the worker.
+        """
+        self._kill_worker(self.busy.pop(key))
+        self.idle.append(self._start_worker())
+
+    def close(self):
+        """
+        Stop the workers once they have finished their current call.
+        """
+        for p, conn in self.idle + list(self.busy.values()):
+            conn.send(None)
+        for p, conn in self.idle + list(self.busy.values()):
+            p.join()
+            conn.close()
+        self.idle, self.busy = [], {}
+
+    def terminate(self):
+        """
+        Kill the workers, and the processes they launched.
+        """
+        for worker in self.idle + list(self.busy.values()):
+            self._kill_worker(worker)
+        self.idle, self.busy = [], {}
+
+
+# stands for the GPU memory managers in the init args of a FileQueueExecutor.
+# Each s2p-worker uses its own manager instead
+GPU_MEMORY_MANAGER_PLACEHOLDER = 'GPU_MEMORY_MANAGER_PLACEHOLDER'
+
+
+class FileQueueExecutor(Executor):
+    """
+    Queue of calls in a directory of a shared filesystem, run by any number of
+    `s2p-worker` processes on any number of machines (see serve_file_queue).
+
+    The calls are pickled in queue_dir/todo, claimed by the workers by moving
+    them (atomically) to queue_dir/running, and their outputs are written to
+    queue_dir/done. The paths in the arguments (config, tiles directories)
+    must be valid on all the machines.
+    """
+
+    def __init__(self, queue_dir, nb_slots, init_args=(), poll_interval=0.5):
+        """
+        Args:
+            queue_dir: path to the queue directory
+            nb_slots: maximal number of calls submitted at the same time,
+                typically the total number of processes of the workers
+            init_args: objects referenced in the arguments of the calls
+            poll_interval: delay (in seconds) between two checks of the
+                outputs of the calls
+        """
+        self.queue_dir = queue_dir
+        self.nb_slots = nb_slots
+        self.poll_interval = poll_interval
+        self.run_id = uuid.uuid4().hex
+        self.count = itertools.count()
+        self.busy = {}
+        for d in ['init', 'todo', 'running', 'done', 'cancel', 'tmp']:
+            os.makedirs(os.path.join(queue_dir, d), exist_ok=True)
+
+        init_args = [GPU_MEMORY_MANAGER_PLACEHOLDER if isinstance(a, GPUMemoryManager) else a
+                     for a in init_args]
+        self.init_path = os.path.join(queue_dir, 'init', self.run_id + '.pkl')
+        self._write(self.init_path, init_args)
+
+    def _write(self, path, obj):
+        tmp = os.path.join(self.queue_dir, 'tmp', os.path.basename(path))
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp, path)
+
+    def nb_idle(self):
+        return self.nb_slots - len(self.busy)
+
+    def submit(self, key, fun, args=(), kwds=None):
+        task_id = '{}-{:07d}.pkl'.format(self.run_id, next(self.count))
+        self._write(os.path.join(self.queue_dir, 'todo', task_id),
+                    (self.init_path, fun, args, kwds or {}))
+        self.busy[key] = task_id
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while True:
+            results = []
+            for key, task_id in list(self.busy.items()):
+                path = os.path.join(self.queue_dir, 'done', task_id)
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        results.append((key,) + pickle.load(f))
+                    os.remove(path)
+                    del self.busy[key]
+            if results or (timeout is not None and time.time() - start >= timeout):
+                return results
+            delay = self.poll_interval
+            if timeout is not None:
+                delay = min(delay, max(0, start + timeout - time.time()))
+            time.sleep(delay)
+
+    def kill(self, key):
+        task_id = self.busy.pop(key)
+        try:
+            # not claimed yet
+            os.remove(os.path.join(self.queue_dir, 'todo', task_id))
+        except FileNotFoundError:
+            open(os.path.join(self.queue_dir, 'cancel', task_id), 'w').close()
+
+    def close(self):
+        os.remove(self.init_path)
+
+    def terminate(self):
+        for key in list(self.busy):
+            self.kill(key)
+        self.close()
+
+
+def claim_task(queue_dir):
+    """
+    Claim the oldest call of a file queue.
+
+    Return:
+        name of the call file in queue_dir/running, or None if the queue is empty
+    """
+    for task_id in sorted(os.listdir(os.path.join(queue_dir, 'todo'))):
+        try:
+            os.rename(os.path.join(queue_dir, 'todo', task_id),
+                      os.path.join(queue_dir, 'running', task_id))
+        except FileNotFoundError:  # claimed by another worker
+            continue
+        return task_id
+
+
+def serve_file_queue(queue_dir, nb_workers, gpu_mem_manager=None, poll_interval=1,
+                     max_idle_time=None):
+    """
+    Run the calls of a file queue, see FileQueueExecutor.
+
+    Args:
+        queue_dir: path to the queue directory
+        nb_workers: number of calls run simultaneously
+        gpu_mem_manager: GPU memory manager used by the calls of this worker
+        poll_interval: delay (in seconds) between two checks of the queue
+        max_idle_time: stop after this time (in seconds) without any call to
+            run. None means never
+    """
+    for d in ['todo', 'running', 'done', 'cancel', 'tmp']:
+        os.makedirs(os.path.join(queue_dir, d), exist_ok=True)
+    gpu_mem_manager = gpu_mem_manager or GPUMemoryManager.make_unbounded()
+    pool = WorkerPool(nb_workers, init_args=[gpu_mem_manager])
+    init_args = {}
+    last_activity = time.time()
+
+    def write_result(task_id, result):
+        tmp = os.path.join(queue_dir, 'tmp', task_id)
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f)
+        except Exception as e:  # output or exception that can not be pickled
+            with open(tmp, 'wb') as f:
+                pickle.dump((False, RuntimeError(repr(result[1]) + ': ' + str(e))), f)
+        os.replace(tmp, os.path.join(queue_dir, 'done', task_id))
+        os.remove(os.path.join(queue_dir, 'running', task_id))
+
+    try:
+        while max_idle_time is None or pool.busy or time.time() - last_activity < max_idle_time:
+            # claim calls while some workers are idle
+            while pool.nb_idle():
+                task_id = claim_task(queue_dir)
+                if task_id is None:
+                    break
+                last_activity = time.time()
+                try:
+                    with open(os.path.join(queue_dir, 'running', task_id), 'rb') as f:
+                        init_path, fun, args, kwds = pickle.load(f)
+                    if init_path not in init_args:
+                        with open(init_path, 'rb') as f:
+                            init_args[init_path] = pickle.load(f)
+                except Exception as e:
+                    write_result(task_id, (False, e))
+                    continue
+
+                # resolve the references to the init args, except the GPU
+                # memory manager, which is the init arg of the local workers
+                local_args = []
+                for a in args:
+                    if isinstance(a, tuple) and len(a) == 2 and a[0] == INIT_ARG_SENTINEL:
+                        a = init_args[init_path][a[1]]
+                        if a == GPU_MEMORY_MANAGER_PLACEHOLDER:
+                            a = (INIT_ARG_SENTINEL, 0)
+                    local_args.append(a)
+                pool.submit(task_id, fun, tuple(local_args), kwds)
+
+            for task_id, success, output in pool.wait(poll_interval):
+                last_activity = time.time()
+                write_result(task_id, (success, output))
+
+            # interrupt the cancelled calls
+            for task_id in list(pool.busy):
+                cancel = os.path.join(queue_dir, 'cancel', task_id)
+                if os.path.exists(cancel):
+                    pool.kill(task_id)
+                    os.remove(cancel)
+                    os.remove(os.path.join(queue_dir, 'running', task_id))
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+
+
+def make_executor(name, nb_workers, init_args=(), queue_dir=None) -> Executor:
+    """
+    Return an executor given by its name: 'serial', 'local' (a WorkerPool, or
+    serial if nb_workers is 1) or 'file_queue'.
+    """
+    if name == 'file_queue':
+        return FileQueueExecutor(queue_dir, nb_workers, init_args)
+    if name == 'serial' or nb_workers == 1:
+        return SerialExecutor(init_args)
+    if name == 'local':
+        return WorkerPool(nb_workers, init_args)
+    raise ValueError("unknown executor '{}'".format(name))
+
+
+@contextlib.contextmanager
+def worker_pool(nb_workers, *init_args, executor='local', queue_dir=None):
+    """
+    Context manager starting the workers used by all the calls to launch_calls
+    and launch_graph made inside of it.
+
+    Starting a worker (spawn, then import numpy, rasterio, scipy and s2p, the
+    heavier modules and shared libraries being loaded on first use) takes a
+    while, so the same pool is used for all the
+    steps of a run instead of one pool per step.
+
+    Args:
+        nb_workers: number of worker processes
+        init_args: objects sent only once to each worker, at startup, instead
+            of with every call having them as arguments (typically the config
+            dictionary, with its RPC models, and the GPU memory manager)
+        executor: 'local', 'serial' or 'file_queue', see make_executor
+        queue_dir: directory of the queue, for the 'file_queue' executor
+    """
+    global shared_pool, shared_init_args
+    assert shared_init_args is None, "worker_pool can not be nested"
+    shared_init_args = list(init_args)
+    shared_pool = make_executor(executor, nb_workers, init_args, queue_dir)
+    try:
+        yield
+    except BaseException:
+        shared_pool.terminate()
+        raise
+    else:
+        shared_pool.close()
+    finally:
+        shared_pool = None
+        shared_init_args = None
+
+
+def tile_label_from_dir(tile_dir: str) -> str:
+    """convert:
+           /path/to/output_s2p/tiles/row_0002145_height_715/col_0000000_width_667
+       to:
+           row_0002145_height_715/col_0000000_width_667
+    """
+    root = os.path.dirname(os.path.dirname(tile_dir))
+    return tile_dir.replace(root, '')
+
+
+def tile_and_pair(x) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Return the label of the tile and the pair index of the (first positional)
+    arguments of a tilewise call, as in tile_log_and_label.
+    """
+    if type(x) == tuple and not hasattr(x[0], 'dir'):
+        pair = x[2] if len(x) >= 3 and isinstance(x[2], int) else None
+        return tile_label_from_dir(x[1].dir), pair
+    return tile_label_from_dir(x[0].dir if type(x) == tuple else x.dir), None
+
+
+def tile_log_and_label(x) -> Tuple[str, str]:
+    """
+    Return the path of the log file and the label of a tilewise call.
+
+    Args:
+        x: (first positional) arguments of the call, either a tile or a tuple
+            (cfg, tile) or (cfg, tile, pair_id)
+    """
+    if type(x) == tuple and not hasattr(x[0], 'dir'):
+        # we expect x = (cfg, tile_dictionary, ?)
+        tile_dir = x[1].dir
+        tile_label = tile_label_from_dir(tile_dir)
+        if len(x) >= 3 and isinstance(x[2], int):  # we expect x = (cfg, tile_dictionary, pair_id, ?)
+            tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
+            tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
+    else:  # we expect x = tile_dictionary or (tile_dictionary, ?)
+        tile_dir = x[0].dir if type(x) == tuple else x.dir
+        tile_label = tile_label_from_dir(tile_dir)
+
+    return os.path.join(tile_dir, 'stdout.log'), tile_label
+
+
 def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
-                 timeout=600):
+                 timeout=600, costs=None, telemetry=None):
     """
     Run a function several times in parallel with different given inputs.
 
@@ -141,93 +751,445 @@ def launch_calls(cfg, fun, list_of_args, nb_workers, *extra_args, tilewise=True,
             fun (same value for all calls)
         tilewise (bool): whether the calls are run tilewise or not
         timeout (int): timeout for each function call (in seconds)
+        costs (list): estimated cost of each call. The calls are started the
+            most expensive first, so that they don't finish last
+        telemetry (str): path to a JSONL file to which the telemetry of the
+            calls is appended, as in `launch_graph`
 
     Return:
         list of outputs
     """
-    results = []
-    outputs = []
+    tasks = []
+    for k, x in enumerate(list_of_args):
+        args = x if type(x) == tuple else (x,)
+        tasks.append(Task(fun, args + extra_args, step=fun.__name__,
+                          tilewise=tilewise, cost=costs[k] if costs else 0))
+    launch_graph(cfg, tasks, nb_workers, timeout=timeout, telemetry=telemetry)
+    return [t.output for t in tasks]
+
+
+@dataclass(eq=False)
+class Task:
+    """
+    A call of `fun` in a graph of tasks run by `launch_graph`.
+
+    The (first positional) arguments `args` follow the same conventions as the
+    items of `list_of_args` in `launch_calls`. A task returning `False` is
+    considered as failed. A task whose status is 'done' when the graph is
+    launched is not run again.
+    """
+    fun: Callable
+    args: tuple
+    step: str
+    # tasks whose output is needed. See `require` for what happens if they fail
+    deps: List[Task] = field(default_factory=list)
+    # run the task if 'all' of its deps succeeded, if 'any' of them succeeded,
+    # or regardless of their status ('none')
+    require: str = 'all'
+    # tasks that must be finished before this one starts (ordering only)
+    after: List[Task] = field(default_factory=list)
+    # extra ordering constraints, evaluated once deps and after are finished.
+    # Useful when they depend on the files written by the deps
+    late_after: Optional[Callable[[], List[Task]]] = None
+    # run the task in the main process, with args passed as they are (global steps)
+    barrier: bool = False
+    tilewise: bool = True
+    # 'pending', 'running', 'done', 'failed' (returned False), 'error' (raised
+    # an exception), 'timeout' or 'skipped'
+    status: str = 'pending'
+    # output of fun, or exception raised by the last attempt
+    output: Any = None
+    # number of times the task was started
+    attempts: int = 0
+    # called in the main process when the task is done
+    on_done: Optional[Callable[[], None]] = None
+    # estimated cost, or function returning it, called when the task is ready.
+    # The ready tasks are started the most expensive first
+    cost: Any = 0
+    # amounts of resources used by the task, e.g. {'memory': 2000} (in MB), or
+    # function returning them, called when the task is ready
+    resources: Any = None
+    # config of the job the task belongs to, used by tilewise_wrapper (the cfg
+    # given to launch_graph if None). Several jobs can share a graph
+    cfg: Optional[dict] = None
+    # the ready tasks of highest priority are started first, whatever their cost
+    priority: int = 0
+    # job the task belongs to. The workers are shared fairly between the groups
+    # of a graph
+    group: Any = None
+    # maximal running time (in seconds) of the task, instead of the timeout of
+    # launch_graph. math.inf for no limit (e.g. global steps run by a worker)
+    timeout: Optional[float] = None
+
+
+def _requirements_met(task: Task) -> bool:
+    statuses = [d.status == 'done' for d in task.deps]
+    if task.require == 'all':
+        return all(statuses)
+    if task.require == 'any':
+        return any(statuses) or not statuses
+    return True
+
+
+# maximal time (in seconds) between two calls to the new_tasks function of
+# launch_graph
+NEW_TASKS_POLL_INTERVAL = 1
+
+
+def per_step_value(value, step):
+    """
+    Return the value of a parameter given either as a single value or as a
+    dictionary of per-step values, with an optional 'default' key.
+    """
+    if isinstance(value, dict):
+        return value.get(step, value.get('default', 0))
+    return value
+
+
+def launch_graph(cfg, tasks: List[Task], nb_workers, max_tasks_per_step=None,
+                 timeout=600, max_retries=0, retry_backoff=10,
+                 raise_errors=True, resources=None, telemetry=None,
+                 new_tasks=None) -> None:
+    """
+    Run a graph of tasks, each task starting as soon as its dependencies are done.
+
+    Unlike successive calls to `launch_calls`, there is no barrier between the
+    steps: a tile flows through the pipeline independently of the others, and
+    only the barrier tasks (global steps) wait for the tasks they depend on.
+    Tasks whose requirements are not met are skipped, and so are their
+    dependents. Statuses and outputs are stored in the tasks themselves.
+
+    Among the ready tasks, the ones of highest priority are started first,
+    then the most expensive ones (longest processing time first), then the ones
+    that became ready first. When the tasks belong to several groups (jobs),
+    a group does not get more than its share of the workers while the tasks
+    of other groups of the same priority are waiting.
+
+    Args:
+        tasks: list of Task objects
+        nb_workers: number of calls run simultaneously. None means the number
+            of available cores
+        max_tasks_per_step (dict): maximal number of simultaneous calls for
+            some steps, e.g. {'stereo_matching': 4}
+        timeout (int): maximal running time (in seconds) of a task, after which
+            its worker is killed. Not enforced by the SerialExecutor
+        max_retries (int or dict): number of times a task raising an
+            exception or timing out is retried, possibly per step
+        retry_backoff (float or dict): delay (in seconds) before the first
+            retry of a task, doubled at each retry, possibly per step
+        raise_errors (bool): raise the exception of the first task that still
+            fails after its retries. Otherwise, the error is logged and the
+            dependents of the task are skipped
+        resources (dict): available amounts of some resources, e.g.
+            {'memory': 16000}. A task is started only if the resources it
+            uses are available, or if no other task is running
+        telemetry (str): path to a JSONL file to which a record (step, tile,
+            pair, status, start and end times, CPU time, peak memory, bytes
+            written...) is appended for each attempt of each task, with the
+            ids of the task and of its prerequisites in the graph. See
+            s2p.report
+        new_tasks (callable): function returning a list of tasks to add to
+            the graph, called before starting the ready tasks and at least
+            every NEW_TASKS_POLL_INTERVAL seconds. The graph is run until all
+            its tasks, including the added ones, are finished
+    """
+    nb_workers = nb_workers or multiprocessing.cpu_count()
+    max_tasks_per_step = max_tasks_per_step or {}
     show_progress.counter = 0
-    show_progress.total = len(list_of_args)
+    show_progress.total = 0
+
+    # the manager objects (and with a worker_pool, the objects shared by all
+    # the calls) are passed to the workers at initialization
+    own_pool = shared_init_args is None
+    init_args = [] if own_pool else shared_init_args
+    worker_args = {}
+    worker_cfgs = {}
+
+    # number of unfinished prerequisites of each task, and reverse edges
+    waiting = {}
+    dependents: Dict[Task, List[Task]] = collections.defaultdict(list)
+    finished = set()
+    ready = []  # heap of (-priority, -cost, index, task)
+    ready_count = itertools.count()
+
+    resources = resources or {}
+    needs: Dict[Task, Dict[str, float]] = {}
+    in_use: Dict[str, float] = collections.Counter()
+
+    running_per_step: Dict[str, int] = collections.Counter()
+    running_per_group: Dict[Any, int] = collections.Counter()
+    unfinished_per_step: Dict[str, int] = collections.Counter()
+    unfinished_per_group: Dict[Any, int] = collections.Counter()
+    group_priority: Dict[Any, int] = {}
+    deadlines: Dict[Task, float] = {}
+    retries = []  # heap of (start time, index, task)
+    nb_unfinished = 0
+
+    # identifiers of the tasks, and of their prerequisites, in the telemetry
+    graph_id = uuid.uuid4().hex[:12]
+    task_ids: Dict[Task, int] = {}
+    prerequisite_ids: Dict[Task, List[int]] = {}
+
+    def make_ready(task):
+        cost = task.cost() if callable(task.cost) else task.cost
+        needs[task] = (task.resources() if callable(task.resources) else task.resources) or {}
+        heapq.heappush(ready, (-task.priority, -cost, next(ready_count), task))
+
+    def fits(task):
+        for r, amount in needs[task].items():
+            if r in resources and in_use[r] + amount > resources[r]:
+                if not sum(running_per_step.values()):
+                    logger.warning('%s needs %s %s, more than the %s available',
+                                   label(task), amount, r, resources[r])
+                    return True
+                return False
+        return True
 
-    extra_args, init_args = remap_extra_args(extra_args)
-    if init_args:
-        # the init_args hack only work when calling tilewise_wrapper
-        assert tilewise
+    def can_start(task):
+        return (sum(running_per_step.values()) < nb_workers and pool.nb_idle() and
+                running_per_step[task.step] < max_tasks_per_step.get(task.step, nb_workers) and
+                fits(task))
 
-    def tile_label_from_dir(tile_dir: str) -> str:
-        """convert:
-               /path/to/output_s2p/tiles/row_0002145_height_715/col_0000000_width_667
-           to:
-               row_0002145_height_715/col_0000000_width_667
+    def over_share(task):
         """
-        root = os.path.dirname(os.path.dirname(tile_dir))
-        return tile_dir.replace(root, '')
+        Tell if the group of a task already uses its share of the workers.
+        """
+        competing = [g for g in unfinished_per_group if group_priority[g] >= task.priority]
+        if len(competing) < 2:
+            return False
+        return running_per_group[task.group] >= -(-nb_workers // len(competing))
 
-    if nb_workers != 1:
-        pool = get_mp_context().Pool(nb_workers, initializer=expand_initargs, initargs=init_args)
+    def add(new):
+        nonlocal nb_unfinished
+        for t in new:
+            task_ids[t] = len(task_ids)
+        for t in new:
+            prerequisite_ids[t] = sorted(task_ids[p] for p in set(t.deps) | set(t.after)
+                                         if p in task_ids)
+            prerequisites = set(t.deps) | set(t.after)
+            prerequisites -= finished
+            waiting[t] = len(prerequisites)
+            for p in prerequisites:
+                dependents[p].append(t)
+            if not t.barrier:
+                worker_args[t] = remap_extra_args(t.args, init_args)[0]
+                worker_cfgs[t] = remap_extra_args((cfg if t.cfg is None else t.cfg,),
+                                                  init_args)[0][0]
+            unfinished_per_step[t.step] += 1
+            unfinished_per_group[t.group] += 1
+            group_priority[t.group] = max(t.priority, group_priority.get(t.group, t.priority))
+        nb_unfinished += len(new)
+        show_progress.total += sum(not t.barrier for t in new)
+        for t in new:
+            if waiting[t] == 0:
+                make_ready(t)
 
-        for x in list_of_args:
-            args = tuple()
-            if type(x) == tuple:
-                args += x
-            else:
-                args += (x,)
-            args += extra_args
-            if tilewise:
-                if type(x) == tuple:
-                    # we expect x = (cfg, tile_dictionary, ?)
-                    tile_dir = x[1].dir
-                    tile_label = tile_label_from_dir(tile_dir)
-                    if len(x) == 3:  # we expect x = (cfg, tile_dictionary, pair_id)
-                        tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
-                        tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
-                else:  # we expect x = tile_dictionary
-                    tile_dir = x.dir
-                    tile_label = tile_label_from_dir(tile_dir)
-
-                log = os.path.join(tile_dir, 'stdout.log')
-                args = (cfg, fun,) + args
-                results.append(pool.apply_async(tilewise_wrapper, args=args,
-                                                kwds={'stdout': log, 'tile_label': tile_label},
-                                                callback=show_progress))
-            else:
-                results.append(pool.apply_async(fun, args=args, callback=show_progress))
+    add(tasks)
 
-        for r in results:
-            o = r.get(timeout)
-            outputs.append(o)
+    pool = shared_pool if not own_pool else make_executor('local', nb_workers, init_args)
 
-        pool.close()
-        pool.join()
+    def label(task):
+        if task.tilewise and not task.barrier:
+            return tile_log_and_label(task.args)[1]
+        return task.step
 
-    else:
-        outputs = []
-        for x in list_of_args:
-            args = tuple()
-            if type(x) == tuple:
-                args += x
-            else:
-                args += (x,)
-            args += extra_args
-            if tilewise:
-                if type(x) == tuple:
-                    # we expect x = (cfg, tile_dictionary, ?)
-                    tile_dir = x[1].dir
-                    tile_label = tile_label_from_dir(tile_dir)
-                    if len(x) == 3:  # we expect x = (cfg, tile_dictionary, pair_id)
-                        tile_dir = os.path.join(tile_dir, 'pair_%d' % x[2])
-                        tile_label = os.path.join(tile_label, 'pair_%d' % x[2])
-                else:  # we expect x = tile_dictionary
-                    tile_dir = x.dir
-                    tile_label = tile_label_from_dir(tile_dir)
-
-                log = os.path.join(tile_dir, 'stdout.log')
-                args = (cfg, fun,) + args
-                outputs.append(tilewise_wrapper(*args, stdout=log, tile_label=tile_label))
-            else:
-                outputs.append(fun(*args))
+    started: Dict[Task, float] = {}
+    telemetry_file = open(telemetry, 'a') if telemetry else None
+
+    def record(task, status, measures):
+        """
+        Append the telemetry record of an attempt of a task.
+        """
+        if telemetry_file is None:
+            return
+        # the barrier tasks are global steps, run on all the tiles
+        tile, pair = (tile_and_pair(task.args) if task.tilewise and not task.barrier
+                      else (None, None))
+        r = {'step': task.step, 'tile': tile, 'pair': pair, 'status': status,
+             'attempt': task.attempts, 'start': started.get(task), 'end': time.time(),
+             'graph': graph_id, 'id': task_ids[task], 'deps': prerequisite_ids[task]}
+        r.update(measures)
+        telemetry_file.write(json.dumps(r) + '\n')
+        telemetry_file.flush()
+
+    def submit(task):
+        if task.tilewise:
+            log, tile_label = tile_log_and_label(task.args)
+            fun = tilewise_wrapper
+            args = (worker_cfgs[task], task.fun) + worker_args[task]
+            kwds = {'stdout': log, 'tile_label': tile_label}
+        else:
+            fun = call_wrapper
+            args = (task.fun,) + worker_args[task]
+            kwds = {}
+        task.status = 'running'
+        task.attempts += 1
+        running_per_step[task.step] += 1
+        running_per_group[task.group] += 1
+        for r, amount in needs[task].items():
+            in_use[r] += amount
+        started[task] = time.time()
+        limit = timeout if task.timeout is None else task.timeout
+        if limit != math.inf:
+            deadlines[task] = started[task] + limit
+        if telemetry_file is not None:
+            fun, args = measure_call, (fun,) + args
+        pool.submit(task, fun, args, kwds)
+
+    def finish(task, status, output=None):
+        nonlocal nb_unfinished
+        if status == 'done' and task.status != 'done' and task.on_done is not None:
+            task.on_done()
+        task.status = status
+        task.output = output
+        finished.add(task)
+        nb_unfinished -= 1
+        if not task.barrier:
+            show_progress(output)
+        unfinished_per_step[task.step] -= 1
+        if unfinished_per_step[task.step] == 0:
+            logger.info('%s: done', task.step)
+        unfinished_per_group[task.group] -= 1
+        if unfinished_per_group[task.group] == 0:
+            del unfinished_per_group[task.group]
+        for d in dependents.pop(task, []):
+            waiting[d] -= 1
+            if waiting[d] == 0:
+                make_ready(d)
 
+    def wait():
+        """
+        Wait for running tasks to finish or time out, or for a retry to be due.
+        """
+        wakeup = min(list(deadlines.values()) + [r[0] for r in retries[:1]] +
+                     ([time.time() + NEW_TASKS_POLL_INTERVAL] if new_tasks else []),
+                     default=None)
+        results = []
+        if any(running_per_step.values()):
+            results = pool.wait(None if wakeup is None else max(0, wakeup - time.time()))
+        else:
+            time.sleep(max(0, wakeup - time.time()))
+        now = time.time()
+        finished = set(r[0] for r in results)
+        for task, deadline in list(deadlines.items()):
+            if task not in finished and deadline <= now:
+                pool.kill(task)
+                results.append((task, False, multiprocessing.TimeoutError(
+                    '{} timed out after {:.0f} seconds'.format(task.fun.__name__,
+                                                               deadline - started[task]))))
+        for task, _, _ in results:
+            deadlines.pop(task, None)
+        return results
+
+    try:
+        while True:
+            if new_tasks is not None:
+                add(new_tasks())
+            if not nb_unfinished:
+                break
+
+            # start the retries that are due
+            while retries and retries[0][0] <= time.time():
+                make_ready(heapq.heappop(retries)[2])
+
+            # launch all the ready tasks allowed by the per-step limits
+            postponed = []
+            unfair = []
+            while ready:
+                item = heapq.heappop(ready)
+                t = item[-1]
+                if t.late_after is not None:
+                    late_after = t.late_after()
+                    late = [p for p in late_after if p.status in ('pending', 'running')]
+                    t.late_after = None
+                    prerequisite_ids[t] = sorted(set(prerequisite_ids[t]).union(
+                        task_ids[p] for p in late_after if p in task_ids))
+                    if late:
+                        waiting[t] = len(late)
+                        for p in late:
+                            dependents[p].append(t)
+                        continue
+                if t.status == 'done':
+                    finish(t, 'done', t.output)
+                elif not _requirements_met(t):
+                    finish(t, 'skipped')
+                elif t.barrier:
+                    # run in the scheduler. Its errors are handled as those of
+                    # the workers, without retries
+                    try:
+                        if telemetry_file is not None:
+                            started[t] = time.time()
+                            output, measures = measure_call(t.fun, *t.args)
+                            record(t, 'done', measures)
+                        else:
+                            output = t.fun(*t.args)
+                    except Exception as e:
+                        record(t, 'error', getattr(e, 's2p_measures', {}))
+                        if raise_errors:
+                            raise
+                        logger.error('%s: %s', label(t), e)
+                        finish(t, 'error', e)
+                    else:
+                        finish(t, 'done', output)
+                elif not can_start(t):
+                    postponed.append(item)
+                elif over_share(t):
+                    unfair.append(item)
+                else:
+                    submit(t)
+            # the workers not used by the other groups are not left idle
+            for item in unfair:
+                if can_start(item[-1]):
+                    submit(item[-1])
+                else:
+                    postponed.append(item)
+            for p in postponed:
+                heapq.heappush(ready, p)
+
+            if not nb_unfinished:
+                continue  # the last tasks may have added new ones
+            if not sum(running_per_step.values()) and not retries:
+                raise RuntimeError('deadlock in the task graph: {} tasks can not '
+                                   'be started'.format(nb_unfinished))
+
+            for task, success, output in wait():
+                running_per_step[task.step] -= 1
+                running_per_group[task.group] -= 1
+                for r, amount in needs[task].items():
+                    in_use[r] -= amount
+                if telemetry_file is not None:
+                    if success:
+                        output, measures = output
+                        status = 'failed' if output is False else 'done'
+                    else:
+                        measures = getattr(output, 's2p_measures', {})
+                        status = 'timeout' if isinstance(output, multiprocessing.TimeoutError) else 'error'
+                    record(task, status, measures)
+                if success:
+                    finish(task, 'failed' if output is False else 'done', output)
+                elif task.attempts <= per_step_value(max_retries, task.step):
+                    delay = per_step_value(retry_backoff, task.step) * 2 ** (task.attempts - 1)
+                    logger.warning('%s: %s, retrying in %s seconds', label(task),
+                                   output, delay)
+                    task.status = 'pending'
+                    heapq.heappush(retries, (time.time() + delay, id(task), task))
+                elif raise_errors:
+                    raise output
+                else:
+                    logger.error('%s: %s', label(task), output)
+                    if isinstance(output, multiprocessing.TimeoutError):
+                        finish(task, 'timeout', output)
+                    else:
+                        finish(task, 'error', output)
+    except BaseException:
+        if own_pool:
+            pool.terminate()
+        raise
+    finally:
+        if telemetry_file is not None:
+            telemetry_file.close()
+
+    if own_pool:
+        pool.close()
 
     common.print_elapsed_time()
-    return outputs
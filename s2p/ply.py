@@ -4,6 +4,103 @@ import numpy as np
 import plyfile
 
 
+# names of the ply property types of the numpy types
+PLY_TYPES = {'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+             'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'}
+
+# numpy types of the ply property types, with their aliases
+NUMPY_TYPES = dict([(v, k) for k, v in PLY_TYPES.items()] +
+                   [('int8', 'i1'), ('uint8', 'u1'), ('int16', 'i2'),
+                    ('uint16', 'u2'), ('int32', 'i4'), ('uint32', 'u4'),
+                    ('float32', 'f4'), ('float64', 'f8')])
+
+BYTE_ORDERS = {'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+
+def read_header(path_to_ply_file):
+    """
+    Parse the header of a binary ply file whose first element is 'vertex'.
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+
+    Returns:
+        numpy structured dtype of the vertices
+        number of vertices
+        list of strings with the ply header comments
+        size of the header, in bytes
+
+    Raises:
+        ValueError: if the file is not a binary ply file, or if its vertices
+            are not its first element or have list properties
+    """
+    names, types, comments = [], [], []
+    byte_order = count = None
+    with open(path_to_ply_file, 'rb') as f:
+        if f.readline().rstrip(b'\r\n') != b'ply':
+            raise ValueError('{} is not a ply file'.format(path_to_ply_file))
+        element = None
+        for line in f:
+            words = line.decode('ascii').split()
+            if not words:
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                if words[1] not in BYTE_ORDERS:
+                    raise ValueError('{}: unsupported ply format {}'.format(
+                        path_to_ply_file, words[1]))
+                byte_order = BYTE_ORDERS[words[1]]
+            elif words[0] == 'comment':
+                comments.append(line.decode('ascii').rstrip('\r\n')[len('comment '):])
+            elif words[0] == 'element':
+                if element is None:
+                    if words[1] != 'vertex':
+                        raise ValueError('{}: the first element is not vertex'.format(
+                            path_to_ply_file))
+                    count = int(words[2])
+                element = words[1]
+            elif words[0] == 'property' and element == 'vertex':
+                if words[1] == 'list':
+                    raise ValueError('{}: list property {}'.format(path_to_ply_file,
+                                                                   words[-1]))
+                names.append(words[2])
+                types.append(NUMPY_TYPES[words[1]])
+        else:
+            raise ValueError('{}: truncated ply header'.format(path_to_ply_file))
+        offset = f.tell()
+
+    if byte_order is None or count is None:
+        raise ValueError('{}: no format or vertex element'.format(path_to_ply_file))
+    dtype = np.dtype([(n, byte_order + t) for n, t in zip(names, types)])
+    return dtype, count, comments, offset
+
+
+def read_vertices(path_to_ply_file):
+    """
+    Memory-map the vertices of a binary ply file.
+
+    The columns of the returned array (e.g. vertices['x']) are views of the
+    file: only the pages of the columns actually used are read.
+
+    Args:
+        path_to_ply_file (str): path to a .ply file
+
+    Returns:
+        numpy structured array (read-only np.memmap) of the vertices
+        list of strings with the ply header comments
+
+    Raises:
+        ValueError: if the file can't be memory-mapped (see read_header)
+    """
+    dtype, count, comments, offset = read_header(path_to_ply_file)
+    if count == 0:  # empty files can't be memory-mapped
+        return np.empty(0, dtype=dtype), comments
+    vertices = np.memmap(path_to_ply_file, dtype=dtype, mode='r', offset=offset,
+                         shape=(count,))
+    return vertices, comments
+
+
 def read_3d_point_cloud_from_ply(path_to_ply_file):
     """
     Read a 3D point cloud from a ply file and return a numpy array.
@@ -15,17 +112,45 @@ def read_3d_point_cloud_from_ply(path_to_ply_file):
         numpy array with the list of 3D points, one point per line
         list of strings with the ply header comments
     """
-    plydata = plyfile.PlyData.read(path_to_ply_file)
-    d = np.asarray(plydata['vertex'].data)
-    array = np.column_stack([d[p.name] for p in plydata['vertex'].properties])
-    return array, plydata.comments
+    try:
+        d, comments = read_vertices(path_to_ply_file)
+    except ValueError:  # e.g. an ascii ply file
+        plydata = plyfile.PlyData.read(path_to_ply_file)
+        d, comments = np.asarray(plydata['vertex'].data), plydata.comments
+    array = np.column_stack([d[name] for name in d.dtype.names])
+    return array, comments
+
+
+def bounds(vertices):
+    """
+    Return the number of vertices of a point cloud and their x, y bounds.
+
+    Args:
+        vertices: numpy structured array of the vertices, as returned by
+            read_vertices
+
+    Returns:
+        list [n, xmin, ymin, xmax, ymax], with nan bounds if n is 0
+    """
+    if len(vertices) == 0:
+        return [0] + [np.nan] * 4
+    x, y = vertices['x'], vertices['y']
+    return [len(vertices), x.min(), y.min(), x.max(), y.max()]
+
+# number of bytes of the vertices written at once
+WRITE_CHUNK_SIZE = 1 << 26
 
 
 def write_3d_point_cloud_to_ply(path_to_ply_file, coordinates, colors=None,
                                 extra_properties=None,
-                                extra_properties_names=None, comments=[]):
+                                extra_properties_names=None, comments=[],
+                                mask=None):
     """
-    Write a 3D point cloud to a ply file.
+    Write a 3D point cloud to a binary little endian ply file.
+
+    The header is written directly, followed by the vertices as a single
+    interleaved buffer, in chunks of WRITE_CHUNK_SIZE bytes. The file is the
+    same as the one written by plyfile.
 
     Args:
         path_to_ply_file (str): path to a .ply file
@@ -36,30 +161,46 @@ def write_3d_point_cloud_to_ply(path_to_ply_file, coordinates, colors=None,
         extra_properties_names (list): list of k strings with the names of the
             (optional) extra properties
         comments (list): list of strings containing the ply header comments
+        mask (array): optional boolean array of shape (n,) of the points to
+            write. It is applied column by column while interleaving, so that
+            the inputs are not copied as a whole
+
+    Returns:
+        list [n, xmin, ymin, xmax, ymax] of the number of points written and
+        their x, y bounds (see bounds)
     """
-    dtypes = [('x', coordinates.dtype),
-              ('y', coordinates.dtype),
-              ('z', coordinates.dtype)]
-    arrays = [coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]]
+    columns = [('x', coordinates[:, 0]), ('y', coordinates[:, 1]), ('z', coordinates[:, 2])]
 
     if colors is not None:
         if colors.shape[1] == 1:  # replicate grayscale 3 times
-            colors = np.column_stack([colors] * 3)
-        elif colors.shape[1] not in [3, 4]:
+            columns += [(name, colors[:, 0]) for name in ['red', 'green', 'blue']]
+        elif colors.shape[1] in [3, 4]:
+            columns += list(zip(['red', 'green', 'blue', 'ir'], colors.T))
+        else:
             raise Exception('Error: colors must have either 1, 3 or 4 channels')
-        arrays += [colors[:, 0], colors[:, 1], colors[:, 2]]
-        dtypes += [('red', colors.dtype),
-                   ('green', colors.dtype),
-                   ('blue', colors.dtype)]
-        if colors.shape[1] == 4:
-            dtypes += [('ir', colors.dtype)]
 
     if extra_properties is not None:
         if extra_properties.ndim == 1:
             extra_properties = extra_properties[..., None]
-        arrays += [extra_properties[:, i] for i in range(extra_properties.shape[1])]
-        dtypes += [(s, extra_properties.dtype) for s in extra_properties_names]
+        columns += list(zip(extra_properties_names, extra_properties.T))
+
+    # interleave the columns, in little endian
+    dtype = np.dtype([(name, c.dtype.newbyteorder('<')) for name, c in columns])
+    vertices = np.empty(len(coordinates) if mask is None else np.count_nonzero(mask),
+                        dtype=dtype)
+    for name, c in columns:
+        vertices[name] = c if mask is None else c[mask]
+
+    header = ['ply', 'format binary_little_endian 1.0']
+    header += ['comment {}'.format(c) for c in comments]
+    header += ['element vertex {}'.format(len(vertices))]
+    header += ['property {} {}'.format(PLY_TYPES[dtype[name].str[1:]], name)
+               for name in dtype.names]
+    header += ['end_header', '']
 
-    data = np.core.records.fromarrays(arrays, dtypes)
-    plydata = plyfile.PlyElement.describe(data, 'vertex')
-    plyfile.PlyData([plydata], comments=comments).write(path_to_ply_file)
+    buffer = memoryview(vertices.view(np.uint8))
+    with open(path_to_ply_file, 'wb') as f:
+        f.write('\n'.join(header).encode('ascii'))
+        for i in range(0, len(buffer), WRITE_CHUNK_SIZE):
+            f.write(buffer[i:i + WRITE_CHUNK_SIZE])
+    return bounds(vertices)
@@ -11,6 +11,7 @@ import numpy as np
 from s2p import sift
 from s2p import rpc_utils
 from s2p import estimation
+from s2p import metadata
 
 
 logger = logging.getLogger(__name__)
@@ -140,7 +141,7 @@ def compute_correction(cfg, img1, img2, rpc1, rpc2, x, y, w, h, method,
     return A, m
 
 
-def global_from_local(tiles):
+def global_from_local(cfg, tiles):
     """
     Computes the pointing correction of a full roi using local corrections on
     tiles.
@@ -154,7 +155,8 @@ def global_from_local(tiles):
     In each folder we expect to find the files pointing.txt and center.txt. The
     file pointing.txt contains the local correction (a projective transform
     given in homogeneous coordinates), and the file center.txt contains the
-    coordinates of the mean of the keypoints of the secondary image.
+    coordinates of the mean of the keypoints of the secondary image (or the
+    records of the metadata database, see s2p.metadata).
     """
     # lists of matching points
     x  = []
@@ -164,9 +166,9 @@ def global_from_local(tiles):
     for f in tiles:
         center = os.path.join(f, 'center_keypts_sec.txt')
         pointing = os.path.join(f, 'pointing.txt')
-        if os.path.isfile(center) and os.path.isfile(pointing):
-            A = np.loadtxt(pointing)
-            p = np.loadtxt(center)
+        if metadata.exists(cfg, center) and metadata.exists(cfg, pointing):
+            A = metadata.load(cfg, pointing)
+            p = metadata.load(cfg, center)
             if A.shape == (3, 3) and p.shape == (2,):
                 q = np.dot(A, np.array([p[0], p[1], 1]))
                 x.append(p)
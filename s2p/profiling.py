@@ -0,0 +1,146 @@
+"""
+Sampling profiler of the tilewise tasks.
+
+A thread samples the stack of the profiled call at regular intervals. The
+stacks are written in the collapsed format of flamegraph.pl (one line
+"outer;...;inner weight" per stack, the weight being in milliseconds), which
+is also read by speedscope. The profiles of the tasks of a step are merged by
+summing the weights of identical stacks.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+# time between two samples, in seconds
+SAMPLING_INTERVAL = 0.01
+
+
+def frame_name(frame):
+    return '{}.{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+def collapse(frame, root_code=None):
+    """
+    Return the stack of a frame as a string "outer;...;inner", starting at the
+    innermost frame running root_code if it is given.
+
+    Returns:
+        the collapsed stack, or None if root_code is given but is not running
+        in the stack (e.g. before or after the profiled call)
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        if frame.f_code is root_code:
+            break
+        frame = frame.f_back
+    else:
+        if root_code is not None:
+            return None
+    return ';'.join(reversed(names))
+
+
+@contextmanager
+def sample_stacks(path, root=None, interval=SAMPLING_INTERVAL):
+    """
+    Sample the stack of the calling thread while in the context, and write the
+    collapsed stacks to a file.
+
+    Args:
+        path: path of the output file
+        root (optional): function whose frames are the roots of the stacks.
+            The frames of its callers are left out, and so are the samples
+            taken while it is not running
+        interval: time between two samples, in seconds
+    """
+    thread_id = threading.get_ident()
+    root_code = getattr(root, '__code__', None)
+    stacks = collections.Counter()
+    done = threading.Event()
+
+    def sampler():
+        last = time.perf_counter()
+        while not done.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            now = time.perf_counter()
+            stack = collapse(frame, root_code) if frame is not None else None
+            if stack is not None:
+                # the sampler may be delayed by code holding the GIL: weight
+                # the samples by the time elapsed since the previous one
+                stacks[stack] += now - last
+            last = now
+
+    t = threading.Thread(target=sampler, daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        done.set()
+        t.join()
+        write_collapsed(path, stacks)
+
+
+def write_collapsed(path, stacks):
+    """
+    Write a dictionary of stack weights (in seconds) in the collapsed format.
+    """
+    with open(path, 'w') as f:
+        for stack, seconds in sorted(stacks.items()):
+            ms = int(round(1000 * seconds))
+            if ms:
+                f.write('{} {}\n'.format(stack, ms))
+
+
+def read_collapsed(path):
+    """
+    Read a collapsed stacks file, and return a dictionary of weights in seconds.
+    """
+    stacks = collections.Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, ms = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(ms) / 1000
+    return stacks
+
+
+def merge_profiles(directory, out_dir, since=None):
+    """
+    Merge the profiles of the tasks, found under a directory, into one file
+    per step.
+
+    The profile of a task of a step is the file named profile_<step>.collapsed
+    in its tile (or pair) directory. The merged profile is written to
+    out_dir/<step>.collapsed.
+
+    Args:
+        directory: directory searched for profiles
+        out_dir: output directory
+        since (optional): timestamp before which the profiles are ignored
+            (e.g. the ones of previous runs)
+
+    Returns:
+        list of the paths of the merged profiles
+    """
+    merged = collections.defaultdict(collections.Counter)
+    for root, _, files in os.walk(directory):
+        for f in files:
+            if not (f.startswith('profile_') and f.endswith('.collapsed')):
+                continue
+            path = os.path.join(root, f)
+            if since is not None and os.path.getmtime(path) < since:
+                continue
+            merged[f[len('profile_'):-len('.collapsed')]].update(read_collapsed(path))
+
+    paths = []
+    if merged:
+        os.makedirs(out_dir, exist_ok=True)
+    for step, stacks in sorted(merged.items()):
+        path = os.path.join(out_dir, '{}.collapsed'.format(step))
+        write_collapsed(path, stacks)
+        paths.append(path)
+    return paths
@@ -198,6 +198,10 @@ def disparity_range(cfg, rpc1, rpc2, x, y, w, h, H1, H2, matches, A=None):
     if cfg['disp_range_method'] in ['sift', 'wider_sift_exogenous']:
         if matches is not None and len(matches) >= 2:
             sift_disp = disparity_range_from_matches(matches, H1, H2, cfg['disp_range_extra_margin'])
+            # the matches found at reduced resolution are less accurate
+            f = cfg['sift_overview_factor']
+            if f > 1:
+                sift_disp = sift_disp[0] - f, sift_disp[1] + f
         else:
             sift_disp = None
         logging.info("SIFT disparity range: %s", sift_disp)
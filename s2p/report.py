@@ -0,0 +1,156 @@
+"""
+Summary of the telemetry records written by parallel.launch_graph.
+"""
+
+import collections
+import json
+import os
+
+
+def read_telemetry(path):
+    """
+    Read a telemetry file, or the telemetry.jsonl file of an output directory.
+
+    Returns:
+        list of records (dictionaries), the ones without start time excluded
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'telemetry.jsonl')
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return [r for r in records if r.get('start') is not None]
+
+
+def duration(r):
+    return r['end'] - r['start']
+
+
+def task_name(r):
+    name = r['step']
+    if r.get('tile'):
+        name += ' ' + r['tile'].strip('/')
+    if r.get('pair') is not None:
+        name += ' pair_{}'.format(r['pair'])
+    return name
+
+
+def steps_table(records):
+    """
+    Per-step number of tasks, failures, durations and span (from the start of
+    the first task to the end of the last one).
+    """
+    lines = ['{:28s} {:>6s} {:>6s} {:>10s} {:>9s} {:>9s} {:>9s} {:>10s}'.format(
+        'step', 'tasks', 'errors', 'span (s)', 'sum (s)', 'max (s)', 'cpu (s)', 'peak (MB)')]
+    by_step = collections.defaultdict(list)
+    for r in records:
+        by_step[r['step']].append(r)
+    for step, rs in sorted(by_step.items(), key=lambda x: min(r['start'] for r in x[1])):
+        cpu = sum((r.get('cpu_time') or 0) + (r.get('children_cpu_time') or 0) for r in rs)
+        peak = max(max(r.get('peak_rss_mb') or 0, r.get('children_peak_rss_mb') or 0) for r in rs)
+        lines.append('{:28s} {:6d} {:6d} {:10.1f} {:9.1f} {:9.1f} {:9.1f} {:10.0f}'.format(
+            step, len(rs), sum(r['status'] != 'done' for r in rs),
+            max(r['end'] for r in rs) - min(r['start'] for r in rs),
+            sum(duration(r) for r in rs), max(duration(r) for r in rs), cpu, peak))
+    return lines
+
+
+def critical_path(records):
+    """
+    Longest chain of tasks through their prerequisites (deps and after), each
+    task weighing the total duration of its attempts. It bounds the running
+    time of its graph, however many workers there are.
+    """
+    attempts = collections.defaultdict(list)
+    for r in records:
+        if r.get('id') is not None:
+            attempts[r.get('graph'), r['id']].append(r)
+    if not attempts:
+        return ['no task dependencies recorded']
+
+    length = {}
+    previous = {}
+
+    def longest(t):
+        """
+        Length of the longest chain ending with task t.
+        """
+        if t not in length:
+            deps = [(t[0], d) for d in attempts[t][-1].get('deps', []) if (t[0], d) in attempts]
+            previous[t] = max(deps, key=longest, default=None)
+            length[t] = sum(duration(r) for r in attempts[t]) + (
+                longest(previous[t]) if previous[t] is not None else 0)
+        return length[t]
+
+    t = max(attempts, key=longest)
+    chain = []
+    while t is not None:
+        chain.append(t)
+        t = previous[t]
+    lines = ['{:.1f}s in {} tasks:'.format(length[chain[0]], len(chain))]
+    for t in reversed(chain):
+        rs = attempts[t]
+        lines.append('{:8.1f}s  {}{}'.format(
+            sum(duration(r) for r in rs), task_name(rs[-1]),
+            ' ({} attempts)'.format(len(rs)) if len(rs) > 1 else ''))
+    return lines
+
+
+def slowest_tiles(records, top=10):
+    """
+    Tiles with the largest total duration of their tasks.
+    """
+    by_tile = collections.defaultdict(float)
+    for r in records:
+        if r.get('tile'):
+            by_tile[r['tile'].strip('/')] += duration(r)
+    tiles = sorted(by_tile.items(), key=lambda x: -x[1])[:top]
+    return ['{:8.1f}s  {}'.format(d, t) for t, d in tiles]
+
+
+def slowest_tasks(records, top=10):
+    tasks = sorted(records, key=lambda r: -duration(r))[:top]
+    return ['{:8.1f}s  {} ({})'.format(duration(r), task_name(r), r['status']) for r in tasks]
+
+
+def utilization(records, nb_bins=20, width=50):
+    """
+    Average number of running tasks over time, as a text histogram.
+    """
+    start = min(r['start'] for r in records)
+    end = max(r['end'] for r in records)
+    bin_size = max(end - start, 1e-6) / nb_bins
+    busy = [0.0] * nb_bins
+    for r in records:
+        for k in range(nb_bins):
+            b0 = start + k * bin_size
+            overlap = min(r['end'], b0 + bin_size) - max(r['start'], b0)
+            if overlap > 0:
+                busy[k] += overlap / bin_size
+    top = max(busy) or 1
+    lines = []
+    for k, b in enumerate(busy):
+        lines.append('{:8.1f}s {:6.1f} {}'.format(k * bin_size, b, '#' * int(round(width * b / top))))
+    return lines
+
+
+def summary(records, top=10):
+    """
+    Return a text summary of telemetry records.
+    """
+    if not records:
+        return 'no telemetry records'
+    start = min(r['start'] for r in records)
+    end = max(r['end'] for r in records)
+    sections = [
+        ['{} tasks in {:.1f}s'.format(len(records), end - start)],
+        ['steps:'] + steps_table(records),
+        ['critical path:'] + critical_path(records),
+        ['slowest tiles:'] + slowest_tiles(records, top),
+        ['slowest tasks:'] + slowest_tasks(records, top),
+        ['running tasks over time:'] + utilization(records),
+    ]
+    return '\n\n'.join('\n'.join(s) for s in sections)
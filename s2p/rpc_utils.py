@@ -13,6 +13,7 @@ import srtm4
 
 from s2p import geographiclib
 from s2p import common
+from s2p import block_cache
 
 
 logger = logging.getLogger(__name__)
@@ -105,7 +106,7 @@ def min_max_heights_from_bbx(im, lon_m, lon_M, lat_m, lat_M, rpc,
         hmin, hmax: min, max heights
     """
     # open image
-    dataset = rasterio.open(im, 'r')
+    dataset = common.open_dataset(im)
 
     # convert lon/lat to im projection
     x_im_proj, y_im_proj = geographiclib.pyproj_transform([lon_m, lon_M],
@@ -138,7 +139,7 @@ def min_max_heights_from_bbx(im, lon_m, lon_M, lat_m, lat_M, rpc,
 
     # get value for each pixel
     if (w != 0) and (h != 0):
-        array = dataset.read(1, window=((y0, y0 + h), (x0, x0 + w))).astype(float)
+        array = block_cache.read_window(im, ((y0, y0 + h), (x0, x0 + w)), 1).astype(float)
         array[array == -32768] = np.nan
         hmin = np.nanmin(array)
         hmax = np.nanmax(array)
@@ -0,0 +1,374 @@
+"""
+Long-running s2p service: jobs submitted over HTTP and run by a pool of
+workers kept alive from one job to the next.
+
+The workers keep their imported modules, loaded shared libraries, compiled
+numba kernels and open datasets (common.open_dataset), so that the jobs do
+not pay the start-up cost of s2p. The jobs are queued with priorities, and
+the tasks of all the running jobs are scheduled in a single graph of tasks,
+the workers being shared fairly between the jobs of the same priority (see
+parallel.launch_graph).
+
+API, on a local TCP port or Unix socket:
+
+    POST /jobs?priority=N   submit a job, the body being a config as in the
+                            json files read by s2p.read_config_file, with
+                            paths relative to the working directory of the
+                            service. Returns the id and status of the job
+    GET /jobs               status of all the jobs
+    GET /jobs/<id>          status of a job, and its number of tasks per step
+                            and per task status
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import heapq
+import logging
+import functools
+import itertools
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import s2p
+from s2p import common
+from s2p import block_cache
+from s2p import config
+from s2p import parallel
+from s2p import initialization
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(eq=False)
+class Job:
+    """
+    An s2p job submitted to the service.
+    """
+    id: str
+    cfg: dict
+    priority: int = 0
+    # 'queued', 'preparing' (computation of the tiles masks), 'running',
+    # 'done' or 'failed'
+    status: str = 'queued'
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    tasks: List[parallel.Task] = field(default_factory=list)
+
+    def summary(self, progress=False) -> dict:
+        """
+        Return the status of the job, and with progress=True its number of
+        tasks per step and per task status.
+        """
+        s = {'id': self.id, 'status': self.status, 'priority': self.priority,
+             'out_dir': self.cfg['out_dir'], 'submitted': self.submitted,
+             'started': self.started, 'finished': self.finished, 'error': self.error}
+        if progress:
+            steps: Dict[str, collections.Counter] = {}
+            for t in self.tasks:
+                steps.setdefault(t.step, collections.Counter())[t.status] += 1
+            s['progress'] = {step: dict(c) for step, c in steps.items()}
+        return s
+
+
+class Service:
+    """
+    Queue of s2p jobs, run by the pool of workers of the run method.
+
+    Args:
+        cfg: config of the service. Its execution parameters (max_processes,
+            max_processes_stereo_matching, timeout, max_retries,
+            retry_backoff, max_memory, gpu_total_memory) apply to all the
+            jobs, whose own execution parameters are ignored
+        telemetry: path to a JSONL file where the telemetry of the tasks of
+            all the jobs is written (see s2p.report)
+    """
+
+    def __init__(self, cfg=None, telemetry=None):
+        self.cfg = cfg or config.get_default_config()
+        self.telemetry = telemetry
+        self.jobs: Dict[str, Job] = {}
+        self.queue = []  # heap of (-priority, index, job)
+        self.queue_count = itertools.count()
+        # tasks of the running jobs, to add to the graph
+        self.new = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.gpu_mem_manager = None
+
+    def submit(self, user_cfg: dict, priority=0) -> Job:
+        """
+        Queue a job.
+
+        Raises:
+            ValueError: if the config is invalid, or if its out_dir is the one
+                of another unfinished job
+        """
+        if 'out_dir' not in user_cfg:
+            raise ValueError('missing out_dir')
+        user_cfg['out_dir'] = os.path.abspath(user_cfg['out_dir'])
+        cfg = config.get_default_config()
+        try:
+            initialization.build_cfg(cfg, user_cfg)
+        except (Exception, SystemExit) as e:
+            raise ValueError('invalid config: {!r}'.format(e)) from e
+
+        with self.condition:
+            if any(j.cfg['out_dir'] == cfg['out_dir'] for j in self.jobs.values()
+                   if j.status not in ('done', 'failed')):
+                raise ValueError('out_dir {} is used by another job'.format(cfg['out_dir']))
+            job = Job(uuid.uuid4().hex[:12], cfg, priority)
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-priority, next(self.queue_count), job))
+            self.condition.notify()
+        logger.info('job %s queued: %s', job.id, cfg['out_dir'])
+        return job
+
+    def stop(self):
+        """
+        Make run return once the queued and running jobs are finished.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        """
+        Run the queued jobs until stop is called.
+        """
+        block_cache.configure(self.cfg)
+        nb_workers = self.cfg['max_processes'] or multiprocessing.cpu_count()
+        nb_workers_stereo = self.cfg['max_processes_stereo_matching'] or nb_workers
+        self.gpu_mem_manager = s2p.make_gpu_mem_manager(self.cfg, nb_workers_stereo)
+
+        with parallel.worker_pool(nb_workers, self.gpu_mem_manager):
+            while True:
+                with self.condition:
+                    while not self.queue and not self.stopped:
+                        self.condition.wait()
+                    if not self.queue:
+                        break
+                # the graph runs until all the jobs, including the ones
+                # submitted meanwhile, are finished
+                parallel.launch_graph(self.cfg, [], nb_workers,
+                                      max_tasks_per_step={'stereo_matching': nb_workers_stereo},
+                                      timeout=self.cfg['timeout'],
+                                      max_retries=self.cfg['max_retries'],
+                                      retry_backoff=self.cfg['retry_backoff'],
+                                      raise_errors=False,
+                                      resources=({'memory': self.cfg['max_memory']}
+                                                 if self.cfg['max_memory'] else None),
+                                      telemetry=self.telemetry, new_tasks=self.new_tasks)
+
+    def new_tasks(self) -> List[parallel.Task]:
+        """
+        Start the queued jobs, and return the tasks to add to the graph.
+        """
+        with self.condition:
+            queued = [heapq.heappop(self.queue)[2] for _ in range(len(self.queue))]
+        for job in queued:
+            self.start(job)
+        tasks, self.new = self.new, []
+        return tasks
+
+    def add(self, job: Job, tasks: List[parallel.Task]) -> None:
+        """
+        Add tasks of a job to the graph.
+        """
+        for t in tasks:
+            t.cfg = job.cfg
+            t.group = job.id
+            t.priority = job.priority
+            if t.barrier:
+                t.fun = self.guarded(job, t.fun)
+        job.tasks = job.tasks + tasks
+        self.new += tasks
+
+    def guarded(self, job: Job, fun):
+        """
+        Wrap a function run in the main process, so that an exception fails
+        the job instead of stopping the service.
+        """
+        @functools.wraps(fun)
+        def call(*args):
+            try:
+                return fun(*args)
+            except Exception as e:
+                logger.exception('job %s: exception in %s', job.id, fun.__name__)
+                self.fail(job, '{}: {!r}'.format(fun.__name__, e))
+        return call
+
+    def fail(self, job: Job, error: str) -> None:
+        logger.error('job %s failed: %s', job.id, error)
+        job.status = 'failed'
+        job.error = job.error or error
+        job.finished = time.time()
+
+    def start(self, job: Job) -> None:
+        """
+        Start a job: list its tiles and compute their masks, as tasks of the
+        graph followed by the creation of the tiles (see create_tiles).
+        """
+        cfg = job.cfg
+        job.status = 'preparing'
+        job.started = time.time()
+        try:
+            initialization.make_dirs(cfg)
+            tw, th = initialization.adjust_tile_size(cfg)
+            roi = [cfg['roi'][k] for k in ['x', 'y', 'w', 'h']]
+            coords, neighborhood = initialization.tiles_coordinates(cfg, *roi, tw, th)
+            images_sizes = [common.open_dataset(img['img']).shape for img in cfg['images']]
+        except Exception as e:
+            logger.exception('job %s: exception in the initialization', job.id)
+            self.fail(job, repr(e))
+            return
+
+        masks = [parallel.Task(initialization.is_this_tile_useful, (cfg, *c, images_sizes),
+                               step='is_this_tile_useful', tilewise=False)
+                 for c in coords]
+        tiles = parallel.Task(self.create_tiles, (job, coords, neighborhood, masks),
+                              step='create_tiles', deps=masks, require='none', barrier=True)
+        self.add(job, masks + [tiles])
+
+    def create_tiles(self, job: Job, coords, neighborhood, masks) -> None:
+        """
+        Create the tiles of a job once their masks are computed, and add the
+        s2p steps on them to the graph.
+        """
+        cfg = job.cfg
+        if any(m.status != 'done' for m in masks):
+            self.fail(job, 'the tiles masks could not be computed')
+            return
+        tiles = initialization.create_tiles(cfg, coords, neighborhood,
+                                            [m.output for m in masks])
+        if not tiles:
+            self.fail(job, 'the ROI is not seen in two images or is totally masked')
+            return
+        initialization.write_tiles_txt(cfg, tiles, os.path.join(cfg['out_dir'], 'tiles.txt'))
+
+        # the global DSM and the files of the job are written by workers, so
+        # that the tasks of the other jobs are still dispatched meanwhile. Only
+        # the bookkeeping of the job is done by the scheduler
+        tasks = s2p.tasks_graph(cfg, tiles, self.gpu_mem_manager, global_dsm_in_worker=True)
+        files = parallel.Task(s2p.store_job_files, (cfg, job.started), step='store_job_files',
+                              deps=list(tasks), require='none', tilewise=False,
+                              timeout=math.inf)
+        end = parallel.Task(self.finish, (job, tasks), step='finish_job', deps=[files],
+                            require='none', barrier=True)
+        job.status = 'running'
+        self.add(job, tasks + [files, end])
+
+    def finish(self, job: Job, tasks: List[parallel.Task]) -> None:
+        s2p.log_failed_tasks(job.cfg, tasks)
+        if job.status == 'failed':
+            return
+        if tasks[-1].status != 'done':
+            self.fail(job, 'the DSM could not be computed')
+            return
+        job.status = 'done'
+        job.finished = time.time()
+        logger.info('job %s done in %.0f s', job.id, job.finished - job.started)
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP API of a Service, given by the service attribute of the server.
+    """
+
+    def address_string(self):
+        # the client address of a Unix socket is an empty string
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+    def reply(self, code, obj):
+        body = json.dumps(obj, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urllib.parse.urlparse(self.path).path.rstrip('/')
+        if path == '/jobs':
+            self.reply(200, [j.summary() for j in list(service.jobs.values())])
+        elif path.startswith('/jobs/') and path[6:] in service.jobs:
+            self.reply(200, service.jobs[path[6:]].summary(progress=True))
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            priority = int(query.get('priority', [0])[0])
+            user_cfg = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.server.service.submit(user_cfg, priority)
+        except ValueError as e:  # json.JSONDecodeError too
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(201, job.summary())
+
+
+class TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service: Service, address):
+    """
+    Return the HTTP server of a service.
+
+    Args:
+        address: (host, port), or path of a Unix socket
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, RequestHandler)
+    else:
+        server = TCPServer(address, RequestHandler)
+    server.service = service
+    return server
+
+
+def main(address, cfg=None, telemetry=None) -> None:
+    """
+    Serve the API of a service on an address, and run its jobs until the
+    process is interrupted.
+
+    Args:
+        address: (host, port), or path of a Unix socket
+        cfg, telemetry: see Service
+    """
+    s2p.setup_main_process()
+    service = Service(cfg, telemetry)
+    server = make_server(service, address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('s2p service listening on %s', address)
+    try:
+        service.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
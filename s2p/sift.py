@@ -4,32 +4,52 @@
 # Copyright (C) 2019, Julien Michel (CNES) <julien.michel@cnes.fr>
 
 import os
+import json
 import ctypes
+import hashlib
 import logging
 import warnings
+from typing import Any
 
 import numpy as np
 import rasterio as rio
 from numpy.ctypeslib import ndpointer
-import ransac
 
+from s2p import common
+from s2p import block_cache
 from s2p import rpc_utils
 from s2p import estimation
 
-import cv2 as cv
-cv.setNumThreads(1)
-
 logger = logging.getLogger(__name__)
 
-# Locate sift4ctypes library and raise an ImportError if it can not be
-# found This call will raise an exception if library can not be found,
-# at import time
+# Location of the sift4ctypes library. It is loaded on first use (and an
+# exception is raised then if it can not be found), as is OpenCV, so that
+# importing s2p stays fast
 
 # TODO: This is kind of ugly. Cleaner way to do this is to update
 # LD_LIBRARY_PATH, which we should do once we have a proper config file
 here = os.path.dirname(os.path.abspath(__file__))
 sift4ctypes = os.path.join(os.path.dirname(here), 'lib', 'libsift4ctypes.so')
-lib = ctypes.CDLL(sift4ctypes)
+lib: Any = None
+
+
+def load_lib() -> Any:
+    """
+    Load the sift4ctypes library, if it is not loaded yet, and return it.
+    """
+    global lib
+    if lib is None:
+        lib = ctypes.CDLL(sift4ctypes)
+    return lib
+
+
+def load_opencv() -> Any:
+    """
+    Import OpenCV, single-threaded as s2p runs several processes in parallel.
+    """
+    import cv2
+    cv2.setNumThreads(1)
+    return cv2
 
 
 # Filter warnings from rasterio reading files wihtout georeferencing
@@ -58,6 +78,8 @@ def keypoints_from_nparray(arr, thresh_dog=0.0133, nb_octaves=8, nb_scales=3, of
     if arr.shape[0] < 32 or arr.shape[1] < 32:
         return np.empty((0, 132), dtype=np.float64)
 
+    lib = load_lib()
+
     # retrieve numpy buffer dimensions
     h, w = arr.shape
 
@@ -93,7 +115,93 @@ def keypoints_from_nparray(arr, thresh_dog=0.0133, nb_octaves=8, nb_scales=3, of
     return keypoints
 
 
-def image_keypoints(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octaves=8, nb_scales=3):
+def keypoints_cache_path(cache_dir, im, *params):
+    """
+    Return the path of the file caching the keypoints computed on an image
+    with some parameters. It depends on the path, size and modification time
+    of the image, so that a modified image is not matched with stale keypoints.
+    """
+    st = os.stat(im)
+    key = json.dumps([os.path.abspath(im), st.st_size, st.st_mtime_ns] + list(params))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def write_keypoints_cache(path, **arrays):
+    """
+    Write arrays to a keypoints cache file, atomically since several
+    processes may compute the same keypoints.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def clip_roi(ds, x, y, w, h):
+    """
+    Clip a window to stay inside the boundaries of an image.
+    """
+    if x < 0:  # if x is negative then replace it with 0 and reduce w
+        w += x
+        x = 0
+    if y < 0:
+        h += y
+        y = 0
+    # if extract not completely inside the full image then resize (w, h)
+    w = min(w, ds.width - x)
+    h = min(h, ds.height - y)
+    return x, y, w, h
+
+
+def read_roi(im, x, y, w, h):
+    """
+    Read a window of an image, clipped to stay inside the image boundaries.
+
+    Returns:
+        array of shape (bands, h, w), and the (x, y) coordinates of its
+        top-left corner
+    """
+    x, y, w, h = clip_roi(common.open_dataset(im), x, y, w, h)
+    return block_cache.read_window(im, rio.windows.Window(x, y, w, h)), x, y
+
+
+def read_roi_decimated(im, x, y, w, h, factor):
+    """
+    Read a window of an image, clipped to stay inside the image boundaries,
+    at a resolution reduced by a factor. GDAL reads it from the overviews of
+    the image, if any (see s2p/ingest.py).
+
+    Returns:
+        array of shape (bands, h // factor, w // factor), and the (x, y, sx,
+        sy) parameters of the map from its pixel coordinates (i, j) to those
+        of the full image: (x + (i + 0.5) * sx - 0.5, y + (j + 0.5) * sy - 0.5)
+    """
+    ds = common.open_dataset(im)
+    x, y, w, h = clip_roi(ds, x, y, w, h)
+    # the roi computed from the RPCs may have float coordinates
+    out_shape = (ds.count, max(int(h // factor), 1), max(int(w // factor), 1))
+    array = ds.read(window=rio.windows.Window(x, y, w, h), out_shape=out_shape,
+                    resampling=rio.enums.Resampling.average)
+    return array, (x, y, w / out_shape[2], h / out_shape[1])
+
+
+def to_full_resolution(points, decimation):
+    """
+    Map the (x, y) coordinates of points detected on a window read by
+    read_roi_decimated to those of the full image, in place.
+
+    Args:
+        points: array whose two first columns are x, y coordinates
+        decimation: (x, y, sx, sy) map returned by read_roi_decimated
+    """
+    x, y, sx, sy = decimation
+    points[:, 0] = x + (points[:, 0] + 0.5) * sx - 0.5
+    points[:, 1] = y + (points[:, 1] + 0.5) * sy - 0.5
+
+
+def image_keypoints(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octaves=8, nb_scales=3,
+                    cache_dir=None, factor=1):
     """
     Runs SIFT (the keypoints detection and description only, no matching).
 
@@ -104,33 +212,43 @@ def image_keypoints(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octaves=8
         im (str): path to the input image
         max_nb (optional): maximal number of keypoints. If more keypoints are
             detected, those at smallest scales are discarded
+        cache_dir (optional): directory where the keypoints are cached, to be
+            reused by the next calls on the same image region
+        factor (optional): the keypoints are detected on the image at a
+            resolution reduced by this factor, and their coordinates are
+            mapped back to the full image
 
     Returns:
         numpy array of shape (n, 132) containing, on each row: (y, x, s, o, 128-descriptor)
     """
-    # Read file with rasterio
-    with rio.open(im) as ds:
-        # clip roi to stay inside the image boundaries
-        if x < 0:  # if x is negative then replace it with 0 and reduce w
-            w += x
-            x = 0
-        if y < 0:
-            h += y
-            y = 0
-        # if extract not completely inside the full image then resize (w, h)
-        w = min(w, ds.width - x)
-        h = min(h, ds.height - y)
-        in_buffer = ds.read(window=rio.windows.Window(x, y, w, h))
-
-    # Detect keypoints on first band
-    keypoints = keypoints_from_nparray(in_buffer[0], thresh_dog=thresh_dog,
-                                       nb_octaves=nb_octaves,
-                                       nb_scales=nb_scales, offset=(x, y))
+    if cache_dir is not None:
+        path = keypoints_cache_path(cache_dir, im, 'sift4ctypes', x, y, w, h, max_nb,
+                                    thresh_dog, nb_octaves, nb_scales,
+                                    *([factor] if factor != 1 else []))
+        if os.path.exists(path):
+            with np.load(path) as f:
+                return f['keypoints']
+
+    if factor == 1:
+        in_buffer, x, y = read_roi(im, x, y, w, h)
+
+        # Detect keypoints on first band
+        keypoints = keypoints_from_nparray(in_buffer[0], thresh_dog=thresh_dog,
+                                           nb_octaves=nb_octaves,
+                                           nb_scales=nb_scales, offset=(x, y))
+    else:
+        in_buffer, decimation = read_roi_decimated(im, x, y, w, h, factor)
+        keypoints = keypoints_from_nparray(in_buffer[0], thresh_dog=thresh_dog,
+                                           nb_octaves=nb_octaves, nb_scales=nb_scales)
+        to_full_resolution(keypoints, decimation)
+        keypoints[:, 2] *= factor
 
     # Limit number of keypoints if needed
     if max_nb is not None:
         keypoints = keypoints[:max_nb]
 
+    if cache_dir is not None:
+        write_keypoints_cache(path, keypoints=keypoints)
     return keypoints
 
 
@@ -190,6 +308,7 @@ def keypoints_match(k1, k2, method='relative', sift_thresh=0.6, F=None,
 
     # filter matches with ransac
     if model == 'fundamental' and len(matches) >= 7:
+        import ransac
         inliers = ransac.find_fundamental_matrix(matches, ntrials=1000,
                                                  max_err=ransac_max_err)[0]
         matches = matches[inliers]
@@ -202,6 +321,8 @@ def keypoints_match_from_nparray(k1, k2, method, sift_threshold,
     """
     Wrapper for the sift keypoints matching function of libsift4ctypes.so.
     """
+    lib = load_lib()
+
     # Set expected args and return types
     lib.matching.argtypes = (ndpointer(dtype=ctypes.c_float, shape=k1.shape),
                              ndpointer(dtype=ctypes.c_float, shape=k2.shape),
@@ -263,7 +384,9 @@ def matches_on_rpc_roi(cfg, im1, im2, rpc1, rpc2, x, y, w, h,
             image. (x, y) is the top-left corner, and (w, h) are the dimensions
             of the rectangle.
         method, sift_thresh, epipolar_threshold: see docstring of
-            s2p.sift.keypoints_match()
+            s2p.sift.keypoints_match(). The epipolar threshold is multiplied
+            by the overview factor when the keypoints are detected at reduced
+            resolution, as they are less accurate
 
     Returns:
         matches: 2D numpy array containing a list of matches. Each line
@@ -276,33 +399,46 @@ def matches_on_rpc_roi(cfg, im1, im2, rpc1, rpc2, x, y, w, h,
     rpc_matches = rpc_utils.matches_from_rpc(cfg, rpc1, rpc2, x, y, w, h, 5)
     F = estimation.affine_fundamental_matrix(rpc_matches)
 
-    # if less than 10 matches, lower thresh_dog. An alternative would be ASIFT
-    thresh_dog = 0.0133
-    for _ in range(2):
-        p1 = image_keypoints(im1, x, y, w, h, thresh_dog=thresh_dog)
-        p2 = image_keypoints(im2, x2, y2, w2, h2, thresh_dog=thresh_dog)
-
-        if p1.size == 0 or p2.size == 0:
+    for factor in overview_factors(cfg):
+        # if less than 10 matches, lower thresh_dog. An alternative would be ASIFT
+        thresh_dog = 0.0133
+        for _ in range(2):
+            p1 = image_keypoints(im1, x, y, w, h, thresh_dog=thresh_dog,
+                                 cache_dir=cfg['keypoints_cache_dir'], factor=factor)
+            p2 = image_keypoints(im2, x2, y2, w2, h2, thresh_dog=thresh_dog,
+                                 cache_dir=cfg['keypoints_cache_dir'], factor=factor)
+
+            if p1.size == 0 or p2.size == 0:
+                thresh_dog /= 2.0
+                continue
+
+            # the keypoints detected at reduced resolution are less accurate
+            matches = keypoints_match(p1, p2, method, sift_thresh, F,
+                                      epipolar_threshold=epipolar_threshold * factor,
+                                      model='fundamental', ransac_max_err=0.3 * factor)
+            if matches is not None and matches.ndim == 2 and matches.shape[0] > 10:
+                return matches
             thresh_dog /= 2.0
-            continue
+    logger.warning("found no matches")
+    return None
 
-        matches = keypoints_match(p1, p2, method, sift_thresh, F,
-                                  epipolar_threshold=epipolar_threshold,
-                                  model='fundamental')
-        if matches is not None and matches.ndim == 2 and matches.shape[0] > 10:
-            break
-        thresh_dog /= 2.0
-    else:
-        logger.warning("found no matches")
-        return None
-    return matches
+
+def overview_factors(cfg):
+    """
+    Return the resolution reduction factors at which the sift matches are
+    searched: cfg['sift_overview_factor'], then the full resolution if no
+    matches are found at reduced resolution.
+    """
+    factor = cfg['sift_overview_factor']
+    return [factor, 1] if factor > 1 else [1]
 
 
 
 
 
 
-def image_keypoints_cv(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octaves=8, nb_scales=3):
+def image_keypoints_cv(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octaves=8, nb_scales=3,
+                       cache_dir=None, factor=1):
     """
     Runs SIFT (the keypoints detection and description only, no matching).
 
@@ -314,28 +450,33 @@ def image_keypoints_cv(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octave
         max_nb (optional): maximal number of keypoints. If more keypoints are
             detected, those at smallest scales are discarded
 
+        cache_dir (optional): directory where the keypoints are cached, to be
+            reused by the next calls on the same image region
+        factor (optional): see image_keypoints
+
     Returns:
         (kp, des) from opencv
     """
-    # Read file with rasterio
-    with rio.open(im) as ds:
-        # clip roi to stay inside the image boundaries
-        if x < 0:  # if x is negative then replace it with 0 and reduce w
-            w += x
-            x = 0
-        if y < 0:
-            h += y
-            y = 0
-        # if extract not completely inside the full image then resize (w, h)
-        w = min(w, ds.width - x)
-        h = min(h, ds.height - y)
-        in_buffer = ds.read(window=rio.windows.Window(x, y, w, h))
+    cv = load_opencv()
+    if cache_dir is not None:
+        path = keypoints_cache_path(cache_dir, im, 'opencv', x, y, w, h, max_nb,
+                                    thresh_dog, nb_octaves, nb_scales,
+                                    *([factor] if factor != 1 else []))
+        if os.path.exists(path):
+            with np.load(path) as f:
+                kp = tuple(cv.KeyPoint(*k[:5], int(k[5]), int(k[6])) for k in f['keypoints'])
+                return kp, (f['descriptors'] if kp else None)
+
+    if factor == 1:
+        in_buffer, x, y = read_roi(im, x, y, w, h)
+        decimation = x, y, 1, 1
+    else:
+        in_buffer, decimation = read_roi_decimated(im, x, y, w, h, factor)
 
     # raise an exception if the image is flat (min=max) it has no sift points and will break the pipeline downstream 
     if np.max(in_buffer[0]) == np.min(in_buffer[0]) :
         raise Exception("The current image has no content: aborting") 
 
-    from s2p import common
 #    im_adjusted = common.linear_stretching_and_quantization_8bit ( in_buffer[0].astype(float) - cv.GaussianBlur( in_buffer[0].astype(float), (11,11), 0 ) , 0.1)
     im_adjusted = common.linear_stretching_and_quantization_8bit (in_buffer[0], 0.1)
 
@@ -349,14 +490,23 @@ def image_keypoints_cv(im, x, y, w, h, max_nb=None, thresh_dog=0.0133, nb_octave
     # keypoints = keypoints_from_nparray(in_buffer[0], thresh_dog=thresh_dog,
     #                                    nb_octaves=nb_octaves,
     #                                    nb_scales=nb_scales, offset=(x, y))
-     # apply offset
-    for i in range(len(kp1)):
-        kp1[i].pt = (kp1[i].pt[0]+x, kp1[i].pt[1]+y)
+     # apply offset (and scale)
+    if kp1:
+        pts = np.array([k.pt for k in kp1])
+        to_full_resolution(pts, decimation)
+        for k, pt in zip(kp1, pts):
+            k.pt = tuple(pt)
+            k.size *= factor
 
     # # Limit number of keypoints if needed
     # if max_nb is not None:
     #     keypoints = keypoints[:max_nb]
 
+    if cache_dir is not None:
+        keypoints = np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave,
+                               k.class_id) for k in kp1]).reshape(-1, 7)
+        write_keypoints_cache(path, keypoints=keypoints,
+                              descriptors=np.zeros((0, 128), np.float32) if des1 is None else des1)
     return kp1, des1
 
 
@@ -375,13 +525,16 @@ def matches_on_rpc_roi_cv(cfg, im1, im2, rpc1, rpc2, x, y, w, h,
             image. (x, y) is the top-left corner, and (w, h) are the dimensions
             of the rectangle.
         method, sift_thresh, epipolar_threshold: see docstring of
-            s2p.sift.keypoints_match()
+            s2p.sift.keypoints_match(). The epipolar threshold is multiplied
+            by the overview factor when the keypoints are detected at reduced
+            resolution, as they are less accurate
 
     Returns:
         matches: 2D numpy array containing a list of matches. Each line
             contains one pair of points, ordered as x1 y1 x2 y2.
             The coordinate system is that of the full images.
     """
+    cv = load_opencv()
     x2, y2, w2, h2 = rpc_utils.corresponding_roi(cfg, rpc1, rpc2, x, y, w, h)
 
     # estimate an approximate affine fundamental matrix from the rpcs
@@ -390,59 +543,69 @@ def matches_on_rpc_roi_cv(cfg, im1, im2, rpc1, rpc2, x, y, w, h,
 
     opencv_matcher = False
 
-    # if less than 10 matches, lower thresh_dog. An alternative would be ASIFT
-    thresh_dog = 0.0133
-    for _ in range(2):
-
-        kp1, des1 = image_keypoints_cv(im1, x, y, w, h, thresh_dog=thresh_dog)
-        kp2, des2 = image_keypoints_cv(im2, x2, y2, w2, h2, thresh_dog=thresh_dog)
-
-        good_matches = []
-
-        if len(kp1) >= 10 and len(kp2) >= 10:
-            if opencv_matcher:
-                # BFMatcher with default params
-                bf = cv.BFMatcher()
-                matches = bf.knnMatch(des1, des2, k=2)
-
-                # Apply ratio test manually
-                for m,n in matches:
-                    if m.distance < 0.8*n.distance:
-                        good_matches.append([m])
-                #good_matches = matches
-
-                # Select good matched keypoints
-                ref_matched_kpts = np.float32([kp1[m[0].queryIdx].pt for m in good_matches])
-                sec_matched_kpts = np.float32([kp2[m[0].trainIdx].pt for m in good_matches])
-
-                if ref_matched_kpts.shape[0] <4:
-                    logger.warning("found no matches")
-                    return None
-
-                # Compute homography using RANSAC
-                H, mask = cv.findHomography(sec_matched_kpts, ref_matched_kpts, cv.RANSAC, 5.0)
-
-                # filter the good_matchs inconsistent with the homography
-                good_matches = [good_matches[i] for i in np.where(mask.squeeze())[0]]
-
-            else:
-                # see https://github.com/opencv/opencv/issues/4554
-                # for the conversion between kp.octave and a scale
-                to_scale = lambda o: (1. / (1 << o) if o >= 0 else float(1 << -o))
-                p1 = np.asarray([
-                    (kp.pt[0], kp.pt[1], to_scale(kp.octave & 255), kp.angle, *des)
-                    for kp, des in zip(kp1, des1)], dtype=np.float32)
-                p2 = np.asarray([
-                    (kp.pt[0], kp.pt[1], to_scale(kp.octave & 255), kp.angle, *des)
-                    for kp, des in zip(kp2, des2)], dtype=np.float32)
-                good_matches = keypoints_match(p1, p2, method, sift_thresh, F,
-                                          epipolar_threshold=epipolar_threshold,
-                                          model='fundamental')
-
-
-        if len(good_matches) > 10 :
-            break
-        thresh_dog /= 2.0
+    for factor in overview_factors(cfg):
+        # if less than 10 matches, lower thresh_dog. An alternative would be ASIFT
+        thresh_dog = 0.0133
+        for _ in range(2):
+
+            kp1, des1 = image_keypoints_cv(im1, x, y, w, h, thresh_dog=thresh_dog,
+                                           cache_dir=cfg['keypoints_cache_dir'],
+                                           factor=factor)
+            kp2, des2 = image_keypoints_cv(im2, x2, y2, w2, h2, thresh_dog=thresh_dog,
+                                           cache_dir=cfg['keypoints_cache_dir'],
+                                           factor=factor)
+
+            good_matches = []
+
+            if len(kp1) >= 10 and len(kp2) >= 10:
+                if opencv_matcher:
+                    # BFMatcher with default params
+                    bf = cv.BFMatcher()
+                    matches = bf.knnMatch(des1, des2, k=2)
+
+                    # Apply ratio test manually
+                    for m,n in matches:
+                        if m.distance < 0.8*n.distance:
+                            good_matches.append([m])
+                    #good_matches = matches
+
+                    # Select good matched keypoints
+                    ref_matched_kpts = np.float32([kp1[m[0].queryIdx].pt for m in good_matches])
+                    sec_matched_kpts = np.float32([kp2[m[0].trainIdx].pt for m in good_matches])
+
+                    if ref_matched_kpts.shape[0] <4:
+                        logger.warning("found no matches")
+                        return None
+
+                    # Compute homography using RANSAC
+                    H, mask = cv.findHomography(sec_matched_kpts, ref_matched_kpts, cv.RANSAC, 5.0)
+
+                    # filter the good_matchs inconsistent with the homography
+                    good_matches = [good_matches[i] for i in np.where(mask.squeeze())[0]]
+
+                else:
+                    # see https://github.com/opencv/opencv/issues/4554
+                    # for the conversion between kp.octave and a scale
+                    to_scale = lambda o: (1. / (1 << o) if o >= 0 else float(1 << -o))
+                    p1 = np.asarray([
+                        (kp.pt[0], kp.pt[1], to_scale(kp.octave & 255), kp.angle, *des)
+                        for kp, des in zip(kp1, des1)], dtype=np.float32)
+                    p2 = np.asarray([
+                        (kp.pt[0], kp.pt[1], to_scale(kp.octave & 255), kp.angle, *des)
+                        for kp, des in zip(kp2, des2)], dtype=np.float32)
+                    # the keypoints detected at reduced resolution are less accurate
+                    good_matches = keypoints_match(p1, p2, method, sift_thresh, F,
+                                              epipolar_threshold=epipolar_threshold * factor,
+                                              model='fundamental',
+                                              ransac_max_err=0.3 * factor)
+
+
+            if len(good_matches) > 10 :
+                break
+            thresh_dog /= 2.0
+        else:
+            continue
+        break
     else:
         logging.warning("found no matches")
         return None
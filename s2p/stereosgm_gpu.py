@@ -1,4 +1,6 @@
 import os
+import ctypes
+import ctypes.util
 from typing import Any
 
 import cffi
@@ -13,6 +15,24 @@ ffi.cdef(open(os.path.join(LIB_FOLDER, "libsgmgpu.h")).read())
 
 sgmgpu: Any = ffi.dlopen(os.path.join(LIB_FOLDER, "libstereosgm.so"))
 
+# CUDA runtime, loaded when a device is selected
+cudart: Any = None
+
+
+def set_device(device: int) -> None:
+    """
+    Select the CUDA device used by the next calls to `run` in this thread.
+    """
+    global cudart
+    if cudart is None:
+        path = ctypes.util.find_library("cudart")
+        if path is None:
+            raise OSError("libcudart not found, can't select the CUDA device")
+        cudart = ctypes.CDLL(path)
+    err = cudart.cudaSetDevice(device)
+    if err != 0:
+        raise RuntimeError(f"cudaSetDevice({device}) failed with error {err}")
+
 
 def wrap(array):
     if array.dtype == np.float32:
@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass
 from typing import List, Tuple
 
@@ -8,3 +9,11 @@ class Tile:
     dir: str
     neighborhood_dirs: List[str]
     json: str
+
+
+def get_tile_dir(x, y, w, h):
+    """
+    Get the name of a tile directory
+    """
+    return os.path.join('tiles','row_{:07d}_height_{}'.format(y, h),
+                        'col_{:07d}_width_{}'.format(x, w))
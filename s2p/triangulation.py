@@ -4,6 +4,7 @@
 
 import os
 import ctypes
+from typing import Any
 from ctypes import c_int, c_float, c_double, byref, POINTER
 from numpy.ctypeslib import ndpointer
 import numpy as np
@@ -16,7 +17,19 @@ from s2p import geographiclib
 
 here = os.path.dirname(os.path.abspath(__file__))
 lib_path = os.path.join(os.path.dirname(here), 'lib', 'disp_to_h.so')
-lib = ctypes.CDLL(lib_path)
+
+# disp_to_h library, loaded on first use so that importing s2p stays fast
+lib: Any = None
+
+
+def load_lib() -> Any:
+    """
+    Load the disp_to_h library, if it is not loaded yet, and return it.
+    """
+    global lib
+    if lib is None:
+        lib = ctypes.CDLL(lib_path)
+    return lib
 
 
 class RPCStruct(ctypes.Structure):
@@ -113,6 +126,8 @@ def disp_to_xyz(rpc1, rpc2, H1, H2, disp, mask_rect, img_bbx, mask_orig, A=None,
     if A is not None:  # apply pointing correction
         H2 = np.dot(H2, np.linalg.inv(A))
 
+    lib = load_lib()
+
     # define the argument types of the disp_to_lonlatalt function from disp_to_h.so
     h, w = disp.shape
     hh, ww = mask_orig.shape
@@ -242,6 +257,8 @@ def stereo_corresp_to_xyz(rpc1, rpc2, pts1, pts2, out_crs=None):
     # get number of points to triangulate
     n = pts1.shape[0]
 
+    lib = load_lib()
+
     # define the argument types of the stereo_corresp_to_lonlatalt function from disp_to_h.so
     lib.stereo_corresp_to_lonlatalt.argtypes = (ndpointer(dtype=c_double, shape=(n, 3)),
                                                 ndpointer(dtype=c_float, shape=(n, 1)),
@@ -291,6 +308,7 @@ def remove_isolated_3d_points(xyz, r, p, n, q=1):
     h, w, d = xyz.shape
     assert d == 3, 'expecting a 3-channels image with shape (h, w, 3)'
 
+    lib = load_lib()
     lib.remove_isolated_3d_points.argtypes = (
         ndpointer(dtype=c_double, shape=(h, w, 3)),
         c_int, c_int, c_float, c_int, c_int, c_int)
@@ -370,13 +388,18 @@ def write_to_ply(path_to_ply_file, xyz, colors=None, proj_com='', confidence='')
         colors (np.array): colors image, optional
         proj_com (str): projection comment in the .ply file
         confidence (str): path to an image containig a confidence map, optional
+
+    Returns:
+        list [n, xmin, ymin, xmax, ymax] of the number of points written and
+        their x, y bounds
     """
     # flatten the xyz array into a list and remove nan points
     xyz_list = xyz.reshape(-1, 3)
     valid = np.all(np.isfinite(xyz_list), axis=1)
 
+    # the invalid points are skipped while writing, without copying the inputs
     if colors is not None:
-        colors_list = colors.transpose(1, 2, 0).reshape(-1, colors.shape[0])[valid]
+        colors_list = colors.reshape(colors.shape[0], -1).T
     else:
         colors_list = None
 
@@ -384,16 +407,17 @@ def write_to_ply(path_to_ply_file, xyz, colors=None, proj_com='', confidence='')
     if confidence != '':
         with rasterio.open(confidence, 'r') as f:
             img = f.read()
-        extra_list  = img.flatten()[valid].astype(np.float32)
+        extra_list  = img.reshape(-1).astype(np.float32, copy=False)
         extra_names = ['confidence']
     else:
         extra_list  = None
         extra_names = None
 
     # write the point cloud to a ply file
-    ply.write_3d_point_cloud_to_ply(path_to_ply_file, xyz_list[valid],
-                                    colors=colors_list,
-                                    extra_properties=extra_list,
-                                    extra_properties_names=extra_names,
-                                    comments=["created by S2P",
-                                              "projection: {}".format(proj_com)])
+    return ply.write_3d_point_cloud_to_ply(path_to_ply_file, xyz_list,
+                                           colors=colors_list,
+                                           extra_properties=extra_list,
+                                           extra_properties_names=extra_names,
+                                           comments=["created by S2P",
+                                                     "projection: {}".format(proj_com)],
+                                           mask=valid)
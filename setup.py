@@ -81,4 +81,9 @@ setup(name="s2p",
       entry_points="""
           [console_scripts]
           s2p=s2p.cli:main
+          s2p-worker=s2p.cli:worker
+          s2p-report=s2p.cli:report
+          s2p-batch=s2p.cli:batch
+          s2p-service=s2p.cli:service
+          s2p-ingest=s2p.cli:ingest
       """)
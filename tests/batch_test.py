@@ -0,0 +1,54 @@
+import os
+import shutil
+from unittest.mock import MagicMock
+
+import rpcm
+
+import s2p
+from s2p import batch
+from s2p.config import get_default_config
+from s2p.gpu_memory_manager import GPUMemoryManager
+from s2p.tile import Tile
+from tests_utils import data_path
+
+
+def test_read_rpcs(tmp_path, monkeypatch):
+    """
+    The RPC models of the images shared by several jobs are read only once.
+    """
+    images = []
+    for name in ['img_01.tif', 'img_02.tif', 'img_03.tif']:
+        images.append(str(tmp_path / name))
+        shutil.copy(data_path(os.path.join('input_triplet', name)), images[-1])
+
+    rpc_from_geotiff = MagicMock(side_effect=rpcm.rpc_from_geotiff)
+    monkeypatch.setattr(rpcm, 'rpc_from_geotiff', rpc_from_geotiff)
+
+    user_cfgs = [{'out_dir': str(tmp_path / 'a'), 'images': [{'img': images[0]}, {'img': images[1]}]},
+                 {'out_dir': str(tmp_path / 'b'), 'images': [{'img': images[0]}, {'img': images[2]}]}]
+    models = batch.read_rpcs(user_cfgs)
+
+    assert rpc_from_geotiff.call_count == 3
+    assert len(models) == 3
+    assert user_cfgs[0]['images'][0]['rpcm'] is user_cfgs[1]['images'][0]['rpcm']
+    assert user_cfgs[0]['images'][1]['rpcm'] is not user_cfgs[1]['images'][1]['rpcm']
+
+
+def test_tasks_cfg(tmp_path):
+    """
+    The tasks of the jobs sharing a graph run with the cfg of their job.
+    """
+    tasks = []
+    for name, debug in [('a', False), ('b', True)]:
+        cfg = get_default_config()
+        cfg['out_dir'] = str(tmp_path / name)
+        cfg['debug'] = debug
+        cfg['images'] = [{'img': 'img_01.tif'}, {'img': 'img_02.tif'}]
+        tile = Tile((0, 0, 10, 10), os.path.join(cfg['out_dir'], 'tiles', 'row_0', 'col_0'),
+                    [], '')
+        job_tasks = s2p.tasks_graph(cfg, [tile], GPUMemoryManager.make_unbounded(),
+                                    global_dsm_in_worker=True)
+        assert all(t.cfg is cfg for t in job_tasks)
+        tasks += job_tasks
+
+    assert [t.cfg['debug'] for t in tasks] == [False] * (len(tasks) // 2) + [True] * (len(tasks) // 2)
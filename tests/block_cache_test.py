@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from s2p import block_cache
+from s2p import common
+from s2p.config import get_default_config
+
+
+@pytest.fixture(name="raster")
+def fixture_raster(tmp_path):
+    """
+    Write a 3 bands 300x500 raster with 64x64 internal tiles.
+    """
+    path = str(tmp_path / "img.tif")
+    array = np.random.default_rng(0).integers(0, 1000, (3, 300, 500), dtype=np.uint16)
+    common.rasterio_write(path, array.transpose(1, 2, 0), {"tiled": True, "blockxsize": 64, "blockysize": 64})
+    return path, array
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_read_window(raster, tmp_path, monkeypatch, shared):
+    path, array = raster
+    cfg = get_default_config()
+    cfg['block_cache_size'] = 1  # MB, i.e. a few blocks
+    if shared:
+        cfg['block_cache_dir'] = str(tmp_path / "blocks")
+    for var in [block_cache.SIZE_VAR, block_cache.DIR_VAR, block_cache.DIR_MAX_SIZE_VAR]:
+        monkeypatch.delenv(var, raising=False)
+    block_cache.configure(cfg)
+
+    for window, indexes in [(((10, 100), (20, 300)), None),
+                            (((250, 280), (450, 499)), 2),
+                            (rasterio.windows.Window(300, 100, 100, 100), [3, 1])]:
+        if not isinstance(window, rasterio.windows.Window):
+            window = rasterio.windows.Window.from_slices(*window)
+        with rasterio.open(path) as f:
+            expected = f.read(indexes, window=window)
+        np.testing.assert_array_equal(block_cache.read_window(path, window, indexes),
+                                      expected)
+
+    # the window is clipped to the raster boundaries
+    np.testing.assert_array_equal(block_cache.read_window(path, ((-10, 20), (480, 600))),
+                                  array[:, :20, 480:])
+
+    # the cache stays within its budget, and the blocks are shared
+    assert 0 < block_cache.cache.nbytes <= 1e6
+    if shared:
+        assert os.listdir(tmp_path / "blocks")
+
+    # same reads with an empty cache of the current process
+    block_cache.cache = None
+    np.testing.assert_array_equal(block_cache.read_window(path, ((10, 100), (20, 300))),
+                                  array[:, 10:100, 20:300])
+
+
+def test_replaced_raster(raster, monkeypatch):
+    """
+    The blocks and the dataset of a replaced raster are not reused.
+    """
+    path, array = raster
+    cfg = get_default_config()
+    for var in [block_cache.SIZE_VAR, block_cache.DIR_VAR, block_cache.DIR_MAX_SIZE_VAR]:
+        monkeypatch.delenv(var, raising=False)
+    block_cache.configure(cfg)
+    np.testing.assert_array_equal(block_cache.read_window(path, ((0, 100), (0, 100))),
+                                  array[:, :100, :100])
+
+    array = array[:, ::-1]
+    common.rasterio_write(path, array.transpose(1, 2, 0), {"tiled": True, "blockxsize": 64, "blockysize": 64})
+    s = os.stat(path)
+    os.utime(path, ns=(s.st_atime_ns, s.st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(block_cache.read_window(path, ((0, 100), (0, 100))),
+                                  array[:, :100, :100])
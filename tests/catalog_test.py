@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from s2p import catalog
+from s2p import initialization
+from s2p.config import get_default_config
+
+
+def test_catalog(tmp_path):
+    """
+    Round trip of the catalog of a 3x4 grid of tiles, and neighborhoods of
+    its useful tiles.
+    """
+    coords, neighborhoods = initialization.compute_tiles_coordinates(0, 0, 1000, 700, 300, 300)
+    assert len(coords) == 12
+    useful = [k != 5 for k in range(len(coords))]  # tile (300, 300) is masked
+
+    path = str(tmp_path / catalog.CATALOG_NAME)
+    catalog.write(path, catalog.from_tiles(coords, neighborhoods, useful))
+    cat = catalog.read(path)
+
+    assert len(cat) == 12
+    np.testing.assert_array_equal(cat.coordinates[-1], (900, 600, 100, 100))
+    np.testing.assert_array_equal(cat.useful(), [k for k in range(12) if k != 5])
+    assert sorted(cat.neighbors_of(0)) == [0, 1, 4, 5]
+    assert len(cat.neighbors_of(5)) == 9
+
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path)
+    tiles = cat.tiles(cfg)
+    assert len(tiles) == 11
+    assert tiles[0].coordinates == (0, 0, 300, 300)
+    assert tiles[0].dir == os.path.join(cfg['out_dir'], 'tiles', 'row_0000000_height_300',
+                                        'col_0000000_width_300')
+    assert tiles[0].json == os.path.join('tiles', 'row_0000000_height_300',
+                                         'col_0000000_width_300', 'config.json')
+    assert sorted(tiles[0].neighborhood_dirs) == [
+        os.path.join('../../..', initialization.get_tile_dir(*c))
+        for c in [(0, 0, 300, 300), (300, 0, 300, 300), (0, 300, 300, 300)]]
+
+
+def test_tiles_txt(tmp_path):
+    """
+    tiles.txt lists the json configs of the tiles, which exist, and is not
+    written without them.
+    """
+    coords, neighborhoods = initialization.compute_tiles_coordinates(0, 0, 600, 300, 300, 300)
+    usefulnesses = [(True, np.ones((300, 300), dtype=bool)), (False, None)]
+    for tile_configs in [True, False]:
+        cfg = get_default_config()
+        cfg['out_dir'] = str(tmp_path / str(tile_configs))
+        cfg['images'] = [{'img': 'ref.tif'}, {'img': 'sec.tif'}]
+        cfg['tile_configs'] = tile_configs
+        os.makedirs(cfg['out_dir'])
+        tiles = initialization.create_tiles(cfg, coords, neighborhoods, usefulnesses)
+        tiles_txt = os.path.join(cfg['out_dir'], 'tiles.txt')
+        initialization.write_tiles_txt(cfg, tiles, tiles_txt)
+
+        if tile_configs:
+            with open(tiles_txt) as f:
+                listed = f.read().split()
+            assert listed == [tiles[0].json]
+            assert os.path.exists(os.path.join(cfg['out_dir'], listed[0]))
+        else:
+            assert not os.path.exists(tiles_txt)
+            assert not os.path.exists(os.path.join(cfg['out_dir'], tiles[0].json))
@@ -0,0 +1,24 @@
+import os
+
+import s2p
+from s2p import dry_run
+from tests_utils import data_path
+
+
+def test_estimate(tmp_path):
+    """
+    Estimate the cost of the pair test job from two of its tiles, without
+    ingesting its images.
+    """
+    cfg = s2p.read_config_file(data_path('input_pair/config.json'))
+    cfg['ingest_dir'] = str(tmp_path / 'ingest')
+    e = dry_run.estimate(cfg, nb_samples=2)
+
+    assert not os.path.exists(cfg['ingest_dir'])
+    assert e['nb_tiles'] > 2
+    assert e['nb_sampled_pairs'] == 2
+    assert 0 < e['max_disparity_range'] < 700
+    assert e['matching_time'] > 0 and e['wall_time'] > e['initialization_time']
+    assert e['worker_memory_mb'] >= e['matching_memory_mb'] > 0
+    assert all(v >= 0 for v in e['disk_bytes'].values())
+    assert 'stereo matching' in dry_run.format_estimate(e)
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from s2p import parallel
+from s2p.gpu_memory_manager import NUM_SLOTS, GPUMemoryManager, UnavailableMemoryException
+
+
+def hold(manager, megabytes, order, name, duration=0.2):
+    """
+    Reserve memory for some time, and record the order of the reservations.
+    """
+    with manager.request(megabytes) as device:
+        order.append((name, device))
+        time.sleep(duration)
+
+
+def test_fifo():
+    """
+    Check that a small request doesn't overtake a large one waiting before it.
+    """
+    manager = GPUMemoryManager.make_bounded(1000, parallel.get_mp_context())
+    order = []
+    with manager.request(800):
+        large = threading.Thread(target=hold, args=(manager, 800, order, 'large'))
+        large.start()
+        time.sleep(0.2)
+        small = threading.Thread(target=hold, args=(manager, 100, order, 'small'))
+        small.start()
+        time.sleep(0.2)
+        assert order == []
+    large.join()
+    small.join()
+
+    assert [name for name, _ in order] == ['large', 'small']
+    stats = manager.stats()
+    assert stats['requests'] == 3
+    assert stats['max_wait'] >= 0.2
+
+
+def test_many_waiters():
+    """
+    Check that more than NUM_SLOTS requests waiting at the same time are all
+    served.
+    """
+    manager = GPUMemoryManager.make_bounded(100, parallel.get_mp_context())
+    order = []
+    threads = [threading.Thread(target=hold, args=(manager, 50, order, i, 0.01),
+                                daemon=True)
+               for i in range(NUM_SLOTS + 10)]
+    with manager.request(50):
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+    for t in threads:
+        t.join(timeout=60)
+
+    assert not any(t.is_alive() for t in threads)
+    assert len(order) == NUM_SLOTS + 10
+
+
+def hold_forever(manager, megabytes, started):
+    """
+    Reserve memory, then take the lock of the manager, and never return.
+    """
+    with manager.request(megabytes):
+        with manager.lock:
+            started.set()
+            time.sleep(3600)
+
+
+def test_killed_holder():
+    """
+    Check that the lock and the tokens of a killed process are given back.
+    """
+    ctx = parallel.get_mp_context()
+    manager = GPUMemoryManager.make_bounded(1000, ctx)
+    started = ctx.Event()
+    p = ctx.Process(target=hold_forever, args=(manager, 800, started))
+    p.start()
+    assert started.wait(timeout=60)
+    p.kill()
+    p.join()
+
+    order = []
+    t = threading.Thread(target=hold, args=(manager, 800, order, 'after', 0),
+                         daemon=True)
+    t.start()
+    t.join(timeout=30)
+    assert order == [('after', 0)]
+
+
+def test_least_loaded_device():
+    """
+    Check that the requests are sent to the least loaded device.
+    """
+    manager = GPUMemoryManager.make_bounded([1000, 2000], parallel.get_mp_context())
+    with manager.request(500) as first:
+        with manager.request(500) as second:
+            with manager.request(900) as third:
+                assert (first, second, third) == (1, 0, 1)
+
+    with pytest.raises(UnavailableMemoryException):
+        with manager.request(3000):
+            pass
+
+
+def test_unbounded():
+    manager = GPUMemoryManager.make_unbounded()
+    with manager.request(10 ** 6) as device:
+        assert device is None
+
+
+def test_nb_devices():
+    """
+    The stereo matching only switches devices when there are several.
+    """
+    ctx = parallel.get_mp_context()
+    assert GPUMemoryManager.make_unbounded().nb_devices() == 1
+    assert GPUMemoryManager.make_bounded(1000, ctx).nb_devices() == 1
+    assert GPUMemoryManager.make_bounded([1000, 2000], ctx).nb_devices() == 2
@@ -0,0 +1,44 @@
+import sys
+import json
+import subprocess
+
+# modules that are slow to import, loaded by s2p on first use only
+LAZY_MODULES = ['cv2', 'numba', 'plyflatten', 'rasterio.merge', 'ransac',
+                'distutils', 's2p.specklefilter', 's2p.stereosgm_gpu']
+
+# shared libraries, loaded on first use only
+LAZY_LIBRARIES = ['s2p.homography.homography', 's2p.sift.lib', 's2p.triangulation.lib']
+
+# generous bound on the import time, in seconds, to catch a heavy module
+# imported again at the top level of a module
+MAX_IMPORT_TIME = 3
+
+
+def import_s2p():
+    """
+    Import s2p in a new interpreter, and return the import time and the list
+    of the loaded modules and libraries.
+    """
+    code = '\n'.join([
+        'import sys, time, json',
+        't = time.perf_counter()',
+        'import s2p',
+        't = time.perf_counter() - t',
+        'libs = [l for l in {} if eval(l) is not None]'.format(LAZY_LIBRARIES),
+        'print(json.dumps({"time": t, "modules": list(sys.modules), "libraries": libs}))',
+    ])
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def test_lazy_imports():
+    out = import_s2p()
+    assert [m for m in LAZY_MODULES if m in out['modules']] == []
+    assert out['libraries'] == []
+
+
+def test_import_time():
+    t = min(import_s2p()['time'] for _ in range(3))
+    print('import s2p: {:.3f} s'.format(t))
+    assert t < MAX_IMPORT_TIME
@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import numpy as np
+import rasterio
+import rpcm
+
+from s2p import ingest
+from tests_utils import data_path
+
+
+def test_ingest(tmp_path):
+    """
+    Convert the strip-organized images of a pair, then reuse the converted
+    images for another job.
+    """
+    srcs = []
+    for name in ["img_01.tif", "img_02.tif"]:
+        shutil.copy(data_path(os.path.join("input_pair", name)), tmp_path / name)
+        srcs.append(str(tmp_path / name))
+    ingest_dir = str(tmp_path / "ingest")
+    user_cfg = {"images": [{"img": srcs[0], "clr": None}, {"img": srcs[1]}]}
+
+    mapping = ingest.ingest(user_cfg, ingest_dir, nb_workers=2)
+    assert sorted(mapping) == srcs
+    for src, img in zip(srcs, user_cfg["images"]):
+        dst = img["img"]
+        assert dst == mapping[src]
+        assert os.path.dirname(dst) == ingest_dir
+        assert ingest.is_ingested(dst)
+        with rasterio.open(src) as f, rasterio.open(dst) as g:
+            assert g.block_shapes[0] == (ingest.BLOCK_SIZE, ingest.BLOCK_SIZE)
+            assert g.overviews(1) == [2, 4]
+            np.testing.assert_array_equal(f.read(), g.read())
+        assert rpcm.rpc_from_geotiff(dst).__dict__ == rpcm.rpc_from_geotiff(src).__dict__
+
+    # the converted images are reused, and not converted again
+    mtimes = [os.stat(p).st_mtime_ns for p in mapping.values()]
+    user_cfg = {"images": [{"img": srcs[0]}, {"img": srcs[1]}]}
+    assert ingest.ingest(user_cfg, ingest_dir, nb_workers=1) == mapping
+    assert [os.stat(p).st_mtime_ns for p in mapping.values()] == mtimes
+
+    # as well as the images that are already tiled with overviews
+    assert ingest.ingest_image(mapping[srcs[0]], ingest_dir) == mapping[srcs[0]]
@@ -3,6 +3,7 @@ import os
 import shutil
 from unittest.mock import MagicMock
 
+import numpy as np
 import rasterio
 import rpcm
 
@@ -146,3 +147,45 @@ def test_roi_geojson(data):
 
     s2p.initialization.build_cfg(cfg, user_cfg)
     assert user_cfg["roi"] == {'x': 150, 'y': 150, 'w': 700, 'h': 700}
+
+
+def test_adaptive_tiling():
+    """
+    The tiles are smaller where the relief is higher, and their neighborhoods
+    are the tiles they touch.
+    """
+    # disparity range due to the relief: hills, with a mountain in the top
+    # left corner and a plain on the right
+    disp = np.full((1000, 2000), 60)
+    disp[:500, :500] = 200
+    disp[:, 1500:] = 0
+
+    def relief(x, y, w, h):
+        return disp[y:y + h, x:x + w].max()
+
+    coords, neighborhoods = s2p.initialization.compute_adaptive_tiles_coordinates(
+        0, 0, 2000, 1000, 250, 250, relief)
+
+    # the tiles partition the ROI
+    covered = np.zeros((1000, 2000), dtype=int)
+    for x, y, w, h in coords:
+        covered[y:y + h, x:x + w] += 1
+    assert (covered == 1).all()
+
+    sizes = {(x, y): w for x, y, w, h in coords}
+    assert sizes[0, 0] < 250
+    assert sizes[1500, 0] > 250
+    assert sizes[500, 500] == 250
+
+    for t in coords:
+        x, y, w, h = t
+        assert t in neighborhoods[str(t)]
+        for x2, y2, w2, h2 in neighborhoods[str(t)]:
+            assert x2 <= x + w and x2 + w2 >= x and y2 <= y + h and y2 + h2 >= y
+            assert t in neighborhoods[str((x2, y2, w2, h2))]
+
+    # with a uniform relief, the grid is the regular one
+    coords, _ = s2p.initialization.compute_adaptive_tiles_coordinates(
+        0, 0, 2000, 1000, 250, 250, lambda *_: 10)
+    assert sorted(coords) == sorted(s2p.initialization.compute_tiles_coordinates(
+        0, 0, 2000, 1000, 250, 250)[0])
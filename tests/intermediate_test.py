@@ -0,0 +1,45 @@
+import os
+
+from s2p import intermediate
+from s2p.config import get_default_config
+
+
+def test_intermediate_store(tmp_path):
+    """
+    The intermediate files of the tiles admitted while the store is not full
+    are written in the store, and moved to out_dir when their tile is done.
+    """
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path / 'out')
+    cfg['intermediate_dir'] = str(tmp_path / 'shm')
+    cfg['intermediate_dir_max_size'] = 1e-3  # 1 kB
+    tile = os.path.join(cfg['out_dir'], 'tiles', 'row_0000000_height_100', 'col_0000000_width_100')
+    os.makedirs(tile)
+
+    disp = intermediate.path(cfg, os.path.join(tile, 'pair_1', 'rectified_disp.tif'))
+    assert disp.startswith(cfg['intermediate_dir'])
+    with open(disp, 'wb') as f:
+        f.write(b'0' * 2000)
+    assert intermediate.path(cfg, os.path.join(tile, 'pair_1', 'rectified_disp.tif')) == disp
+
+    # the store is full, but the tile is already in it
+    mask = intermediate.path(cfg, os.path.join(tile, 'mask.tif'))
+    assert mask.startswith(cfg['intermediate_dir'])
+
+    # the store is full: the files of the other tiles are in out_dir
+    other_tile = os.path.join(cfg['out_dir'], 'tiles', 'row_0000000_height_100',
+                              'col_0000100_width_100')
+    other_mask = os.path.join(other_tile, 'mask.tif')
+    assert intermediate.path(cfg, other_mask) == other_mask
+
+    # outside of out_dir
+    other = str(tmp_path / 'other.tif')
+    assert intermediate.path(cfg, other) == other
+
+    intermediate.persist(cfg, tile)
+    assert os.path.getsize(os.path.join(tile, 'pair_1', 'rectified_disp.tif')) == 2000
+    assert not os.path.exists(disp)
+    assert intermediate.size(intermediate.root(cfg)) == 0
+
+    cfg['intermediate_dir'] = None
+    assert intermediate.path(cfg, other_mask) == other_mask
@@ -0,0 +1,78 @@
+import os
+
+from s2p import manifest
+from s2p import metadata
+from s2p import intermediate
+from s2p.config import get_default_config
+
+
+def test_step_key_invalidation():
+    """
+    Check that changing a parameter changes the keys of the steps using it,
+    and of the steps depending on them only.
+    """
+    cfg = get_default_config()
+    cfg['images'] = [{'img': 'img_01.tif'}, {'img': 'img_02.tif'}]
+
+    def keys(cfg):
+        pointing = manifest.step_key(cfg, 'pointing_correction', 'pair_1/pointing_correction', [])
+        matching = manifest.step_key(cfg, 'stereo_matching', 'pair_1/stereo_matching', [pointing])
+        dsm = manifest.step_key(cfg, 'plys_to_dsm', 'plys_to_dsm', [matching])
+        return pointing, matching, dsm
+
+    pointing, matching, dsm = keys(cfg)
+    assert keys(cfg) == (pointing, matching, dsm)
+
+    cfg['dsm_resolution'] = 0.5
+    assert keys(cfg) == (pointing, matching, keys(cfg)[2])
+    assert keys(cfg)[2] != dsm
+
+    cfg['census_ncc_win'] = 3
+    assert keys(cfg)[0] == pointing and keys(cfg)[1] != matching
+
+    cfg['max_processes'] = 3
+    assert keys(cfg)[0] == pointing
+
+    cfg['sift_match_thresh'] = 0.5
+    assert keys(cfg)[0] != pointing
+
+
+def test_record_step(tmp_path):
+    """
+    Check that the recorded keys are read back.
+    """
+    manifest.record_step(str(tmp_path), 'pair_1/stereo_matching', 'abc')
+    manifest.record_step(str(tmp_path), 'plys_to_dsm', 'def')
+    assert manifest.read_manifest(str(tmp_path)) == {'pair_1/stereo_matching': 'abc',
+                                                     'plys_to_dsm': 'def'}
+    assert manifest.read_manifest(str(tmp_path / 'missing')) == {}
+
+
+def test_outputs_exist(tmp_path):
+    """
+    Check that a step is not considered done when the outputs read by the
+    next steps were removed, in out_dir or in the intermediate store.
+    """
+    cfg = get_default_config()
+    cfg['images'] = [{'img': 'img_01.tif'}, {'img': 'img_02.tif'}, {'img': 'img_03.tif'}]
+    cfg['out_dir'] = str(tmp_path / 'out')
+    cfg['intermediate_dir'] = str(tmp_path / 'store')
+    tile = os.path.join(cfg['out_dir'], 'tiles', 'row_0', 'col_0')
+    os.makedirs(os.path.join(tile, 'pair_1'))
+
+    assert not manifest.outputs_exist(cfg, tile, 'stereo_matching', 'pair_1/stereo_matching')
+    open(os.path.join(tile, 'pair_1', 'rectified_disp.tif'), 'w').close()
+    stored = intermediate.path(cfg, os.path.join(tile, 'pair_1', 'rectified_mask.png'))
+    assert stored.startswith(cfg['intermediate_dir'])
+    open(stored, 'w').close()
+    assert manifest.outputs_exist(cfg, tile, 'stereo_matching', 'pair_1/stereo_matching')
+
+    metadata.save(cfg, os.path.join(cfg['out_dir'], 'global_pointing_pair_1.txt'), [0])
+    assert not manifest.outputs_exist(cfg, cfg['out_dir'], 'global_pointing_correction',
+                                      'global_pointing_correction')
+    metadata.save(cfg, os.path.join(cfg['out_dir'], 'global_pointing_pair_2.txt'), [0])
+    assert manifest.outputs_exist(cfg, cfg['out_dir'], 'global_pointing_correction',
+                                  'global_pointing_correction')
+
+    # the outputs of plys_to_dsm are optional
+    assert manifest.outputs_exist(cfg, tile, 'plys_to_dsm', 'plys_to_dsm')
@@ -0,0 +1,83 @@
+import os
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import s2p
+from s2p import metadata
+from s2p import parallel
+from s2p.config import get_default_config
+
+
+def write_records(cfg, k):
+    """
+    Save arrays in the pair directories of a tile.
+    """
+    for i in range(20):
+        metadata.save(cfg, os.path.join(cfg['out_dir'], 'tile_{}'.format(k),
+                                        'pair_{}'.format(i), 'H_ref.txt'), np.eye(3) * k)
+
+
+@pytest.mark.parametrize('db', [False, True])
+def test_metadata(tmp_path, db):
+    """
+    The arrays are loaded as np.loadtxt does, and exactly with the database.
+    """
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path)
+    cfg['metadata_db'] = db
+    os.makedirs(tmp_path / 'pair_1')
+    path = str(tmp_path / 'pair_1' / 'sift_matches.txt')
+
+    m = np.random.default_rng(0).random((1, 4)) * 1000
+    assert not metadata.exists(cfg, path)
+    with pytest.raises(OSError):
+        metadata.load(cfg, path)
+    metadata.save(cfg, path, m, fmt='%9.3f')
+    assert metadata.exists(cfg, path)
+    loaded = metadata.load(cfg, path)
+    assert loaded.shape == (4,)
+    if db:
+        np.testing.assert_array_equal(loaded, m[0])
+        assert not os.path.exists(path)
+    else:
+        np.testing.assert_allclose(loaded, m[0], atol=1e-3)
+    metadata.remove(cfg, path)
+    assert not metadata.exists(cfg, path)
+
+
+def test_metadata_concurrent_writers(tmp_path):
+    """
+    Several processes write in the same database.
+    """
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path)
+    cfg['metadata_db'] = True
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        pool.starmap(write_records, [(cfg, k) for k in range(8)])
+    for k in range(8):
+        for i in range(20):
+            np.testing.assert_array_equal(
+                metadata.load(cfg, os.path.join(cfg['out_dir'], 'tile_{}'.format(k),
+                                                'pair_{}'.format(i), 'H_ref.txt')),
+                np.eye(3) * k)
+
+
+@pytest.mark.parametrize('db', [False, True])
+def test_pointing_fallback(tmp_path, db):
+    """
+    The rectification waits for the global pointing correction only if the
+    local one was not saved.
+    """
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path)
+    cfg['metadata_db'] = db
+    tile = s2p.initialization.create_tile(cfg, (0, 0, 300, 300), {})
+    os.makedirs(os.path.join(tile.dir, 'pair_1'))
+    global_pointing = parallel.Task(print, (), step='global_pointing', barrier=True)
+    late_after = s2p._pointing_fallback(cfg, tile, 1, global_pointing)
+
+    assert late_after() == [global_pointing]
+    metadata.save(cfg, os.path.join(tile.dir, 'pair_1', 'pointing.txt'), np.eye(3))
+    assert late_after() == []
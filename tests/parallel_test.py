@@ -1,10 +1,18 @@
+import os
+import math
 import time
+import threading
 import subprocess
 
+import numpy as np
 import pytest
+import rasterio
 
+import s2p
 from s2p import parallel
+from s2p import report
 from s2p.config import get_default_config
+from s2p.tile import Tile
 
 
 def raise_exception(t, e):
@@ -23,3 +31,285 @@ def test_launch_calls_error():
     with pytest.raises(subprocess.CalledProcessError):
         parallel.launch_calls(cfg, raise_exception, [1, 1, 1, 1], 2,
                               subprocess.CalledProcessError(1, "failcmd"), tilewise=False)
+
+
+def record(calls, name, ok=True):
+    """
+    Append name to the list calls, and return ok.
+    """
+    calls.append(name)
+    return ok
+
+
+def test_launch_graph_order_and_skip():
+    """
+    Run a small graph of tasks and check that the dependencies are respected
+    and that the dependents of a failed task are skipped.
+    """
+    cfg = get_default_config()
+    calls = []
+    a = parallel.Task(record, (calls, 'a'), step='a', tilewise=False)
+    b = parallel.Task(record, (calls, 'b', False), step='b', deps=[a], tilewise=False)
+    c = parallel.Task(record, (calls, 'c'), step='c', deps=[b], tilewise=False)
+    d = parallel.Task(record, (calls, 'd'), step='d', deps=[b, c], require='none',
+                      barrier=True)
+    parallel.launch_graph(cfg, [d, c, b, a], 1)
+
+    assert calls == ['a', 'b', 'd']
+    assert [t.status for t in (a, b, c, d)] == ['done', 'failed', 'skipped', 'done']
+
+
+def test_launch_graph_barrier_error(tmp_path):
+    """
+    The error of a barrier task is recorded as those of the workers, and its
+    dependents are run according to their requirements.
+    """
+    cfg = get_default_config()
+    calls = []
+    a = parallel.Task(raise_exception, (0, ValueError('a')), step='a', barrier=True)
+    b = parallel.Task(record, (calls, 'b'), step='b', deps=[a], tilewise=False)
+    c = parallel.Task(record, (calls, 'c'), step='c', deps=[a], require='none',
+                      tilewise=False)
+    parallel.launch_graph(cfg, [a, b, c], 1, raise_errors=False,
+                          telemetry=str(tmp_path / 'telemetry.jsonl'))
+
+    assert calls == ['c']
+    assert [t.status for t in (a, b, c)] == ['error', 'skipped', 'done']
+    assert isinstance(a.output, ValueError)
+    records = report.read_telemetry(str(tmp_path / 'telemetry.jsonl'))
+    assert [(r['step'], r['status']) for r in records] == [('a', 'error'), ('c', 'done')]
+
+    a = parallel.Task(raise_exception, (0, ValueError('a')), step='a', barrier=True)
+    with pytest.raises(ValueError):
+        parallel.launch_graph(cfg, [a], 1)
+
+
+def pid_and_len(x):
+    """
+    Return the process id and the length of x.
+    """
+    return os.getpid(), len(x)
+
+
+def test_worker_pool():
+    """
+    Check that the workers of a worker_pool are reused by successive calls to
+    launch_calls, and that they receive the objects given at initialization.
+    """
+    cfg = get_default_config()
+    shared = list(range(1000))
+    with parallel.worker_pool(2, shared):
+        first = parallel.launch_calls(cfg, pid_and_len, [shared] * 4, 2, tilewise=False)
+        second = parallel.launch_calls(cfg, pid_and_len, [shared] * 4, 2, tilewise=False)
+
+    assert all(n == 1000 for _, n in first + second)
+    assert len(set(pid for pid, _ in first + second)) <= 2
+
+
+def test_launch_graph_timeout_and_retry():
+    """
+    Check that a hung task is killed at its deadline without blocking the
+    other ones, and that it is retried.
+    """
+    cfg = get_default_config()
+    slow = parallel.Task(time.sleep, (60,), step='sleep', tilewise=False)
+    fast = [parallel.Task(time.sleep, (0.1,), step='sleep', tilewise=False) for _ in range(4)]
+    t = time.time()
+    parallel.launch_graph(cfg, [slow] + fast, 2, timeout=2, max_retries=1,
+                          retry_backoff=0, raise_errors=False)
+
+    assert time.time() - t < 30
+    assert slow.status == 'timeout' and slow.attempts == 2
+    assert all(f.status == 'done' for f in fast)
+
+
+def test_launch_graph_task_timeout():
+    """
+    The timeout of a task replaces the one of the graph, and math.inf
+    disables it.
+    """
+    cfg = get_default_config()
+    unlimited = parallel.Task(time.sleep, (3,), step='sleep', tilewise=False,
+                              timeout=math.inf)
+    limited = parallel.Task(time.sleep, (60,), step='sleep', tilewise=False, timeout=1)
+    t = time.time()
+    parallel.launch_graph(cfg, [unlimited, limited], 2, timeout=2, raise_errors=False)
+
+    assert time.time() - t < 30
+    assert unlimited.status == 'done'
+    assert limited.status == 'timeout'
+
+
+def pool_sum(n):
+    """
+    Sum the squares of range(n) in a spawn multiprocessing.Pool.
+    """
+    with parallel.get_mp_context().Pool(2) as pool:
+        return sum(pool.map(abs, [i * i for i in range(n)]))
+
+
+def test_launch_graph_pool_in_worker():
+    """
+    The calls run in the workers can start their own pools, as global_dsm
+    does when there are more than 4 tiles per process to merge.
+    """
+    cfg = get_default_config()
+    task = parallel.Task(pool_sum, (4,), step='pool', tilewise=False)
+    parallel.launch_graph(cfg, [task], 2)
+
+    assert task.status == 'done'
+    assert task.output == 14
+
+
+def test_launch_graph_global_dsm(tmp_path):
+    """
+    Merge more than 4 x max_processes tiles with global_dsm run in a worker.
+    """
+    cfg = get_default_config()
+    cfg['out_dir'] = str(tmp_path)
+    cfg['max_processes'] = 2
+    cfg['dsm_resolution'] = 1
+    tiles = []
+    for i in range(12):
+        d = os.path.join(str(tmp_path), 'tiles', str(i))
+        os.makedirs(d)
+        transform = rasterio.transform.from_origin(10 * i, 10, 1, 1)
+        with rasterio.open(os.path.join(d, 'dsm.tif'), 'w', driver='GTiff',
+                           width=10, height=10, count=1, dtype='float32',
+                           crs='epsg:32631', transform=transform,
+                           nodata=np.nan) as f:
+            f.write(np.full((1, 10, 10), i, dtype='float32'))
+        tiles.append(Tile((10 * i, 0, 10, 10), d, [], ''))
+
+    tasks = [parallel.Task(s2p.global_dsm, (cfg, tiles), step='global_dsm',
+                           tilewise=False, timeout=math.inf)]
+    parallel.launch_graph(cfg, tasks, 2)
+
+    assert tasks[0].status == 'done'
+    with rasterio.open(os.path.join(str(tmp_path), 'dsm.tif')) as f:
+        dsm = f.read(1)
+    assert dsm.shape == (10, 120)
+    np.testing.assert_array_equal(dsm[:, ::10][0], np.arange(12))
+
+
+def test_launch_calls_costs():
+    """
+    Check that the most expensive calls are started first.
+    """
+    cfg = get_default_config()
+    calls = []
+    parallel.launch_calls(cfg, record, [(calls, k) for k in range(5)], 1,
+                          tilewise=False, costs=[1, 5, 2, 5, 3])
+    assert calls == [1, 3, 4, 2, 0]
+
+
+def test_file_queue_executor(tmp_path):
+    """
+    Run calls through a file queue served by a worker running in a thread.
+    """
+    cfg = get_default_config()
+    queue_dir = str(tmp_path / 'queue')
+    shared = list(range(1000))
+    worker = threading.Thread(target=parallel.serve_file_queue,
+                              args=(queue_dir, 2), kwargs={'max_idle_time': 2})
+    worker.start()
+    with parallel.worker_pool(3, shared, executor='file_queue', queue_dir=queue_dir):
+        outputs = parallel.launch_calls(cfg, pid_and_len, [shared] * 4, 3, tilewise=False)
+        with pytest.raises(subprocess.CalledProcessError):
+            parallel.launch_calls(cfg, raise_exception, [0], 1,
+                                  subprocess.CalledProcessError(1, "failcmd"),
+                                  tilewise=False)
+    worker.join()
+
+    assert [n for _, n in outputs] == [1000] * 4
+    assert len(set(pid for pid, _ in outputs)) <= 2
+
+
+def sleep_and_time(t):
+    """
+    Sleep for t seconds and return the start and end times.
+    """
+    start = time.time()
+    time.sleep(t)
+    return start, time.time()
+
+
+def test_launch_graph_resources():
+    """
+    Check that tasks run simultaneously only if their resources fit.
+    """
+    cfg = get_default_config()
+    big = [parallel.Task(sleep_and_time, (0.5,), step='big', tilewise=False,
+                         resources={'memory': 600}) for _ in range(2)]
+    small = parallel.Task(sleep_and_time, (0.5,), step='small', tilewise=False,
+                          resources={'memory': 300}, cost=-1)
+    parallel.launch_graph(cfg, big + [small], 3, resources={'memory': 1000})
+
+    (s0, e0), (s1, e1), (s2, e2) = [t.output for t in big + [small]]
+    assert s1 >= e0 or s0 >= e1
+    assert s2 < min(e0, e1)
+
+
+def test_launch_graph_telemetry(tmp_path):
+    """
+    Check that a telemetry record is written for each attempt of each task,
+    and that it can be summarized.
+    """
+    cfg = get_default_config()
+    path = str(tmp_path / 'telemetry.jsonl')
+    tasks = [parallel.Task(time.sleep, (0.1,), step='sleep', tilewise=False) for _ in range(3)]
+    tasks.append(parallel.Task(raise_exception, (0, ValueError()), step='raise',
+                               tilewise=False))
+    parallel.launch_graph(cfg, tasks, 2, max_retries=1, retry_backoff=0,
+                          raise_errors=False, telemetry=path)
+
+    records = report.read_telemetry(path)
+    assert sorted(r['status'] for r in records) == ['done'] * 3 + ['error'] * 2
+    assert all(r['end'] - r['start'] >= 0.1 for r in records if r['step'] == 'sleep')
+    assert all(r['peak_rss_mb'] > 0 for r in records)
+    assert 'sleep' in report.summary(records)
+
+
+def test_critical_path(tmp_path):
+    """
+    Check that the critical path is the longest chain of prerequisites, and
+    that launch_calls writes telemetry too.
+    """
+    cfg = get_default_config()
+    path = str(tmp_path / 'telemetry.jsonl')
+    a = parallel.Task(time.sleep, (0.3,), step='a', tilewise=False)
+    b = parallel.Task(time.sleep, (0.3,), step='b', tilewise=False, after=[a])
+    c = parallel.Task(time.sleep, (0.5,), step='c', tilewise=False)
+    d = parallel.Task(time.sleep, (0.1,), step='d', tilewise=False, deps=[b, c])
+    parallel.launch_graph(cfg, [a, b, c, d], 2, telemetry=path)
+    parallel.launch_calls(cfg, time.sleep, [0.1, 0.1], 2, tilewise=False, telemetry=path)
+
+    records = report.read_telemetry(path)
+    assert len(records) == 6
+    lines = report.critical_path(records)
+    assert [line.split()[-1] for line in lines[1:]] == ['a', 'b', 'd']
+    assert lines[0].endswith('in 3 tasks:')
+
+
+def test_launch_graph_groups_and_new_tasks():
+    """
+    Check that tasks added while the graph runs are scheduled, that the
+    workers are shared between the groups, and that priorities come first.
+    """
+    cfg = get_default_config()
+    a = [parallel.Task(sleep_and_time, (0.5,), step='sleep', tilewise=False, group='a')
+         for _ in range(4)]
+    b = [parallel.Task(sleep_and_time, (0.5,), step='sleep', tilewise=False, group='b')
+         for _ in range(2)]
+    added = [b]
+    parallel.launch_graph(cfg, a, 2, new_tasks=lambda: added.pop() if added else [])
+
+    assert all(t.status == 'done' for t in a + b)
+    # a gets one worker out of two until b is finished
+    assert max(t.output[0] for t in b) < sorted(t.output[0] for t in a)[2]
+
+    calls = []
+    tasks = [parallel.Task(record, (calls, k), step='record', tilewise=False,
+                           cost=k, priority=int(k == 0)) for k in range(3)]
+    parallel.launch_graph(cfg, tasks, 1)
+    assert calls == [0, 2, 1]
@@ -0,0 +1,121 @@
+import numpy as np
+import plyfile
+import pytest
+
+from s2p import ply
+
+
+def write_with_plyfile(path, columns, comments):
+    """
+    Write a point cloud with plyfile, as ply.write_3d_point_cloud_to_ply
+    used to.
+    """
+    data = np.rec.fromarrays([c for _, c in columns],
+                             dtype=[(name, c.dtype) for name, c in columns])
+    plyfile.PlyData([plyfile.PlyElement.describe(data, 'vertex')],
+                    comments=comments).write(path)
+
+
+@pytest.mark.parametrize("nb_channels", [None, 1, 3])
+@pytest.mark.parametrize("extra", [False, True])
+@pytest.mark.parametrize("n", [0, 1000])
+def test_write_3d_point_cloud_to_ply(tmp_path, monkeypatch, nb_channels, extra, n):
+    """
+    The point clouds are written as plyfile writes them, whatever the size
+    of the chunks.
+    """
+    rng = np.random.default_rng(0)
+    xyz = rng.normal(0, 1000, (n, 3))
+    columns = list(zip('xyz', xyz.T))
+    colors = None
+    if nb_channels is not None:
+        colors = rng.integers(0, 256, (n, nb_channels), dtype=np.uint8)
+        columns += list(zip(['red', 'green', 'blue'], (colors if nb_channels == 3 else
+                                                       np.repeat(colors, 3, axis=1)).T))
+    confidence = None
+    if extra:
+        confidence = rng.random(n).astype(np.float32)
+        columns.append(('confidence', confidence))
+    comments = ['created by S2P', 'projection: CRS epsg:32631']
+
+    expected = str(tmp_path / 'expected.ply')
+    write_with_plyfile(expected, columns, comments)
+
+    computed = str(tmp_path / 'computed.ply')
+    monkeypatch.setattr(ply, 'WRITE_CHUNK_SIZE', 1000)
+    ply.write_3d_point_cloud_to_ply(computed, xyz, colors=colors,
+                                    extra_properties=confidence,
+                                    extra_properties_names=['confidence'] if extra else None,
+                                    comments=comments)
+    with open(expected, 'rb') as f, open(computed, 'rb') as g:
+        assert f.read() == g.read()
+
+    array, read_comments = ply.read_3d_point_cloud_from_ply(computed)
+    assert read_comments == comments
+    np.testing.assert_array_equal(array[:, :3], xyz)
+
+
+def test_write_3d_point_cloud_to_ply_mask(tmp_path):
+    """
+    The masked points are skipped, as if the inputs were indexed by the mask.
+    """
+    rng = np.random.default_rng(0)
+    xyz = rng.normal(0, 1000, (1000, 3))
+    colors = rng.integers(0, 256, (1000, 1), dtype=np.uint8)
+    mask = rng.random(1000) > 0.3
+
+    expected = str(tmp_path / 'expected.ply')
+    ply.write_3d_point_cloud_to_ply(expected, xyz[mask], colors=colors[mask])
+    computed = str(tmp_path / 'computed.ply')
+    ply.write_3d_point_cloud_to_ply(computed, xyz, colors=colors, mask=mask)
+    with open(expected, 'rb') as f, open(computed, 'rb') as g:
+        assert f.read() == g.read()
+
+
+@pytest.mark.parametrize("text", ['binary_little_endian', 'binary_big_endian', 'ascii'])
+def test_read_vertices(tmp_path, text):
+    """
+    The binary ply files are memory-mapped, the others are read with plyfile.
+    """
+    rng = np.random.default_rng(0)
+    xyz = rng.normal(0, 1000, (100, 3))
+    colors = rng.integers(0, 256, (100, 3), dtype=np.uint8)
+    columns = list(zip('xyz', xyz.T)) + list(zip(['red', 'green', 'blue'], colors.T))
+    comments = ['created by S2P', 'projection: CRS epsg:32631']
+    path = str(tmp_path / 'cloud.ply')
+    data = np.rec.fromarrays([c for _, c in columns],
+                             dtype=[(name, c.dtype) for name, c in columns])
+    plyfile.PlyData([plyfile.PlyElement.describe(data, 'vertex')], comments=comments,
+                    text=text == 'ascii',
+                    byte_order='>' if text == 'binary_big_endian' else '<').write(path)
+
+    if text == 'ascii':
+        with pytest.raises(ValueError):
+            ply.read_vertices(path)
+    else:
+        vertices, read_comments = ply.read_vertices(path)
+        assert isinstance(vertices, np.memmap)
+        assert read_comments == comments
+        for name, c in columns:
+            np.testing.assert_array_equal(vertices[name], c)
+        assert ply.bounds(vertices) == [100, xyz[:, 0].min(), xyz[:, 1].min(),
+                                        xyz[:, 0].max(), xyz[:, 1].max()]
+
+    array, read_comments = ply.read_3d_point_cloud_from_ply(path)
+    assert read_comments == comments
+    np.testing.assert_array_equal(array, np.column_stack([c for _, c in columns]))
+
+
+def test_bounds_of_written_cloud(tmp_path):
+    """
+    The bounds returned by the writer are the ones of the written cloud.
+    """
+    xyz = np.random.default_rng(0).normal(0, 1000, (100, 3))
+    mask = xyz[:, 2] > 0
+    path = str(tmp_path / 'cloud.ply')
+    b = ply.write_3d_point_cloud_to_ply(path, xyz, mask=mask)
+    assert b == ply.bounds(ply.read_vertices(path)[0])
+    assert b[0] == np.count_nonzero(mask)
+
+    b = ply.write_3d_point_cloud_to_ply(path, xyz[:0])
+    assert b[0] == 0 and len(ply.read_vertices(path)[0]) == 0
@@ -0,0 +1,51 @@
+import os
+import time
+
+from s2p import profiling
+
+
+def busy_loop(seconds):
+    """
+    Run Python code for some seconds.
+    """
+    t = time.perf_counter()
+    while time.perf_counter() - t < seconds:
+        sum(range(1000))
+
+
+def profiled_step(seconds):
+    busy_loop(seconds)
+
+
+def test_sample_and_merge_profiles(tmp_path):
+    """
+    Profile two tasks of the same step in two tile directories, and check
+    that the merged profile sums their stacks.
+    """
+    for k in range(2):
+        tile_dir = tmp_path / 'tiles' / 'tile_{}'.format(k)
+        tile_dir.mkdir(parents=True)
+        path = str(tile_dir / 'profile_profiled_step.collapsed')
+        with profiling.sample_stacks(path, root=profiled_step):
+            profiled_step(0.3)
+
+    paths = profiling.merge_profiles(str(tmp_path / 'tiles'), str(tmp_path / 'profile'))
+    assert paths == [os.path.join(str(tmp_path / 'profile'), 'profiled_step.collapsed')]
+
+    stacks = profiling.read_collapsed(paths[0])
+    assert all(s.startswith('profiling_test.profiled_step') for s in stacks)
+    busy = sum(w for s, w in stacks.items() if 'profiling_test.busy_loop' in s)
+    assert 0.4 < busy < 0.8
+
+
+def test_samples_outside_root(tmp_path):
+    """
+    The samples taken while the root function is not running are dropped.
+    """
+    path = str(tmp_path / 'profile_profiled_step.collapsed')
+    with profiling.sample_stacks(path, root=profiled_step):
+        busy_loop(0.2)
+        profiled_step(0.2)
+    stacks = profiling.read_collapsed(path)
+    assert stacks
+    assert all(s.startswith('profiling_test.profiled_step') for s in stacks)
@@ -0,0 +1,59 @@
+import json
+import threading
+import http.client
+
+import s2p
+from s2p import config
+from s2p import service
+from tests_utils import data_path
+
+
+def request(server, method, path, body=None):
+    """
+    Send a request to the HTTP API of a service, and return the status and
+    the decoded json reply.
+    """
+    conn = http.client.HTTPConnection(*server.server_address)
+    conn.request(method, path, body=None if body is None else json.dumps(body))
+    r = conn.getresponse()
+    out = r.status, json.loads(r.read())
+    conn.close()
+    return out
+
+
+def test_service(tmp_path):
+    """
+    Submit jobs through the HTTP API, and run a job whose ROI is outside of
+    the images.
+    """
+    cfg = config.get_default_config()
+    cfg['max_processes'] = 2
+    srv = service.Service(cfg)
+    server = service.make_server(srv, ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    run = threading.Thread(target=srv.run)
+    run.start()
+    try:
+        user_cfg = s2p.read_config_file(data_path('input_pair/config.json'))
+        user_cfg['out_dir'] = str(tmp_path / 'out')
+        user_cfg['roi'] = {'x': 100000, 'y': 100000, 'w': 100, 'h': 100}
+
+        assert request(server, 'POST', '/jobs', {'out_dir': 'x'})[0] == 400
+        status, job = request(server, 'POST', '/jobs?priority=2', user_cfg)
+        assert status == 201 and job['priority'] == 2
+        assert request(server, 'POST', '/jobs', user_cfg)[0] == 400  # same out_dir
+        assert request(server, 'GET', '/jobs/unknown')[0] == 404
+
+        srv.stop()
+        run.join(60)
+        assert not run.is_alive()
+        status, job = request(server, 'GET', '/jobs/' + job['id'])
+        assert status == 200
+        assert job['status'] == 'failed' and 'ROI' in job['error']
+        assert job['progress'] == {'is_this_tile_useful': {'done': 1},
+                                   'create_tiles': {'done': 1}}
+        assert [j['id'] for j in request(server, 'GET', '/jobs')[1]] == [job['id']]
+    finally:
+        srv.stop()
+        server.shutdown()
+        server.server_close()
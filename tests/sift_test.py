@@ -3,9 +3,11 @@
 # Copyright (C) 2019, Julien Michel (CNES) <julien.michel@cnes.fr>
 
 import numpy as np
+import pytest
 import rpcm
 
 from s2p import sift
+from s2p import common
 from s2p.config import get_default_config
 from tests_utils import data_path
 
@@ -50,3 +52,69 @@ def test_matches_on_rpc_roi():
     expected = np.loadtxt(data_path('expected_output/units/matches_on_rpc_roi.txt'))
     np.testing.assert_allclose(computed, expected, rtol=0.01, atol=0.1,
                                verbose=True)
+
+
+@pytest.mark.parametrize('matches_on_rpc_roi', [sift.matches_on_rpc_roi,
+                                                sift.matches_on_rpc_roi_cv])
+def test_matches_on_rpc_roi_overview(monkeypatch, matches_on_rpc_roi):
+    """
+    The epipolar and RANSAC thresholds are scaled by the overview factor.
+    """
+    img1 = data_path('input_triplet/img_01.tif')
+    img2 = data_path('input_triplet/img_02.tif')
+    rpc1 = rpcm.rpc_from_geotiff(img1)
+    rpc2 = rpcm.rpc_from_geotiff(img2)
+    cfg = get_default_config()
+    cfg['sift_overview_factor'] = 2
+
+    thresholds = []
+    keypoints_match = sift.keypoints_match
+
+    def spy(*args, **kwargs):
+        thresholds.append((kwargs['epipolar_threshold'], kwargs['ransac_max_err']))
+        return keypoints_match(*args, **kwargs)
+
+    monkeypatch.setattr(sift, 'keypoints_match', spy)
+    computed = matches_on_rpc_roi(cfg, img1, img2, rpc1, rpc2, 100, 100, 200, 200,
+                                  method='relative', sift_thresh=0.6, epipolar_threshold=10)
+
+    assert thresholds[0] == (20, 0.6)
+    assert len(computed) > 10
+
+
+def test_image_keypoints_cv_cache(tmp_path):
+    """
+    The keypoints read from the cache are the ones computed on the first call.
+    """
+    img = data_path('input_triplet/img_02.tif')
+    kp, des = sift.image_keypoints_cv(img, 100, 100, 200, 200, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    cached_kp, cached_des = sift.image_keypoints_cv(img, 100, 100, 200, 200,
+                                                    cache_dir=str(tmp_path))
+    np.testing.assert_allclose([k.pt for k in cached_kp], [k.pt for k in kp], atol=1e-4)
+    assert [k.octave for k in cached_kp] == [k.octave for k in kp]
+    np.testing.assert_array_equal(cached_des, des)
+
+    # another region is not read from the cache
+    sift.image_keypoints_cv(img, 100, 100, 150, 200, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_read_roi_decimated(tmp_path):
+    """
+    Unit test for the functions sift.read_roi_decimated and
+    sift.to_full_resolution: a bright square read at reduced resolution is
+    mapped back to its position in the full image.
+    """
+    img = np.zeros((400, 600), dtype=np.float32)
+    img[200:216, 320:336] = 1
+    path = str(tmp_path / 'img.tif')
+    common.rasterio_write(path, img)
+
+    array, decimation = sift.read_roi_decimated(path, 100, 100, 400, 400, 4)
+    assert array.shape == (1, 75, 100)  # the roi is clipped to 300 x 400
+    j, i = np.nonzero(array[0] == array[0].max())
+    center = np.array([[i.mean(), j.mean()]])
+    sift.to_full_resolution(center, decimation)
+    np.testing.assert_allclose(center, [[327.5, 207.5]])
@@ -31,6 +31,7 @@ import rpcm
 
 import s2p
 from s2p import common
+from s2p import metadata
 
 def pix_2_latlon(gt, px, py, zone_number, northern):
     x = px * gt[1] + gt[0]
@@ -183,6 +184,7 @@ def write_tiles_polygon(tile, kml, m=None, M=None, message=None, error_mode=Fals
         head_style = green_style
 
     tile_cfg = s2p.read_config_file(os.path.join(tile, "config.json"))
+    tile_cfg.setdefault('metadata_db', False)  # configs written before the option
     x = tile_cfg['roi']['x']
     y = tile_cfg['roi']['y']
     w = tile_cfg['roi']['w']
@@ -211,8 +213,8 @@ def write_tiles_polygon(tile, kml, m=None, M=None, message=None, error_mode=Fals
         disp_min_max = os.path.join(pair_dir,
                                     "disp_min_max.txt")
 
-        if os.path.exists(disp_min_max) is True:
-            disp_min, disp_max = np.loadtxt(disp_min_max)
+        if metadata.exists(tile_cfg, disp_min_max):
+            disp_min, disp_max = metadata.load(tile_cfg, disp_min_max)
         else:
             disp_min, disp_max = None, None
 